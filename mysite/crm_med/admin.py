@@ -36,3 +36,5 @@ admin.site.register(Receptionist)
 admin.site.register(Room)
 admin.site.register(Doctor)
 admin.site.register(Patient)
+admin.site.register(PatientCard)
+admin.site.register(OutboxMessage)
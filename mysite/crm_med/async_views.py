@@ -0,0 +1,267 @@
+import asyncio
+
+from asgiref.sync import sync_to_async
+from django.db.models import Count, Q, Sum
+from django.http import HttpResponse
+from django.utils import timezone
+from django.views import View
+from rest_framework.exceptions import APIException, MethodNotAllowed, NotAuthenticated, PermissionDenied, ValidationError
+from rest_framework.permissions import AllowAny
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.views import exception_handler
+
+from .authentication import ClaimsJWTAuthentication
+from .cache import CachedResponseMixin, etag_matches, get_cache, record
+from .changes import ChangeCounterETagMixin, acurrent
+from .middleware import phase
+from .models import Doctor, Patient, PATIENT_STATUS_CHOICES
+from .reports import analysis_rows, analysis_chart, calendar_window, effective_price
+from .views import (
+    CalendarListAPIView, DoctorPatientAPIView, PatientHistoryAPIView, PatientHistoryAppointmentAPIView,
+    PatientHistoryPaymentAPIView, AnalysisAPIView, analysis_response, ANALYSIS_PERIODS,
+)
+
+
+# Async-версии read-heavy представлений для ASGI (mysite/asgi.py): запросы
+# к базе — через async ORM, поток занят только на время самого SQL, а не всего
+# запроса. Фильтры, сериализаторы, права и формат ответов — те же, что
+# у синхронных представлений в views.py; отвечают только JSON.
+
+
+class AsyncAPIView(View):
+    """
+    Минимальный async-аналог APIView: JWT (ClaimsJWTAuthentication.aauthenticate),
+    permission_classes, исключения DRF и JSON-рендер без перехода в поток.
+    Обработчики get() возвращают rest_framework.response.Response.
+    """
+    http_method_names = ['get', 'options']
+    permission_classes = api_settings.DEFAULT_PERMISSION_CLASSES
+    serializer_class = None
+    pagination_class = None
+    renderer = JSONRenderer()
+
+    async def dispatch(self, request, *args, **kwargs):
+        # Request без аутентификаторов: пользователь выставляется ниже, асинхронно
+        request = Request(request, authenticators=[])
+        request.accepted_renderer = self.renderer
+        request.accepted_media_type = self.renderer.media_type
+        self.request, self.args, self.kwargs = request, args, kwargs
+        try:
+            handler = getattr(self, request.method.lower(), None)
+            if request.method.lower() not in self.http_method_names or handler is None:
+                raise MethodNotAllowed(request.method)
+            with phase('auth'):
+                result = await ClaimsJWTAuthentication().aauthenticate(request._request)
+            if result is not None:
+                request.user, request.auth = result
+            self.check_permissions(request)
+            response = await handler(request, *args, **kwargs)
+        except APIException as exc:
+            response = exception_handler(exc, {'view': self, 'request': request, 'args': args, 'kwargs': kwargs})
+            if response.status_code == 401:
+                response['WWW-Authenticate'] = ClaimsJWTAuthentication().authenticate_header(request)
+        return self.finalize(request, response)
+
+    async def options(self, request, *args, **kwargs):
+        return Response(status=200, headers={'Allow': ', '.join(method.upper() for method in self.http_method_names)})
+
+    def check_permissions(self, request):
+        for permission in [permission() for permission in self.permission_classes]:
+            if isinstance(permission, AllowAny):
+                continue
+            if not request.user or not request.user.is_authenticated:
+                raise NotAuthenticated()
+            if not permission.has_permission(request, self):
+                raise PermissionDenied(getattr(permission, 'message', None))
+
+    def finalize(self, request, response):
+        # готовый HttpResponse: ответ с render() Django отрендерил бы в потоке
+        with phase('render'):
+            response.accepted_renderer = self.renderer
+            response.accepted_media_type = self.renderer.media_type
+            response.renderer_context = {'view': self, 'args': self.args, 'kwargs': self.kwargs, 'request': request}
+            response.render()
+        rendered = HttpResponse(response.content, status=response.status_code)
+        for header, value in response.items():
+            rendered[header] = value
+        return rendered
+
+    def get_serializer(self, *args, **kwargs):
+        kwargs.setdefault('context', {'request': self.request, 'format': None, 'view': self})
+        return self.serializer_class(*args, **kwargs)
+
+    @property
+    def paginator(self):
+        if not hasattr(self, '_paginator'):
+            self._paginator = self.pagination_class() if self.pagination_class else None
+        return self._paginator
+
+    async def paginate_queryset(self, queryset):
+        # курсорная пагинация DRF как есть: её запрос страницы — в потоке
+        return await sync_to_async(self.paginator.paginate_queryset)(queryset, self.request, view=self)
+
+    async def paginated(self, queryset):
+        page = await self.paginate_queryset(queryset)
+        return self.paginator.get_paginated_response(self.get_serializer(page, many=True).data)
+
+
+class AsyncConditionalMixin(ChangeCounterETagMixin):
+    """ChangeCounterETagMixin для AsyncAPIView: счётчики читаются через async ORM."""
+
+    async def get(self, request, *args, **kwargs):
+        etag = self.etag_from(request, await acurrent(self.get_change_scopes(request)))
+        if etag_matches(request, etag):
+            response = Response(status=304)
+        else:
+            response = await self.get_list(request)
+            if response.status_code != 200:
+                return response
+        return self.with_etag(response, etag)
+
+
+class AsyncCachedResponseMixin(CachedResponseMixin):
+    """CachedResponseMixin для AsyncAPIView: промах считается get_uncached() через async ORM."""
+
+    async def get(self, request, *args, **kwargs):
+        # кэш ответов — без базы; вызовы локального или файлового кэша короткие
+        key = self.get_response_cache_key(request)
+        entry = get_cache().get(key)
+        if entry is not None:
+            record(self.cache_name, 'hits')
+            return self.cached_response(request, entry, 'HIT')
+
+        record(self.cache_name, 'misses')
+        response = await self.get_uncached(request, *args, **kwargs)
+        return self.store_response(request, key, response)
+
+
+class CalendarListAsyncView(AsyncConditionalMixin, AsyncAPIView):
+    """
+    CalendarListAPIView через async ORM. doctor и department — целые id
+    (без проверки существования: несуществующий id даёт пустой список).
+    """
+    permission_classes = CalendarListAPIView.permission_classes
+    serializer_class = CalendarListAPIView.serializer_class
+    pagination_class = CalendarListAPIView.pagination_class
+    query_budget = CalendarListAPIView.query_budget
+    get_change_scope = CalendarListAPIView.get_change_scope
+
+    async def get_list(self, request):
+        start, end = calendar_window(request.query_params.get('start'), request.query_params.get('end'))
+        queryset = Patient.objects.select_related('doctor__job_title', 'department').filter(
+            appointment_date__gte=start,
+            appointment_date__lt=end,
+        )
+        for field in ('doctor', 'department'):
+            value = request.query_params.get(field)
+            if value:
+                if not value.isdigit():
+                    raise ValidationError({field: ["Select a valid choice. That choice is not one of the available choices."]})
+                queryset = queryset.filter(**{f'{field}_id': int(value)})
+        return await self.paginated(queryset)
+
+
+class DoctorPatientAsyncView(AsyncConditionalMixin, AsyncAPIView):
+    permission_classes = DoctorPatientAPIView.permission_classes
+    serializer_class = DoctorPatientAPIView.serializer_class
+    pagination_class = DoctorPatientAPIView.pagination_class
+    query_budget = DoctorPatientAPIView.query_budget
+    get_change_scope = DoctorPatientAPIView.get_change_scope
+    get_queryset = DoctorPatientAPIView.get_queryset
+
+    async def get_list(self, request):
+        return await self.paginated(self.get_queryset())
+
+
+class PatientHistoryAsyncView(AsyncAPIView):
+    """PatientHistoryAPIView: счётчики по статусам и страница визитов — параллельно."""
+    permission_classes = PatientHistoryAPIView.permission_classes
+    serializer_class = PatientHistoryAPIView.serializer_class
+    pagination_class = PatientHistoryAPIView.pagination_class
+    query_budget = PatientHistoryAPIView.query_budget
+    get_queryset = PatientHistoryAPIView.get_queryset
+
+    async def get(self, request, *args, **kwargs):
+        queryset = self.get_queryset()
+        status_counts = queryset.values('patient_status').annotate(count=Count('id')).order_by()
+        rows, page = await asyncio.gather(
+            collect(status_counts),
+            self.paginate_queryset(queryset),
+        )
+        counts_dict = {status: 0 for status, _ in PATIENT_STATUS_CHOICES}
+        for item in rows:
+            counts_dict[item['patient_status']] = item['count']
+        counts_dict['all'] = sum(item['count'] for item in rows)
+
+        return Response({
+            "report": counts_dict,
+            "patients": self.get_serializer(page, many=True).data,
+            "next": self.paginator.get_next_link(),
+            "previous": self.paginator.get_previous_link(),
+        })
+
+
+class PatientHistoryAppointmentAsyncView(AsyncAPIView):
+    permission_classes = PatientHistoryAppointmentAPIView.permission_classes
+    serializer_class = PatientHistoryAppointmentAPIView.serializer_class
+    query_budget = PatientHistoryAppointmentAPIView.query_budget
+    get_queryset = PatientHistoryAppointmentAPIView.get_queryset
+
+    async def get(self, request, *args, **kwargs):
+        patients = self.get_serializer(await collect(self.get_queryset()), many=True).data
+        return Response({
+            'patient_quantity': len(patients),
+            'patients': patients,
+        })
+
+
+class PatientHistoryPaymentAsyncView(AsyncAPIView):
+    """PatientHistoryPaymentAPIView: суммы по способу оплаты — aaggregate параллельно со списком."""
+    permission_classes = PatientHistoryPaymentAPIView.permission_classes
+    serializer_class = PatientHistoryPaymentAPIView.serializer_class
+    query_budget = PatientHistoryPaymentAPIView.query_budget + 1
+    get_queryset = PatientHistoryPaymentAPIView.get_queryset
+
+    async def get(self, request, *args, **kwargs):
+        queryset = self.get_queryset()
+        patients, totals = await asyncio.gather(
+            collect(queryset),
+            queryset.order_by().aaggregate(
+                cash=Sum(effective_price(), filter=Q(payment_type='cash'), default=0),
+                card=Sum(effective_price(), filter=~Q(payment_type='cash'), default=0),
+            ),
+        )
+        return Response({
+            'cash': totals['cash'],
+            'card': totals['card'],
+            'total_sum': totals['cash'] + totals['card'],
+            'patients': self.get_serializer(patients, many=True).data,
+        })
+
+
+class AnalysisAsyncView(AsyncCachedResponseMixin, AsyncAPIView):
+    """AnalysisAPIView: число докторов и график — два независимых запроса параллельно."""
+    permission_classes = AnalysisAPIView.permission_classes
+    # общий кэш с синхронной версией: ответы совпадают
+    cache_name = AnalysisAPIView.cache_name
+    cache_timeout = AnalysisAPIView.cache_timeout
+    query_budget = AnalysisAPIView.query_budget
+
+    async def get_uncached(self, request):
+        period = request.query_params.get("period", "weekly")
+
+        if period not in ANALYSIS_PERIODS:
+            return Response({"error": "Invalid period"}, status=400)
+
+        now = timezone.now()
+        starts, rows = analysis_rows(Patient.objects.all(), period, now)
+        total_doctors, rows = await asyncio.gather(Doctor.objects.acount(), collect(rows))
+        totals, chart = analysis_chart(starts, rows)
+        return Response(analysis_response(total_doctors, totals, chart))
+
+
+async def collect(queryset):
+    return [row async for row in queryset]
@@ -0,0 +1,132 @@
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.utils.functional import cached_property
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.models import TokenUser
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.utils import get_md5_hash_password
+
+from .cache import get_cache
+from .models import UserProfile
+
+
+# Роль и отпечаток пароля записываются в токен при входе (LoginSerializer),
+# поэтому проверка прав не читает UserProfile на каждый запрос.
+ROLE_CLAIM = 'user_role'
+PASSWORD_CLAIM = 'password_hash'
+
+
+def add_claims(token, user):
+    """Claims роли и пароля; access-токен копирует их из refresh-токена."""
+    token[ROLE_CLAIM] = user.user_role
+    token[PASSWORD_CLAIM] = get_md5_hash_password(user.password)
+    return token
+
+
+def _state_key(user_id):
+    return f'crm_med:user_state:{user_id}'
+
+
+def user_state(user_id):
+    """
+    Активен ли пользователь, его роль и отпечаток пароля — из кэша на
+    AUTH_USER_STATE_TIMEOUT секунд, иначе одним запросом к базе.
+    None, если пользователя нет.
+    """
+    state = get_cache().get(_state_key(user_id))
+    if state is None:
+        state = _remember_state(user_id, _state_query(user_id).first())
+    return state if state['exists'] else None
+
+
+async def auser_state(user_id):
+    """user_state для async-представлений: промах кэша читается через async ORM."""
+    state = get_cache().get(_state_key(user_id))
+    if state is None:
+        state = _remember_state(user_id, await _state_query(user_id).afirst())
+    return state if state['exists'] else None
+
+
+def _state_query(user_id):
+    return UserProfile.objects.filter(pk=user_id).values('is_active', 'user_role', 'password')
+
+
+def _remember_state(user_id, user):
+    state = {
+        'exists': user is not None,
+        'is_active': bool(user and user['is_active']),
+        'user_role': user and user['user_role'],
+        'password_hash': user and get_md5_hash_password(user['password']),
+    }
+    get_cache().set(_state_key(user_id), state, getattr(settings, 'AUTH_USER_STATE_TIMEOUT', 60))
+    return state
+
+
+def forget_user_state(user_id):
+    get_cache().delete(_state_key(user_id))
+
+
+class ClaimsUser(TokenUser):
+    """Пользователь из claims токена: id, user_role; без запроса к базе."""
+
+    @cached_property
+    def user_role(self):
+        return self.token.get(ROLE_CLAIM)
+
+
+class ClaimsJWTAuthentication(JWTAuthentication):
+    """
+    JWTAuthentication без загрузки UserProfile: request.user — ClaimsUser.
+    Удалённый или отключённый пользователь, смена роли или пароля делают
+    токен недействительным (с задержкой до AUTH_USER_STATE_TIMEOUT в других
+    процессах, если кэш не общий). Токены без claims роли, выданные до
+    этого изменения, проверяются как раньше — через базу.
+    """
+
+    def get_user(self, validated_token):
+        if ROLE_CLAIM not in validated_token:
+            return super().get_user(validated_token)
+        return self.claims_user(validated_token, user_state(self.token_user_id(validated_token)))
+
+    async def aget_user(self, validated_token):
+        if ROLE_CLAIM not in validated_token:
+            return await sync_to_async(super().get_user)(validated_token)
+        return self.claims_user(validated_token, await auser_state(self.token_user_id(validated_token)))
+
+    async def aauthenticate(self, request):
+        """authenticate() для async-представлений (crm_med/async_views.py)."""
+        header = self.get_header(request)
+        if header is None:
+            return None
+        raw_token = self.get_raw_token(header)
+        if raw_token is None:
+            return None
+        validated_token = self.get_validated_token(raw_token)
+        return await self.aget_user(validated_token), validated_token
+
+    def token_user_id(self, validated_token):
+        try:
+            return validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError:
+            raise AuthenticationFailed("Token contained no recognizable user identification", code='token_not_valid')
+
+    def claims_user(self, validated_token, state):
+        if state is None:
+            raise AuthenticationFailed("User not found", code='user_not_found')
+        if not state['is_active']:
+            raise AuthenticationFailed("User is inactive", code='user_inactive')
+        if (state['user_role'] != validated_token[ROLE_CLAIM]
+                or state['password_hash'] != validated_token.get(PASSWORD_CLAIM)):
+            raise AuthenticationFailed("Token has been revoked, log in again", code='token_revoked')
+        return ClaimsUser(validated_token)
+
+
+def user_from_token(raw_token):
+    """
+    Пользователь по access-токену вне DRF (поток SSE, WebSocket):
+    браузерные EventSource и WebSocket не отправляют заголовок Authorization,
+    токен передаётся параметром. AuthenticationFailed / InvalidToken — как в DRF.
+    """
+    authentication = ClaimsJWTAuthentication()
+    return authentication.get_user(authentication.get_validated_token(raw_token.encode()))
@@ -0,0 +1,384 @@
+import asyncio
+import io
+import os
+import platform
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from urllib.parse import urlencode
+
+import django
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection, transaction
+from django.urls import reverse
+from django.utils import timezone
+from PIL import Image
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from .authentication import add_claims
+from .cache import bump_version, PATIENT_DATA, REFERENCE_DATA
+from .models import Admin, Receptionist, Doctor, ServiceType, Patient
+from .seeding import ADMIN_EMAIL, PASSWORD
+from . import middleware as server_timing
+
+
+# Замеры эндпоинтов crm_med/urls.py на синтетических данных
+# (management-команда benchmark, данные — crm_med/seeding.py).
+
+SCALES = {'10k': 10_000, '100k': 100_000, '1m': 1_000_000}
+
+# маршруты, которые не замеряются: сторонние (django_rest_passwordreset)
+# и поток SSE, который не завершается
+SKIPPED_ROUTES = {'password_reset', 'doctor_notification_stream'}
+
+
+def is_seeded(rows):
+    return Admin.objects.filter(email=ADMIN_EMAIL).exists() and Patient.objects.count() == rows
+
+
+def fixtures():
+    """Пользователи и объекты, на которых вызываются эндпоинты."""
+    admin = Admin.objects.get(email=ADMIN_EMAIL)
+    receptionist = Receptionist.objects.order_by('id').first()
+    doctor = Doctor.objects.order_by('id').first()
+    patient = Patient.objects.filter(doctor=doctor).order_by('-id').first()
+    return {
+        'admin': admin,
+        'receptionist': receptionist,
+        'doctor': doctor,
+        'patient': patient,
+        'service': ServiceType.objects.filter(department_id=doctor.department_id).first(),
+        'recent_ids': list(Patient.objects.order_by('-id').values_list('id', flat=True)[:100]),
+    }
+
+
+def visit_row(f, minutes=0):
+    return {
+        'name': f'Bench Visitor {minutes}', 'phone': f'+996555{minutes:06d}', 'service_type': f['service'].id,
+        'birthday': '1990-01-01', 'department': f['doctor'].department_id, 'registrar': f['receptionist'].id,
+        'appointment_date': (timezone.now() + timedelta(minutes=minutes)).isoformat(), 'gender': 'female',
+        'doctor': f['doctor'].id, 'payment_type': 'cash', 'patient_status': 'pre-registration',
+    }
+
+
+def typo(name):
+    # переставленные буквы в фамилии: 'Асан Асанов' -> 'Асан Аснаов'
+    first, last = name.split()[:2]
+    if len(last) < 4:
+        return name
+    return f'{first} {last[:2]}{last[3]}{last[2]}{last[4:]}'
+
+
+def profile_image():
+    buffer = io.BytesIO()
+    Image.new('RGB', (64, 64), 'white').save(buffer, 'PNG')
+    return SimpleUploadedFile('doctor.png', buffer.getvalue(), content_type='image/png')
+
+
+def endpoints(f):
+    """
+    (ключ, имя маршрута, метод, args, параметры или тело, пользователь, ожидаемый статус).
+    Тело с файлом задаётся функцией — файл нельзя отправить дважды.
+    Изменяющие запросы выполняются в транзакции с откатом — данные между замерами не меняются.
+    """
+    admin, receptionist, doctor, patient = f['admin'], f['receptionist'], f['doctor'], f['patient']
+    now = timezone.now()
+    window = {'start': (now - timedelta(days=31)).date().isoformat(), 'end': now.date().isoformat()}
+    return [
+        ('login', 'login', 'post', [], {'email': ADMIN_EMAIL, 'password': PASSWORD}, None, 200),
+        ('department_patients', 'department_patients', 'get', [doctor.department_id], {}, admin, 200),
+        ('patient_create', 'patient_create', 'post', [], visit_row(f), receptionist, 201),
+        ('patient_bulk_create', 'patient_bulk_create', 'post', [],
+         [visit_row(f, i) for i in range(100)], receptionist, 201),
+        ('patient_bulk_status', 'patient_bulk_status', 'post', [],
+         {'ids': f['recent_ids'], 'patient_status': 'canceled'}, receptionist, 200),
+        ('patient_search', 'patient_search', 'get', [], {'q': patient.name}, receptionist, 200),
+        ('patient_search:typo', 'patient_search', 'get', [], {'q': typo(patient.name)}, receptionist, 200),
+        ('patient_edit', 'patient_edit', 'get', [patient.id], {}, admin, 200),
+        ('patient_edit:patch', 'patient_edit', 'patch', [patient.id], {'info': 'Benchmark'}, admin, 200),
+        ('patient_history', 'patient_history', 'get', [patient.name], {}, admin, 200),
+        ('patient_history_of_appointments', 'patient_history_of_appointments', 'get',
+         [patient.name], {}, admin, 200),
+        ('patient_history_of_payment', 'patient_history_of_payment', 'get', [patient.name], {}, admin, 200),
+        ('patient_info', 'patient_info', 'get', [patient.id], {}, admin, 200),
+        ('patient_card_history', 'patient_card_history', 'get', [patient.card_id], {}, admin, 200),
+        ('patient_card_history_of_appointments', 'patient_card_history_of_appointments', 'get',
+         [patient.card_id], {}, admin, 200),
+        ('patient_card_history_of_payment', 'patient_card_history_of_payment', 'get',
+         [patient.card_id], {}, admin, 200),
+        ('receptionist_edit', 'receptionist_edit', 'get', [receptionist.id], {}, admin, 200),
+        ('doctor_list', 'doctor_list', 'get', [], {}, admin, 200),
+        ('doctor_edit', 'doctor_edit', 'get', [doctor.id], {}, admin, 200),
+        ('doctor_notification', 'doctor_notification', 'get', [], {}, doctor, 200),
+        ('doctor_create', 'doctor_create', 'post', [], lambda: {
+            'username': 'bench-new-doctor', 'password': PASSWORD, 'email': 'bench-new-doctor@bench.local',
+            'department': doctor.department_id, 'job_title': doctor.job_title_id, 'room': doctor.room_id,
+            'bonus': 10, 'profile_image': profile_image(),
+        }, admin, 201),
+        ('doctor_patients', 'doctor_patients', 'get', [], {}, doctor, 200),
+        ('department_list', 'department_list', 'get', [], {}, admin, 200),
+        ('department_list_services', 'department_list_services', 'get', [], {}, admin, 200),
+        ('report_exact', 'report_exact', 'get', [], {}, admin, 200),
+        ('report_doctor', 'report_doctor', 'get', [], {'doctor': doctor.id}, admin, 200),
+        ('report_summary', 'report_summary', 'get', [], {}, admin, 200),
+        ('report_summary:name', 'report_summary', 'get', [], {'name': patient.name}, admin, 200),
+        ('analysis_regression', 'analysis_regression', 'get', [], {'period': 'monthly'}, admin, 200),
+        ('verify_reset_code', 'verify_reset_code', 'post', [],
+         {'email': ADMIN_EMAIL, 'reset_code': 1234, 'new_password': PASSWORD}, None, 400),
+        ('calendar_list', 'calendar_list', 'get', [], window, admin, 200),
+        ('job_title_list', 'job_title_list', 'get', [], {}, admin, 200),
+        ('room_list', 'room_list', 'get', [], {}, admin, 200),
+        ('calendar_list_async', 'calendar_list_async', 'get', [], window, admin, 200),
+        ('doctor_patients_async', 'doctor_patients_async', 'get', [], {}, doctor, 200),
+        ('patient_history_async', 'patient_history_async', 'get', [patient.name], {}, admin, 200),
+        ('patient_history_of_appointments_async', 'patient_history_of_appointments_async', 'get',
+         [patient.name], {}, admin, 200),
+        ('patient_history_of_payment_async', 'patient_history_of_payment_async', 'get',
+         [patient.name], {}, admin, 200),
+        ('patient_card_history_async', 'patient_card_history_async', 'get', [patient.card_id], {}, admin, 200),
+        ('patient_card_history_of_appointments_async', 'patient_card_history_of_appointments_async', 'get',
+         [patient.card_id], {}, admin, 200),
+        ('patient_card_history_of_payment_async', 'patient_card_history_of_payment_async', 'get',
+         [patient.card_id], {}, admin, 200),
+        ('analysis_regression_async', 'analysis_regression_async', 'get', [], {'period': 'monthly'}, admin, 200),
+    ]
+
+
+def client_for(user, clients):
+    # такой же JWT, как выдаёт login, а не force_authenticate: аутентификация входит в замер
+    if user is None:
+        return APIClient()
+    if user.pk not in clients:
+        client = APIClient()
+        token = add_claims(RefreshToken.for_user(user), user).access_token
+        client.credentials(HTTP_AUTHORIZATION=f'Bearer {token}')
+        clients[user.pk] = client
+    return clients[user.pk]
+
+
+def request(client, method, url, data, expected):
+    """Один запрос: (секунды, число SQL-запросов). Транзакция отката в замер не входит."""
+    if callable(data):
+        data, format = data(), 'multipart'
+    else:
+        format = 'json' if method != 'get' else None
+    with transaction.atomic():
+        with server_timing.measure() as timings:
+            started = time.perf_counter()
+            response = getattr(client, method)(url, data, format=format)
+            duration = time.perf_counter() - started
+        transaction.set_rollback(True)
+    if response.status_code != expected:
+        raise AssertionError(
+            f'{method.upper()} {url}: {response.status_code}, expected {expected}: {response.content[:300]!r}'
+        )
+    return duration, timings.queries
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def invalidate_responses():
+    # только ответы: кэш состояния пользователей (аутентификация) остаётся тёплым, как в работе
+    bump_version(PATIENT_DATA)
+    bump_version(REFERENCE_DATA)
+
+
+def run(iterations=20, warm=False, only=None):
+    """
+    {ключ: {p50_ms, p95_ms, queries, peak_kb}} по всем эндпоинтам.
+    warm=False — кэш ответов очищается перед каждым запросом (замер без кэша).
+    Пиковая память (tracemalloc) — отдельным запросом: трассировка замедляет код.
+    """
+    clients = {}
+    results = {}
+    for key, name, method, args, data, user, expected in endpoints(fixtures()):
+        if only and key not in only:
+            continue
+        client = client_for(user, clients)
+        url = reverse(name, args=args)
+        request(client, method, url, data, expected)  # прогрев
+
+        durations = []
+        for _ in range(iterations):
+            if not warm:
+                invalidate_responses()
+            duration, queries = request(client, method, url, data, expected)
+            durations.append(duration)
+
+        if not warm:
+            invalidate_responses()
+        tracemalloc.start()
+        try:
+            request(client, method, url, data, expected)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+        results[key] = {
+            'p50_ms': round(percentile(durations, 0.5) * 1000, 3),
+            'p95_ms': round(percentile(durations, 0.95) * 1000, 3),
+            'queries': queries,
+            'peak_kb': round(peak / 1024, 1),
+        }
+    return results
+
+
+def compare(baseline, current, threshold=0.2):
+    """
+    Сравнение двух результатов одного масштаба.
+    Возвращает строки (ключ, метрика, было, стало, изменение, регрессия ли).
+    Регрессия — рост p50/p95/памяти больше чем на threshold или любой рост числа запросов.
+    """
+    rows = []
+    for key, values in current.items():
+        before = baseline.get(key)
+        if before is None:
+            continue
+        for metric, value in values.items():
+            old = before.get(metric)
+            if old is None:
+                continue
+            change = (value - old) / old if old else 0.0
+            regression = value > old if metric == 'queries' else change > threshold
+            rows.append((key, metric, old, value, change, regression))
+    return rows
+
+
+def metadata(scale, rows, options):
+    return {
+        'scale': scale,
+        'rows': rows,
+        'iterations': options['iterations'],
+        'warm': options['warm'],
+        'database': connection.vendor,
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'created': datetime.now().isoformat(timespec='seconds'),
+    }
+
+
+@contextmanager
+def scale_database(scale, data_dir, reseed=False):
+    """Отдельная база на каждый масштаб, рабочая база не затрагивается."""
+    old_name = connection.settings_dict['NAME']
+    test_settings = connection.settings_dict.setdefault('TEST', {})
+    old_test_name = test_settings.get('NAME')
+    if connection.vendor == 'sqlite':
+        test_settings['NAME'] = os.path.join(data_dir, f'benchmark_{scale}.sqlite3')
+    else:
+        test_settings['NAME'] = f'{old_name}_benchmark_{scale}'
+    connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False, keepdb=not reseed)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0, keepdb=True)
+        if old_test_name is None:
+            test_settings.pop('NAME', None)
+        else:
+            test_settings['NAME'] = old_test_name
+
+
+# --- нагрузочный тест: синхронные и async-представления под ASGI ---
+
+def load_routes(f, only=None):
+    """(ключ, синхронный маршрут, async-маршрут, args, параметры, заголовок Authorization) по парам из endpoints()."""
+    routes = []
+    for key, name, method, args, data, user, expected in endpoints(f):
+        key = key.removesuffix('_async')
+        if name.endswith('_async') and (not only or key in only):
+            authorization = f'Bearer {add_claims(RefreshToken.for_user(user), user).access_token}'.encode()
+            routes.append((key, name.removesuffix('_async'), name, args, data, authorization))
+    return routes
+
+
+async def asgi_get(url, params, authorization):
+    """GET через mysite.asgi.application в этом же процессе: (статус, тело)."""
+    # не при импорте модуля: mysite.asgi поднимает ASGI-приложение целиком
+    from mysite.asgi import application as asgi_application
+
+    path = str(url)
+    scope = {
+        'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET', 'scheme': 'http',
+        'path': path, 'raw_path': path.encode(), 'query_string': urlencode(params, doseq=True).encode(),
+        'root_path': '', 'headers': [(b'host', b'testserver'), (b'authorization', authorization)],
+        'client': ('127.0.0.1', 0), 'server': ('testserver', 80),
+    }
+    sent = False
+    disconnected = asyncio.Event()
+    status, body = None, []
+
+    async def receive():
+        nonlocal sent
+        if not sent:
+            sent = True
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+        await disconnected.wait()
+        return {'type': 'http.disconnect'}
+
+    async def send(message):
+        nonlocal status
+        if message['type'] == 'http.response.start':
+            status = message['status']
+        elif message['type'] == 'http.response.body':
+            body.append(message.get('body', b''))
+
+    try:
+        await asgi_application(scope, receive, send)
+    finally:
+        disconnected.set()
+    return status, b''.join(body)
+
+
+async def hammer(url, params, authorization, concurrency, requests):
+    """requests запросов, одновременно не больше concurrency."""
+    durations = []
+    errors = 0
+    threads = threading.active_count()
+    remaining = requests
+
+    async def worker():
+        nonlocal errors, threads, remaining
+        while remaining > 0:
+            remaining -= 1
+            started = time.perf_counter()
+            status, _ = await asgi_get(url, params, authorization)
+            durations.append(time.perf_counter() - started)
+            if status != 200:
+                errors += 1
+            threads = max(threads, threading.active_count())
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    return {
+        'rps': round(requests / elapsed, 1),
+        'p50_ms': round(percentile(durations, 0.5) * 1000, 3),
+        'p95_ms': round(percentile(durations, 0.95) * 1000, 3),
+        'errors': errors,
+        'threads': threads,
+    }
+
+
+async def load_test(routes, levels=(1, 8, 32), requests=200, warm=False):
+    """
+    {ключ: {уровень: {'sync': {...}, 'async': {...}}}}: пропускная способность,
+    p50/p95 и пик потоков на каждом уровне одновременных запросов.
+    """
+    results = {}
+    for key, sync_name, async_name, args, params, authorization in routes:
+        results[key] = {}
+        for concurrency in levels:
+            row = results[key][concurrency] = {}
+            for mode, name in (('sync', sync_name), ('async', async_name)):
+                url = reverse(name, args=args)
+                await asgi_get(url, params, authorization)  # прогрев
+                if not warm:
+                    invalidate_responses()
+                row[mode] = await hammer(url, params, authorization, concurrency, requests)
+    return results
@@ -0,0 +1,190 @@
+import hashlib
+import json
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.utils.http import parse_etags
+from django.utils.translation import get_language
+from rest_framework.response import Response
+
+
+# Пространства версий: при изменении данных версия увеличивается,
+# и все ключи, построенные на старой версии, перестают использоваться.
+PATIENT_DATA = 'patient_data'
+# справочники: отделения, должности, кабинеты, услуги
+REFERENCE_DATA = 'reference_data'
+
+
+def get_cache():
+    return caches[getattr(settings, 'REPORT_CACHE_ALIAS', 'default')]
+
+
+def _version_key(namespace):
+    return f'crm_med:version:{namespace}'
+
+
+def get_version(namespace):
+    cache = get_cache()
+    key = _version_key(namespace)
+    version = cache.get(key)
+    if version is None:
+        # после вытеснения ключа нельзя начинать с 1: старые записи могли остаться в кэше
+        cache.add(key, time.time_ns(), timeout=None)
+        version = cache.get(key)
+    return version
+
+
+def bump_version(namespace):
+    cache = get_cache()
+    key = _version_key(namespace)
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.add(key, time.time_ns(), timeout=None)
+
+
+def bump_version_on_commit(namespace):
+    # увеличиваем версию только после коммита, иначе параллельный запрос
+    # успеет закэшировать старые данные под новой версией
+    transaction.on_commit(lambda: bump_version(namespace))
+
+
+def normalize_params(query_params):
+    items = []
+    for key in sorted(query_params):
+        values = sorted(value for value in query_params.getlist(key) if value != '')
+        if values:
+            items.append(f'{key}={",".join(values)}')
+    return '&'.join(items)
+
+
+# --- счётчики попаданий ---
+
+# cache.incr в файловом кэше — чтение и запись без блокировки, параллельные
+# воркеры теряли бы прибавления. Счётчики хранятся в файле метрик
+# (crm_med/metrics.py), который каждый процесс меняет под flock: слот
+# маршрута cache_name, метод GET.
+_stat_names = set()
+
+_STAT_FIELDS = {'hits': 'cache_hits', 'misses': 'cache_misses'}
+
+
+def record(name, kind):
+    # metrics импортирует этот модуль
+    from .metrics import get_store
+
+    get_store().add(name, 'GET', {_STAT_FIELDS[kind]: 1})
+
+
+def cache_stats(snapshot=None):
+    """
+    {'report_summary': {'hits': 10, 'misses': 2}, ...} по всем кэшируемым представлениям,
+    суммарно по всем процессам. snapshot — уже прочитанный MetricsStore.snapshot().
+    """
+    if snapshot is None:
+        from .metrics import get_store
+        snapshot = get_store().snapshot()
+    return {
+        name: {
+            kind: int(snapshot.get((name, 'GET'), {}).get(field, 0))
+            for kind, field in _STAT_FIELDS.items()
+        }
+        for name in sorted(_stat_names)
+    }
+
+
+def data_etag(data):
+    # хэш содержимого, а не версии: изменение других данных того же пространства
+    # меняет версию, но не ETag неизменившегося ответа
+    raw = json.dumps(data, cls=DjangoJSONEncoder, sort_keys=True, ensure_ascii=False)
+    return hashlib.md5(raw.encode()).hexdigest()
+
+
+def etag_matches(request, etag):
+    header = request.META.get('HTTP_IF_NONE_MATCH')
+    if not header:
+        return False
+    # If-None-Match сравнивается слабым сравнением (RFC 9110, 13.1.2)
+    etags = [value.removeprefix('W/') for value in parse_etags(header)]
+    return '*' in etags or etag in etags
+
+
+class CachedResponseMixin:
+    """
+    Кэширует GET-ответ представления.
+
+    Ключ: cache_name + нормализованные параметры запроса + язык + версия данных.
+    Ответ получает строгий ETag по содержимому; запрос с совпадающим
+    If-None-Match получает 304 без тела. Выгрузки в Excel (?export=) не кэшируются.
+    """
+    cache_name = None
+    cache_namespace = PATIENT_DATA
+    cache_timeout = None
+    cache_timeout_setting = 'REPORT_CACHE_TIMEOUT'
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if cls.cache_name:
+            _stat_names.add(cls.cache_name)
+
+    def get_response_cache_key(self, request):
+        raw = '|'.join([
+            normalize_params(request.query_params),
+            getattr(request, 'LANGUAGE_CODE', None) or get_language() or '',
+            str(get_version(self.cache_namespace)),
+        ])
+        return f'crm_med:response:{self.cache_name}:{hashlib.md5(raw.encode()).hexdigest()}'
+
+    def get(self, request, *args, **kwargs):
+        if request.query_params.get('export'):
+            return self.get_uncached(request, *args, **kwargs)
+
+        key = self.get_response_cache_key(request)
+        entry = get_cache().get(key)
+        if entry is not None:
+            record(self.cache_name, 'hits')
+            return self.cached_response(request, entry, 'HIT')
+
+        record(self.cache_name, 'misses')
+        response = self.get_uncached(request, *args, **kwargs)
+        return self.store_response(request, key, response)
+
+    def store_response(self, request, key, response):
+        if response.status_code != 200:
+            response['X-Cache'] = 'MISS'
+            return response
+        entry = {'data': response.data, 'etag': data_etag(response.data)}
+        get_cache().set(key, entry, self.get_cache_timeout())
+        return self.cached_response(request, entry, 'MISS', response)
+
+    def get_cache_timeout(self):
+        return self.cache_timeout or getattr(settings, self.cache_timeout_setting, 300)
+
+    def cached_response(self, request, entry, result, response=None):
+        # JSON и Browsable API — разные представления, у каждого свой ETag
+        etag = f'"{entry["etag"]}-{request.accepted_renderer.format}"'
+        if etag_matches(request, etag):
+            response = Response(status=304)
+        elif response is None:
+            response = Response(entry['data'])
+        response['ETag'] = etag
+        # браузер хранит ответ, но перед использованием сверяет ETag
+        response['Cache-Control'] = 'private, no-cache'
+        response['X-Cache'] = result
+        return response
+
+    def get_uncached(self, request, *args, **kwargs):
+        # представления на APIView, у которых нет родительского get(), переопределяют этот метод
+        return super().get(request, *args, **kwargs)
+
+
+class ReferenceDataMixin(CachedResponseMixin):
+    """
+    Справочники почти не меняются: ответ хранится до изменения Department,
+    JobTitle, Room или ServiceType (signals.py), срок — REFERENCE_CACHE_TIMEOUT.
+    """
+    cache_namespace = REFERENCE_DATA
+    cache_timeout_setting = 'REFERENCE_CACHE_TIMEOUT'
@@ -0,0 +1,125 @@
+import hashlib
+
+from django.db.models import F, Q
+from django.utils.translation import get_language
+from rest_framework.response import Response
+
+from .cache import etag_matches, get_version, normalize_params, REFERENCE_DATA
+from .models import ChangeCounter
+
+
+# Счётчики изменений для условных GET: запись визита увеличивает счётчики
+# его доктора и отделения, в той же транзакции, что и сама запись.
+# ETag ленты строится из счётчиков, поэтому If-None-Match отвечает 304
+# без запроса списка и сериализации.
+
+# все визиты: отдельного счётчика нет — одна строка, которую обновляет каждая
+# запись визита, сериализовала бы все записи. Значение — сумма счётчиков
+# отделений: каждая запись увеличивает счётчик своего отделения, сумма растёт.
+ALL_SCOPE = 'all'
+DEPARTMENT_PREFIX = 'department:'
+# доктора и регистраторы: их имена и отделения видны во всех лентах
+PROFILES_SCOPE = 'profiles'
+
+
+def doctor_scope(doctor_id):
+    return f'doctor:{doctor_id}'
+
+
+def department_scope(department_id):
+    return f'{DEPARTMENT_PREFIX}{department_id}'
+
+
+def patient_scopes(patients):
+    scopes = set()
+    for patient in patients:
+        scopes.add(doctor_scope(patient.doctor_id))
+        scopes.add(department_scope(patient.department_id))
+    return scopes
+
+
+def bump(scopes):
+    """Увеличивает счётчики; обычно одним UPDATE, недостающие создаются."""
+    scopes = set(scopes)
+    if not scopes:
+        return
+    counters = ChangeCounter.objects.filter(scope__in=scopes)
+    if counters.update(value=F('value') + 1) == len(scopes):
+        return
+    # новые области: создаём с нулём и увеличиваем ещё раз — существующие
+    # счётчики вырастут на 2, для ETag важно лишь, что значение изменилось
+    ChangeCounter.objects.bulk_create([ChangeCounter(scope=scope) for scope in scopes], ignore_conflicts=True)
+    counters.update(value=F('value') + 1)
+
+
+def bump_existing():
+    # после записи в обход сигналов (crm_med/seeding.py): затронута может быть любая область
+    ChangeCounter.objects.update(value=F('value') + 1)
+
+
+def counters_query(scopes):
+    query = Q(scope__in=scopes)
+    if ALL_SCOPE in scopes:
+        query |= Q(scope__startswith=DEPARTMENT_PREFIX)
+    return ChangeCounter.objects.filter(query).values_list('scope', 'value')
+
+
+def format_counters(scopes, rows):
+    values = dict(rows)
+    values[ALL_SCOPE] = sum(value for scope, value in values.items() if scope.startswith(DEPARTMENT_PREFIX))
+    return ','.join(f'{scope}:{values.get(scope, 0)}' for scope in scopes)
+
+
+def current(scopes):
+    """'scope:value,...' для областей одним запросом; несозданный счётчик равен 0."""
+    return format_counters(scopes, counters_query(scopes))
+
+
+async def acurrent(scopes):
+    return format_counters(scopes, [row async for row in counters_query(scopes)])
+
+
+class ChangeCounterETagMixin:
+    """
+    Условный GET для списков визитов.
+
+    ETag: счётчики области get_change_scope() и профилей + параметры
+    запроса + язык + версия справочников + формат ответа. Совпавший
+    If-None-Match — 304 после одного запроса к счётчикам. Счётчики читаются
+    до списка: запись между ними даст более свежий ответ со старым ETag,
+    и следующий запрос просто получит 200.
+    """
+
+    def get_change_scope(self, request):
+        raise NotImplementedError
+
+    def get_change_scopes(self, request):
+        return [self.get_change_scope(request), PROFILES_SCOPE]
+
+    def get_etag(self, request):
+        return self.etag_from(request, current(self.get_change_scopes(request)))
+
+    def etag_from(self, request, counters):
+        raw = '|'.join([
+            counters,
+            normalize_params(request.query_params),
+            getattr(request, 'LANGUAGE_CODE', None) or get_language() or '',
+            str(get_version(REFERENCE_DATA)),
+            request.accepted_renderer.format,
+        ])
+        return f'"{hashlib.md5(raw.encode()).hexdigest()}"'
+
+    def get(self, request, *args, **kwargs):
+        etag = self.get_etag(request)
+        if etag_matches(request, etag):
+            response = Response(status=304)
+        else:
+            response = super().get(request, *args, **kwargs)
+            if response.status_code != 200:
+                return response
+        return self.with_etag(response, etag)
+
+    def with_etag(self, response, etag):
+        response['ETag'] = etag
+        response['Cache-Control'] = 'private, no-cache'
+        return response
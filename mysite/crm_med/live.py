@@ -0,0 +1,340 @@
+import asyncio
+import fcntl
+import json
+import os
+import re
+import threading
+import time
+from types import SimpleNamespace
+from contextlib import asynccontextmanager
+from urllib.parse import parse_qs
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.utils import timezone, translation
+from django.utils.dateparse import parse_datetime
+from django.utils.module_loading import import_string
+from rest_framework.exceptions import AuthenticationFailed, ValidationError
+from rest_framework_simplejwt.exceptions import InvalidToken
+
+from .authentication import user_from_token
+from .models import Department, Patient
+from .reports import calendar_window
+
+
+# Живой календарь: изменения визитов рассылаются по WebSocket подписчикам
+# канала отделения (ws/calendar/<department_id>/) в формате CalendarReport.
+# Рассылка идёт через брокер (LIVE_BROKER): InProcessBroker — в пределах
+# одного процесса, FileBroker — общий файл для нескольких процессов.
+
+CREATED = 'created'
+UPDATED = 'updated'
+DELETED = 'deleted'
+
+# подписчик не успевает читать — соединение закрывается, клиент перечитывает календарь
+OVERFLOW = object()
+
+
+def channel(department_id):
+    return f'calendar.{department_id}'
+
+
+class InProcessBroker:
+    """Очереди подписчиков в памяти процесса; publish можно вызывать из любого потока."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscribers = {}
+
+    def wants(self, channel_name):
+        return bool(self.subscribers.get(channel_name))
+
+    def publish(self, channel_name, message):
+        with self.lock:
+            queues = list(self.subscribers.get(channel_name, ()))
+        for loop, queue in queues:
+            loop.call_soon_threadsafe(_put, queue, message)
+
+    @asynccontextmanager
+    async def subscribe(self, channel_name):
+        # лишнее место в очереди — для OVERFLOW
+        entry = (asyncio.get_running_loop(), asyncio.Queue(getattr(settings, 'LIVE_QUEUE_SIZE', 1000) + 1))
+        with self.lock:
+            self.subscribers.setdefault(channel_name, set()).add(entry)
+        try:
+            yield entry[1]
+        finally:
+            with self.lock:
+                self.subscribers[channel_name].discard(entry)
+
+
+def _put(queue, message):
+    if queue.full():
+        return
+    queue.put_nowait(OVERFLOW if queue.qsize() == queue.maxsize - 1 else message)
+
+
+class FileBroker:
+    """
+    Канал — файл JSON-строк в LIVE_BROKER_DIR: издатель дописывает строку под
+    flock, подписчик читает хвост файла раз в LIVE_BROKER_POLL_INTERVAL секунд.
+    Файл больше LIVE_BROKER_MAX_BYTES обнуляется; подписчик, не успевший
+    дочитать его, получает OVERFLOW. Подписчики обновляют время изменения
+    файла <канал>.subscribers раз в LIVE_BROKER_HEARTBEAT секунд: канал без
+    свежей отметки никто не слушает, и издатель не готовит для него сообщения.
+    """
+
+    def __init__(self):
+        self.directory = settings.LIVE_BROKER_DIR
+        os.makedirs(self.directory, exist_ok=True)
+
+    def path(self, channel_name):
+        return os.path.join(self.directory, f'{channel_name}.jsonl')
+
+    def heartbeat_path(self, channel_name):
+        return os.path.join(self.directory, f'{channel_name}.subscribers')
+
+    def heartbeat(self, channel_name):
+        with open(self.heartbeat_path(channel_name), 'a'):
+            os.utime(self.heartbeat_path(channel_name))
+
+    def wants(self, channel_name):
+        try:
+            mtime = os.path.getmtime(self.heartbeat_path(channel_name))
+        except FileNotFoundError:
+            return False
+        # запас на пропущенный такт подписчика
+        return time.time() - mtime < 2 * getattr(settings, 'LIVE_BROKER_HEARTBEAT', 5)
+
+    def publish(self, channel_name, message):
+        line = (json.dumps(message, cls=DjangoJSONEncoder, ensure_ascii=False) + '\n').encode()
+        fd = os.open(self.path(channel_name), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            if os.fstat(fd).st_size > getattr(settings, 'LIVE_BROKER_MAX_BYTES', 10_000_000):
+                os.ftruncate(fd, 0)
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+
+    @asynccontextmanager
+    async def subscribe(self, channel_name):
+        queue = asyncio.Queue()
+        # отметка до возврата: изменения сразу после подписки уже публикуются
+        self.heartbeat(channel_name)
+        task = asyncio.ensure_future(self.follow(channel_name, queue))
+        try:
+            yield queue
+        finally:
+            task.cancel()
+
+    async def follow(self, channel_name, queue):
+        interval = getattr(settings, 'LIVE_BROKER_POLL_INTERVAL', 0.2)
+        heartbeat = getattr(settings, 'LIVE_BROKER_HEARTBEAT', 5)
+        path = self.path(channel_name)
+        offset = os.path.getsize(path) if os.path.exists(path) else 0
+        buffer = b''
+        last_beat = time.monotonic()
+        while True:
+            await asyncio.sleep(interval)
+            if time.monotonic() - last_beat >= heartbeat:
+                self.heartbeat(channel_name)
+                last_beat = time.monotonic()
+            try:
+                size = os.path.getsize(path)
+            except FileNotFoundError:
+                continue
+            if size < offset:
+                await queue.put(OVERFLOW)
+                offset, buffer = 0, b''
+            if size == offset:
+                continue
+            with open(path, 'rb') as file:
+                file.seek(offset)
+                chunk = file.read(size - offset)
+            offset += len(chunk)
+            *lines, buffer = (buffer + chunk).split(b'\n')
+            for line in lines:
+                await queue.put(json.loads(line))
+
+
+_brokers = {}
+
+
+def get_broker():
+    path = getattr(settings, 'LIVE_BROKER', 'crm_med.live.InProcessBroker')
+    broker = _brokers.get(path)
+    if broker is None:
+        broker = _brokers[path] = import_string(path)()
+    return broker
+
+
+# --- издатель: сигналы Patient ---
+
+def queue_changes(changes):
+    """
+    changes — [(kind, patient_id, department_id, appointment_date, previous_date)].
+    Рассылаются после коммита: подписчики не должны увидеть откатившиеся изменения.
+    """
+    if changes:
+        transaction.on_commit(lambda: publish_changes(changes))
+
+
+def publish_changes(changes):
+    from .serializers import CalendarReport
+
+    broker = get_broker()
+    changes = [change for change in changes if broker.wants(channel(change[2]))]
+    live_ids = [patient_id for kind, patient_id, *_ in changes if kind != DELETED]
+    patients = Patient.objects.select_related('doctor__job_title', 'department').in_bulk(live_ids) if live_ids else {}
+    for kind, patient_id, department_id, appointment_date, previous_date in changes:
+        payload = None
+        if kind != DELETED:
+            patient = patients.get(patient_id)
+            if patient is None:
+                continue
+            # названия отделений и должностей переводятся: готовим ответ на каждом языке
+            payload = {}
+            for language, _ in settings.LANGUAGES:
+                with translation.override(language):
+                    payload[language] = CalendarReport(patient).data
+        broker.publish(channel(department_id), {
+            'type': kind,
+            'id': patient_id,
+            'appointment_date': _isoformat(appointment_date),
+            'previous_appointment_date': _isoformat(previous_date),
+            'patient': payload,
+        })
+
+
+def _isoformat(value):
+    # у несохранённого из формы визита дата может остаться строкой
+    return value.isoformat() if hasattr(value, 'isoformat') else value
+
+
+def patient_changes(patient, previous):
+    """Изменения визита для рассылки: перенос в другое отделение — удаление и создание."""
+    if previous is None:
+        return [(CREATED, patient.pk, patient.department_id, patient.appointment_date, None)]
+    if previous.department_id != patient.department_id:
+        return [
+            (DELETED, patient.pk, previous.department_id, previous.appointment_date, None),
+            (CREATED, patient.pk, patient.department_id, patient.appointment_date, None),
+        ]
+    return [(UPDATED, patient.pk, patient.department_id, patient.appointment_date, previous.appointment_date)]
+
+
+# --- подписчик: WebSocket ---
+
+CALENDAR_PATH = re.compile(r'^/ws/calendar/(?P<department_id>\d+)/$')
+
+CLOSE_UNAUTHORIZED = 4401
+CLOSE_FORBIDDEN = 4403
+CLOSE_BAD_REQUEST = 4400
+CLOSE_NOT_FOUND = 4404
+CLOSE_OVERFLOW = 4408
+
+
+def in_window(message, start, end):
+    # изменение видно, если визит был или стал в окне клиента
+    for value in (message['appointment_date'], message['previous_appointment_date']):
+        # дата из формы может быть без часового пояса или не разобраться вовсе
+        try:
+            moment = parse_datetime(value)
+        except (TypeError, ValueError):
+            continue
+        if moment is None:
+            continue
+        if timezone.is_naive(moment):
+            moment = timezone.make_aware(moment)
+        if start <= moment < end:
+            return True
+    return False
+
+
+def has_permission(user):
+    """Права CalendarListAPIView: подписчик видит то же, что и список календаря."""
+    # views импортирует signals, а signals — этот модуль
+    from .views import CalendarListAPIView
+
+    request = SimpleNamespace(user=user)
+    return all(
+        permission().has_permission(request, None) for permission in CalendarListAPIView.permission_classes
+    )
+
+
+async def websocket_application(scope, receive, send):
+    """
+    ASGI-приложение для scope['type'] == 'websocket' (mysite/asgi.py).
+
+    ws/calendar/<department_id>/?access_token=...&start=...&end=...&lang=ru
+    Клиент получает {"type": "created" | "updated" | "deleted", "id", "patient"}
+    для визитов отделения в своём окне; окно меняется сообщением
+    {"start": ..., "end": ...}. Права — как у calendar_list (4403), отделение
+    должно существовать (4404). Закрытие с кодом 4408 — клиент отстал,
+    календарь нужно перечитать через calendar_list.
+    """
+    match = CALENDAR_PATH.match(scope['path'])
+    message = await receive()
+    if message['type'] != 'websocket.connect':
+        return
+    if match is None:
+        await send({'type': 'websocket.close', 'code': CLOSE_NOT_FOUND})
+        return
+
+    params = {key: values[-1] for key, values in parse_qs(scope['query_string'].decode()).items()}
+    try:
+        user = await sync_to_async(user_from_token)(params.get('access_token', ''))
+    except (AuthenticationFailed, InvalidToken):
+        await send({'type': 'websocket.close', 'code': CLOSE_UNAUTHORIZED})
+        return
+    if not has_permission(user):
+        await send({'type': 'websocket.close', 'code': CLOSE_FORBIDDEN})
+        return
+    department_id = int(match['department_id'])
+    if not await Department.objects.filter(pk=department_id).aexists():
+        await send({'type': 'websocket.close', 'code': CLOSE_NOT_FOUND})
+        return
+    try:
+        start, end = calendar_window(params.get('start'), params.get('end'))
+    except ValidationError:
+        await send({'type': 'websocket.close', 'code': CLOSE_BAD_REQUEST})
+        return
+    languages = {language for language, _ in settings.LANGUAGES}
+    language = params.get('lang') if params.get('lang') in languages else settings.LANGUAGE_CODE
+
+    await send({'type': 'websocket.accept'})
+    async with get_broker().subscribe(channel(department_id)) as queue:
+        client = asyncio.ensure_future(receive())
+        delta = asyncio.ensure_future(queue.get())
+        try:
+            while True:
+                done, _ = await asyncio.wait({client, delta}, return_when=asyncio.FIRST_COMPLETED)
+                if client in done:
+                    message = client.result()
+                    if message['type'] == 'websocket.disconnect':
+                        break
+                    try:
+                        window = json.loads(message.get('text') or '{}')
+                        start, end = calendar_window(window.get('start'), window.get('end'))
+                    except (ValueError, AttributeError, ValidationError) as exc:
+                        detail = exc.detail if isinstance(exc, ValidationError) else "Expected JSON {start, end}"
+                        await send({'type': 'websocket.send', 'text': json.dumps({'type': 'error', 'detail': detail})})
+                    client = asyncio.ensure_future(receive())
+                if delta in done:
+                    message = delta.result()
+                    if message is OVERFLOW:
+                        await send({'type': 'websocket.close', 'code': CLOSE_OVERFLOW})
+                        break
+                    if in_window(message, start, end):
+                        await send({'type': 'websocket.send', 'text': json.dumps({
+                            'type': message['type'],
+                            'id': message['id'],
+                            'patient': message['patient'] and message['patient'][language],
+                        }, ensure_ascii=False)})
+                    delta = asyncio.ensure_future(queue.get())
+        finally:
+            client.cancel()
+            delta.cancel()
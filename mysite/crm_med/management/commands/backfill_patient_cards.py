@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from crm_med.models import Patient, PatientCard, normalize_name
+
+
+class Command(BaseCommand):
+    help = "Привязывает существующие визиты (Patient) к карточкам пациентов пачками"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        last_id = 0
+        linked = 0
+        while True:
+            batch = list(
+                Patient.objects.filter(card__isnull=True, id__gt=last_id)
+                .order_by('id')
+                .only('id', 'name', 'phone')[:batch_size]
+            )
+            if not batch:
+                break
+            last_id = batch[-1].id
+
+            with transaction.atomic():
+                cards = PatientCard.objects.for_visits((patient.name, patient.phone) for patient in batch)
+                for patient in batch:
+                    patient.card = cards[(normalize_name(patient.name), str(patient.phone))]
+                Patient.objects.bulk_update(batch, ['card'])
+
+            linked += len(batch)
+            self.stdout.write(f"Linked {linked} visits")
+
+        self.stdout.write(self.style.SUCCESS(f"Done: {linked} visits linked"))
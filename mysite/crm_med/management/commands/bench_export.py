@@ -0,0 +1,107 @@
+import io
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+from contextlib import nullcontext
+from unittest import mock
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.http import HttpResponse
+from django.test.utils import setup_test_environment, teardown_test_environment
+from django.urls import reverse
+from openpyxl import Workbook
+from rest_framework.test import APIClient
+
+from crm_med import benchmark, seeding
+from crm_med.exports import XLSX_CONTENT_TYPE
+from crm_med.models import Admin
+
+
+class InMemoryExport:
+    """Старый вариант: обычная книга openpyxl целиком в памяти, тот же интерфейс, что у XlsxExport."""
+
+    def __init__(self, title, headers, widths=None):
+        self.workbook = Workbook()
+        self.sheet = self.workbook.active
+        self.sheet.title = title
+        self.sheet.append(headers)
+
+    def append(self, row):
+        self.sheet.append(row)
+
+    def response(self, filename):
+        buffer = io.BytesIO()
+        self.workbook.save(buffer)
+        return HttpResponse(buffer.getvalue(), content_type=XLSX_CONTENT_TYPE)
+
+
+def measure(mode, queue):
+    """Выгрузка ReportExactAPIView (?export=excel) по всем визитам базы — в отдельном процессе."""
+    connections.close_all()
+    client = APIClient()
+    client.force_authenticate(Admin.objects.get(email=seeding.ADMIN_EMAIL))
+    # ru_maxrss в Linux — килобайты
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    started = time.perf_counter()
+    with mock.patch('crm_med.views.XlsxExport', InMemoryExport) if mode == 'in-memory' else nullcontext():
+        response = client.get(reverse('report_exact'), {'export': 'excel'})
+        content = response.streaming_content if response.streaming else [response.content]
+        size = sum(len(chunk) for chunk in content)
+        response.close()
+    queue.put({
+        'status': response.status_code,
+        'seconds': time.perf_counter() - started,
+        'size': size,
+        'base_rss_mb': before,
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    })
+
+
+class Command(BaseCommand):
+    help = (
+        "Время и пиковое потребление памяти (RSS) выгрузки отчёта в Excel "
+        "(report_exact?export=excel) на синтетических данных разного объёма"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, nargs='+', default=[10_000, 500_000])
+        parser.add_argument('--in-memory', action='store_true',
+                            help="Дополнительно замерить старую выгрузку через обычный Workbook")
+        parser.add_argument('--data-dir', default=os.path.join(tempfile.gettempdir(), 'crm_med_benchmark'),
+                            help="Каталог баз SQLite с данными (переиспользуются между запусками)")
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                            help="Процессов для генерации данных")
+
+    def handle(self, *args, **options):
+        os.makedirs(options['data_dir'], exist_ok=True)
+        modes = ['streaming'] + (['in-memory'] if options['in_memory'] else [])
+        # каждый замер в отдельном процессе: ru_maxrss не сбрасывается внутри процесса
+        context = multiprocessing.get_context('fork')
+        setup_test_environment()
+        try:
+            for rows in options['rows']:
+                with benchmark.scale_database(f'export_{rows}', options['data_dir']):
+                    if not benchmark.is_seeded(rows):
+                        self.stdout.write(f"seeding {rows} visits...")
+                        call_command('flush', interactive=False, verbosity=0)
+                        seeding.seed(rows, workers=options['workers'])
+                    # дочерний процесс открывает своё соединение
+                    connections.close_all()
+                    for mode in modes:
+                        queue = context.Queue()
+                        process = context.Process(target=measure, args=(mode, queue))
+                        process.start()
+                        result = queue.get()
+                        process.join()
+                        self.stdout.write(
+                            f"{mode:>10} {rows:>9} rows: peak RSS {result['peak_rss_mb']:8.1f} MB "
+                            f"(+{result['peak_rss_mb'] - result['base_rss_mb']:.1f} MB), "
+                            f"{result['seconds']:6.1f} s, {result['size'] / 1024 / 1024:6.1f} MB file, "
+                            f"HTTP {result['status']}"
+                        )
+        finally:
+            teardown_test_environment()
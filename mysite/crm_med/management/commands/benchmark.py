@@ -0,0 +1,104 @@
+import json
+import logging
+import os
+import tempfile
+import time
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings, setup_test_environment, teardown_test_environment
+
+from crm_med import benchmark, seeding
+
+
+class Command(BaseCommand):
+    help = (
+        "Замеры всех эндпоинтов crm_med на синтетических данных (10k / 100k / 1M визитов): "
+        "p50/p95, число SQL-запросов, пиковая память. Результат — JSON, "
+        "--baseline сравнивает его с сохранённым"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scales', nargs='+', choices=list(benchmark.SCALES), default=list(benchmark.SCALES))
+        parser.add_argument('--iterations', type=int, default=20)
+        parser.add_argument('--warm', action='store_true',
+                            help="Не очищать кэш ответов перед запросами")
+        parser.add_argument('--only', nargs='+', metavar='KEY', help="Замерить только эти эндпоинты")
+        parser.add_argument('--output', default='benchmark.json')
+        parser.add_argument('--baseline', help="JSON предыдущего запуска для сравнения")
+        parser.add_argument('--threshold', type=float, default=0.2,
+                            help="Допустимый рост p50/p95/памяти, доля (0.2 = 20%%)")
+        parser.add_argument('--data-dir', default=os.path.join(tempfile.gettempdir(), 'crm_med_benchmark'),
+                            help="Каталог баз SQLite с данными (переиспользуются между запусками)")
+        parser.add_argument('--reseed', action='store_true', help="Заново создать данные")
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                            help="Процессов для генерации данных")
+
+    def handle(self, *args, **options):
+        os.makedirs(options['data_dir'], exist_ok=True)
+        report = {}
+        setup_test_environment()
+        # ожидаемые 400 (verify_reset_code) не пишем в лог на каждой итерации
+        request_logger = logging.getLogger('django.request')
+        level = request_logger.level
+        request_logger.setLevel(logging.ERROR)
+        # изображения врачей из doctor_create — во временный каталог, не в media/
+        try:
+            with tempfile.TemporaryDirectory() as media_root, override_settings(MEDIA_ROOT=media_root):
+                for scale in options['scales']:
+                    report[scale] = self.run_scale(scale, options)
+        finally:
+            request_logger.setLevel(level)
+            teardown_test_environment()
+
+        with open(options['output'], 'w') as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+        self.stdout.write(self.style.SUCCESS(f"Results written to {options['output']}"))
+
+        if options['baseline']:
+            self.compare(options['baseline'], report, options['threshold'])
+
+    def run_scale(self, scale, options):
+        rows = benchmark.SCALES[scale]
+        with benchmark.scale_database(scale, options['data_dir'], options['reseed']):
+            if not benchmark.is_seeded(rows):
+                self.stdout.write(f"[{scale}] seeding {rows} visits...")
+                started = time.perf_counter()
+                # остатки прерванного заполнения
+                call_command('flush', interactive=False, verbosity=0)
+                seeding.seed(rows, workers=options['workers'])
+                self.stdout.write(f"[{scale}] seeded in {time.perf_counter() - started:.1f} s")
+
+            self.stdout.write(f"[{scale}] {'endpoint':<40} {'p50 ms':>9} {'p95 ms':>9} {'queries':>8} {'peak KB':>10}")
+            results = benchmark.run(options['iterations'], warm=options['warm'], only=options['only'])
+            for key, values in results.items():
+                self.stdout.write(
+                    f"[{scale}] {key:<40} {values['p50_ms']:>9.2f} {values['p95_ms']:>9.2f} "
+                    f"{values['queries']:>8} {values['peak_kb']:>10.1f}"
+                )
+            return {'meta': benchmark.metadata(scale, rows, options), 'results': results}
+
+    def compare(self, path, report, threshold):
+        with open(path) as baseline_file:
+            baseline = json.load(baseline_file)
+
+        regressions = 0
+        for scale, current in report.items():
+            if scale not in baseline:
+                self.stdout.write(f"[{scale}] no baseline")
+                continue
+            for key, metric, old, new, change, regression in benchmark.compare(
+                baseline[scale]['results'], current['results'], threshold,
+            ):
+                if not regression and abs(change) <= threshold:
+                    continue
+                line = f"[{scale}] {key:<40} {metric:<8} {old:>10} -> {new:>10} ({change:+.0%})"
+                if regression:
+                    regressions += 1
+                    self.stdout.write(self.style.ERROR(line))
+                else:
+                    self.stdout.write(self.style.SUCCESS(line))
+
+        if regressions:
+            raise CommandError(f"{regressions} regressions against {path}")
+        self.stdout.write(self.style.SUCCESS(f"No regressions against {path}"))
@@ -0,0 +1,59 @@
+import json
+import os
+import tempfile
+
+from asgiref.sync import async_to_sync
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+from crm_med import benchmark
+
+
+class Command(BaseCommand):
+    help = (
+        "Нагрузочный тест под ASGI: синхронные представления и их async-версии "
+        "(crm_med/async_views.py) на одних данных при разном числе одновременных запросов. "
+        "Данные — база команды benchmark того же масштаба"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scale', choices=list(benchmark.SCALES), default='10k')
+        parser.add_argument('--concurrency', nargs='+', type=int, default=[1, 8, 32],
+                            help="Уровни одновременных запросов")
+        parser.add_argument('--requests', type=int, default=200, help="Запросов на каждый уровень")
+        parser.add_argument('--warm', action='store_true', help="Не очищать кэш ответов перед уровнем")
+        parser.add_argument('--only', nargs='+', metavar='KEY', help="Только эти эндпоинты")
+        parser.add_argument('--output', default='loadtest.json')
+        parser.add_argument('--data-dir', default=os.path.join(tempfile.gettempdir(), 'crm_med_benchmark'),
+                            help="Каталог баз SQLite команды benchmark")
+
+    def handle(self, *args, **options):
+        scale = options['scale']
+        setup_test_environment()
+        try:
+            with benchmark.scale_database(scale, options['data_dir']):
+                if not benchmark.is_seeded(benchmark.SCALES[scale]):
+                    raise CommandError(f"No {scale} data in {options['data_dir']}: run `benchmark --scales {scale}` first")
+                routes = benchmark.load_routes(benchmark.fixtures(), options['only'])
+                # синхронный код представлений и async ORM выполняется в одном потоке, как под ASGI-сервером
+                results = async_to_sync(benchmark.load_test)(
+                    routes, options['concurrency'], options['requests'], options['warm'],
+                )
+        finally:
+            teardown_test_environment()
+
+        self.stdout.write(
+            f"{'endpoint':<40} {'conc':>5} {'mode':>6} {'rps':>8} {'p50 ms':>9} {'p95 ms':>9} "
+            f"{'errors':>7} {'threads':>8}"
+        )
+        for key, levels in results.items():
+            for concurrency, modes in levels.items():
+                for mode, values in modes.items():
+                    self.stdout.write(
+                        f"{key:<40} {concurrency:>5} {mode:>6} {values['rps']:>8.1f} {values['p50_ms']:>9.2f} "
+                        f"{values['p95_ms']:>9.2f} {values['errors']:>7} {values['threads']:>8}"
+                    )
+
+        with open(options['output'], 'w') as output:
+            json.dump({scale: results}, output, indent=2, sort_keys=True)
+        self.stdout.write(self.style.SUCCESS(f"Results written to {options['output']}"))
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from crm_med import search
+
+
+class Command(BaseCommand):
+    help = "Пересобирает полнотекстовый индекс визитов (SQLite FTS5)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default='default')
+        parser.add_argument('--optimize', action='store_true',
+                            help="После пересборки слить сегменты индекса в один")
+
+    def handle(self, *args, **options):
+        connection = connections[options['database']]
+        if not search.is_supported(connection):
+            raise CommandError("Full-text search index is only available on SQLite")
+
+        search.install(connection, rebuild=True)
+        if options['optimize']:
+            search.optimize(connection)
+        self.stdout.write(self.style.SUCCESS("Patient search index rebuilt"))
@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from crm_med.models import DailyRevenueRollup
+from crm_med.rollup import rebuild_rollup
+
+
+class Command(BaseCommand):
+    help = "Пересобирает сводную таблицу выручки DailyRevenueRollup из Patient"
+
+    def handle(self, *args, **options):
+        rebuild_rollup()
+        self.stdout.write(f"Rollup rebuilt: {DailyRevenueRollup.objects.count()} rows")
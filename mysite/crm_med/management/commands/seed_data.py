@@ -0,0 +1,52 @@
+import os
+import time
+
+from django.core.management.base import BaseCommand
+
+from crm_med import seeding
+
+
+class Command(BaseCommand):
+    help = "Заполняет базу синтетическими данными: справочники, врачи, регистраторы и визиты пациентов"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--patients', type=int, default=200, help="Количество визитов")
+        parser.add_argument('--doctors', type=int, default=30)
+        parser.add_argument('--receptionists', type=int, default=10)
+        parser.add_argument('--departments', type=int, default=10)
+        parser.add_argument('--job-titles', type=int, default=6)
+        parser.add_argument('--rooms', type=int, default=20)
+        parser.add_argument('--services', type=int, default=5, help="Услуг на отделение")
+        parser.add_argument('--days', type=int, default=365, help="Визиты за сколько дней до сегодня")
+        parser.add_argument('--future-days', type=int, default=14, help="Предварительная запись вперёд")
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                            help="Процессов для генерации визитов")
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--password', default=seeding.PASSWORD, help="Пароль всех пользователей")
+        parser.add_argument('--keep', action='store_true', help="Не удалять существующие данные")
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        if not options['keep']:
+            self.stdout.write("Clearing old data...")
+            seeding.clear()
+
+        seeding.seed(
+            options['patients'],
+            doctors=options['doctors'],
+            receptionists=options['receptionists'],
+            departments=options['departments'],
+            job_titles=options['job_titles'],
+            rooms=options['rooms'],
+            services=options['services'],
+            days=options['days'],
+            future_days=options['future_days'],
+            workers=options['workers'],
+            seed=options['seed'],
+            password=options['password'],
+            stdout=self.stdout,
+        )
+        self.stdout.write(self.style.SUCCESS(
+            f"Seeded {options['patients']} visits in {time.perf_counter() - started:.1f} s, "
+            f"admin: {seeding.ADMIN_EMAIL} / {options['password']}"
+        ))
@@ -0,0 +1,36 @@
+import signal
+import threading
+
+from django.core.management.base import BaseCommand
+
+from crm_med import outbox
+
+
+class Command(BaseCommand):
+    help = (
+        "Отправляет письма из очереди OutboxMessage пачками с повторами. "
+        "Без --once работает до SIGTERM/SIGINT (для OUTBOX_WORKER = 'command')"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help="Отправить то, что пора, и выйти")
+        parser.add_argument('--batch-size', type=int, help="Писем за одно SMTP-соединение")
+        parser.add_argument('--interval', type=float, help="Секунд между проверками очереди")
+
+    def handle(self, *args, **options):
+        if options['once']:
+            result = outbox.deliver(options['batch_size'])
+            self.stdout.write(f"Sent {result['sent']}, retry scheduled {result['retried']}, failed {result['failed']}")
+            return
+
+        stop, wakeup = threading.Event(), threading.Event()
+
+        def shutdown(*args):
+            stop.set()
+            wakeup.set()
+
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, shutdown)
+        self.stdout.write("Outbox worker started")
+        outbox.run(stop, wakeup, batch_size=options['batch_size'], poll_interval=options['interval'])
+        self.stdout.write("Outbox worker stopped")
@@ -0,0 +1,216 @@
+import bisect
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import threading
+
+from django.conf import settings
+
+
+# Метрики запросов по маршрутам crm_med/urls.py в формате Prometheus.
+#
+# Значения лежат в общем файле, отображённом в память (mmap): каждый воркер
+# gunicorn прибавляет свои значения под flock, /metrics в любом воркере
+# читает сумму по всем процессам. Внешних сервисов не нужно.
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (1, 2, 5, 10, 20, 50, 100)
+SIZE_BUCKETS = (1_000, 10_000, 100_000, 1_000_000, 10_000_000)
+
+METHODS = ('GET', 'POST', 'PUT', 'PATCH', 'DELETE', 'OTHER')
+
+# маршрут, не найденный в crm_med/urls.py (админка, документация, 404)
+OTHER_ROUTE = 'other'
+
+# поля одного слота (маршрут + метод), все — float64;
+# cache_hits / cache_misses — кэш ответов представления (crm_med/cache.py)
+FIELDS = (
+    ['requests', 'client_errors', 'server_errors', 'duration_sum', 'queries_sum', 'size_sum',
+     'cache_hits', 'cache_misses']
+    + [f'duration_{i}' for i in range(len(DURATION_BUCKETS))]
+    + [f'queries_{i}' for i in range(len(QUERY_BUCKETS))]
+    + [f'size_{i}' for i in range(len(SIZE_BUCKETS))]
+)
+FIELD_INDEX = {name: i for i, name in enumerate(FIELDS)}
+VALUE = struct.Struct('<d')
+MAGIC = b'CRMMETR1'
+HEADER_SIZE = 32
+
+
+class MetricsStore:
+    def __init__(self, path, routes):
+        self.path = path
+        self.routes = sorted(set(routes)) + [OTHER_ROUTE]
+        self.route_index = {route: i for i, route in enumerate(self.routes)}
+        self.slot_size = len(FIELDS) * VALUE.size
+        self.size = HEADER_SIZE + len(self.routes) * len(METHODS) * self.slot_size
+        # при другом наборе маршрутов или полей файл размечается заново
+        layout = '|'.join(self.routes + list(METHODS) + FIELDS)
+        self.header = MAGIC + hashlib.md5(layout.encode()).digest()
+        self.lock = threading.Lock()
+        self.pid = None
+        self.fd = None
+        self.map = None
+
+    def _open(self):
+        # после fork воркера у процесса должен быть свой дескриптор: flock работает по дескрипторам
+        if self.pid == os.getpid():
+            return
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(fd).st_size != self.size or os.pread(fd, len(self.header), 0) != self.header:
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, self.size)
+                os.pwrite(fd, self.header, 0)
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        self.fd = fd
+        self.map = mmap.mmap(fd, self.size)
+        self.pid = os.getpid()
+
+    def offset(self, route, method, field):
+        slot = self.route_index.get(route, self.route_index[OTHER_ROUTE]) * len(METHODS)
+        slot += METHODS.index(method) if method in METHODS else len(METHODS) - 1
+        return HEADER_SIZE + slot * self.slot_size + FIELD_INDEX[field] * VALUE.size
+
+    def observe(self, route, method, duration, queries, size, status):
+        increments = {
+            'requests': 1,
+            'duration_sum': duration,
+            'queries_sum': queries,
+            'size_sum': size,
+        }
+        if 400 <= status < 500:
+            increments['client_errors'] = 1
+        elif status >= 500:
+            increments['server_errors'] = 1
+        # гистограммы хранятся по корзинам, накопительные суммы считаются при выводе
+        for prefix, buckets, value in (
+            ('duration', DURATION_BUCKETS, duration),
+            ('queries', QUERY_BUCKETS, queries),
+            ('size', SIZE_BUCKETS, size),
+        ):
+            index = bisect.bisect_left(buckets, value)
+            if index < len(buckets):
+                increments[f'{prefix}_{index}'] = 1
+        self.add(route, method, increments)
+
+    def add(self, route, method, increments):
+        """Прибавляет {field: value} к слоту одной операцией под flock."""
+        with self.lock:
+            self._open()
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+            try:
+                for field, value in increments.items():
+                    offset = self.offset(route, method, field)
+                    VALUE.pack_into(self.map, offset, VALUE.unpack_from(self.map, offset)[0] + value)
+            finally:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def snapshot(self):
+        """{(route, method): {field: value}} для непустых слотов."""
+        with self.lock:
+            self._open()
+            fcntl.flock(self.fd, fcntl.LOCK_SH)
+            try:
+                data = bytes(self.map)
+            finally:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+        result = {}
+        for route in self.routes:
+            for method in METHODS:
+                start = self.offset(route, method, FIELDS[0])
+                values = struct.unpack_from(f'<{len(FIELDS)}d', data, start)
+                if any(values):
+                    result[route, method] = dict(zip(FIELDS, values))
+        return result
+
+    def reset(self):
+        with self.lock:
+            self._open()
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+            try:
+                self.map[HEADER_SIZE:] = bytes(self.size - HEADER_SIZE)
+            finally:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+
+_stores = {}
+
+
+def get_store():
+    path = settings.METRICS_FILE
+    store = _stores.get(path)
+    if store is None:
+        from . import urls
+        routes = [pattern.name for pattern in urls.urlpatterns if getattr(pattern, 'name', None)]
+        store = _stores[path] = MetricsStore(path, routes)
+    return store
+
+
+def _format(value):
+    return str(int(value)) if float(value).is_integer() else repr(value)
+
+
+def _histogram(lines, name, help_text, buckets, prefix, snapshot):
+    lines.append(f'# HELP {name} {help_text}')
+    lines.append(f'# TYPE {name} histogram')
+    for (route, method), values in snapshot.items():
+        labels = f'route="{route}",method="{method}"'
+        cumulative = 0
+        for i, le in enumerate(buckets):
+            cumulative += values[f'{prefix}_{i}']
+            lines.append(f'{name}_bucket{{{labels},le="{le}"}} {_format(cumulative)}')
+        lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {_format(values["requests"])}')
+        lines.append(f'{name}_sum{{{labels}}} {_format(values[f"{prefix}_sum"])}')
+        lines.append(f'{name}_count{{{labels}}} {_format(values["requests"])}')
+
+
+def render():
+    """Все метрики в текстовом формате Prometheus 0.0.4."""
+    # metrics импортируется из cache.py
+    from .cache import cache_stats
+
+    counters = get_store().snapshot()
+    # слот может хранить только счётчики кэша, если middleware выключен
+    snapshot = {slot: values for slot, values in counters.items() if values['requests']}
+    lines = [
+        '# HELP crm_med_http_requests_total Requests by route and method.',
+        '# TYPE crm_med_http_requests_total counter',
+    ]
+    for (route, method), values in snapshot.items():
+        lines.append(f'crm_med_http_requests_total{{route="{route}",method="{method}"}} {_format(values["requests"])}')
+
+    lines += [
+        '# HELP crm_med_http_errors_total Responses with 4xx/5xx status by route and method.',
+        '# TYPE crm_med_http_errors_total counter',
+    ]
+    for (route, method), values in snapshot.items():
+        for status_class, field in (('4xx', 'client_errors'), ('5xx', 'server_errors')):
+            lines.append(
+                f'crm_med_http_errors_total{{route="{route}",method="{method}",status="{status_class}"}} '
+                f'{_format(values[field])}'
+            )
+
+    _histogram(lines, 'crm_med_http_request_duration_seconds', 'Request latency.',
+               DURATION_BUCKETS, 'duration', snapshot)
+    _histogram(lines, 'crm_med_db_queries_per_request', 'SQL queries issued per request.',
+               QUERY_BUCKETS, 'queries', snapshot)
+    _histogram(lines, 'crm_med_http_response_size_bytes', 'Response body size.',
+               SIZE_BUCKETS, 'size', snapshot)
+
+    stats = cache_stats(counters)
+    if stats:
+        lines += [
+            '# HELP crm_med_response_cache_total Cached report responses by view and result.',
+            '# TYPE crm_med_response_cache_total counter',
+        ]
+        for view, counts in stats.items():
+            for result, value in counts.items():
+                lines.append(f'crm_med_response_cache_total{{view="{view}",result="{result}"}} {value}')
+
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,257 @@
+import functools
+import logging
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+from . import metrics
+
+
+logger = logging.getLogger(__name__)
+
+_current = ContextVar('crm_med_server_timing', default=None)
+
+
+class Timings:
+    """Замеры одного запроса: длительности фаз (секунды) и число SQL-запросов."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.total = None
+        self.durations = {}
+        self.queries = 0
+        self.phase_queries = {}
+        self.depth = 0
+
+    def add(self, name, seconds, queries=0):
+        self.durations[name] = self.durations.get(name, 0) + seconds
+        if queries:
+            self.phase_queries[name] = self.phase_queries.get(name, 0) + queries
+
+    def finish(self):
+        self.total = time.perf_counter() - self.started
+
+    def header(self):
+        parts = [f'db;dur={self.durations.get("db", 0) * 1000:.1f};desc="{self.queries} queries"']
+        for name, seconds in self.durations.items():
+            if name != 'db':
+                parts.append(f'{name};dur={seconds * 1000:.1f}')
+        total = self.total if self.total is not None else time.perf_counter() - self.started
+        parts.append(f'total;dur={total * 1000:.1f}')
+        return ', '.join(parts)
+
+
+def current():
+    return _current.get()
+
+
+@contextmanager
+def phase(name):
+    """
+    Замер фазы запроса, например with phase('xlsx'): ...
+    Время SQL внутри фазы в неё не входит — оно уже учтено в db.
+    Вне запроса (или при выключенной middleware) ничего не делает.
+    """
+    timings = _current.get()
+    if timings is None or timings.depth:
+        # вложенные фазы не считаем повторно
+        yield
+        return
+    timings.depth += 1
+    db_before, queries_before = timings.durations.get('db', 0), timings.queries
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        db = timings.durations.get('db', 0) - db_before
+        timings.add(name, time.perf_counter() - started - db, timings.queries - queries_before)
+        timings.depth -= 1
+
+
+def add(name, seconds):
+    """Добавить уже измеренное время к фазе (для горячих циклов, где phase() дорог)."""
+    timings = _current.get()
+    if timings is not None:
+        timings.add(name, seconds)
+
+
+def _execute_wrapper(execute, sql, params, many, context):
+    timings = _current.get()
+    if timings is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        timings.add('db', time.perf_counter() - started)
+        timings.queries += 1
+
+
+def install_execute_wrapper(connection, **kwargs):
+    """
+    execute_wrapper ставится на соединение один раз и пишет в замер текущего
+    контекста: async ORM выполняет запросы в другом потоке, со своим
+    соединением, но с тем же contextvar.
+    """
+    if _execute_wrapper not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_execute_wrapper)
+
+
+connection_created.connect(install_execute_wrapper)
+
+
+@contextmanager
+def measure():
+    """
+    Включает замер для текущего запроса: SQL на всех соединениях контекста.
+    Если замер уже идёт (внешняя middleware), возвращает его же.
+    """
+    timings = _current.get()
+    if timings is not None:
+        yield timings
+        return
+    timings = Timings()
+    token = _current.set(timings)
+    try:
+        for connection in connections.all():
+            install_execute_wrapper(connection)
+        yield timings
+    finally:
+        _current.reset(token)
+        timings.finish()
+
+
+def _timed(name, function):
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if _current.get() is None:
+            return function(*args, **kwargs)
+        with phase(name):
+            return function(*args, **kwargs)
+    wrapper.server_timing = True
+    return wrapper
+
+
+def install_hooks():
+    """
+    Оборачивает сериализацию DRF (BaseSerializer.data) и аутентификацию
+    (Request._authenticate). Без активного замера обёртки сразу вызывают оригинал.
+    """
+    from rest_framework.request import Request
+    from rest_framework.serializers import BaseSerializer
+
+    if not getattr(BaseSerializer.data.fget, 'server_timing', False):
+        BaseSerializer.data = property(_timed('ser', BaseSerializer.data.fget))
+    if not getattr(Request._authenticate, 'server_timing', False):
+        Request._authenticate = _timed('auth', Request._authenticate)
+
+
+class ServerTimingMiddleware:
+    """
+    Добавляет заголовок Server-Timing:
+        db;dur=12.3;desc="8 queries", auth;dur=0.4, ser;dur=5.1, render;dur=0.9, total;dur=21.0
+
+    db — время SQL (через execute_wrapper соединения), ser/auth/xlsx — время
+    фаз без SQL внутри них, render — рендер ответа DRF, total — весь запрос.
+    Если представление объявляет query_budget и превышает его (без запросов
+    аутентификации), пишется предупреждение в лог.
+    Выключается настройкой SERVER_TIMING_ENABLED = False.
+    Работает и в async-цепочке (ASGI): иначе Django переключал бы каждый
+    запрос в поток ради синхронной middleware.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not getattr(settings, 'SERVER_TIMING_ENABLED', True):
+            raise MiddlewareNotUsed
+        install_hooks()
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        with measure() as timings:
+            response = self.get_response(request)
+        return self.finish(request, response, timings)
+
+    async def __acall__(self, request):
+        with measure() as timings:
+            response = await self.get_response(request)
+        return self.finish(request, response, timings)
+
+    def finish(self, request, response, timings):
+        response['Server-Timing'] = timings.header()
+        self.check_query_budget(request, timings)
+        return response
+
+    def process_template_response(self, request, response):
+        timings = _current.get()
+        started = time.perf_counter()
+        response.add_post_render_callback(lambda r: timings.add('render', time.perf_counter() - started))
+        return response
+
+    def check_query_budget(self, request, timings):
+        match = getattr(request, 'resolver_match', None)
+        view_class = getattr(getattr(match, 'func', None), 'view_class', None)
+        budget = getattr(view_class, 'query_budget', None)
+        if budget is None:
+            return
+        queries = timings.queries - timings.phase_queries.get('auth', 0)
+        if queries > budget:
+            logger.warning(
+                "%s %s issued %d queries, query_budget of %s is %d",
+                request.method, request.path, queries, view_class.__name__, budget,
+            )
+
+
+class MetricsMiddleware:
+    """
+    Счётчики и гистограммы по маршрутам (crm_med/metrics.py) для /metrics:
+    длительность, число SQL-запросов, размер ответа, ошибки.
+    Выключается настройкой METRICS_ENABLED = False.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not getattr(settings, 'METRICS_ENABLED', True):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        started = time.perf_counter()
+        with measure() as timings:
+            response = self.get_response(request)
+            queries = timings.queries
+        return self.observe(request, response, time.perf_counter() - started, queries)
+
+    async def __acall__(self, request):
+        started = time.perf_counter()
+        with measure() as timings:
+            response = await self.get_response(request)
+            queries = timings.queries
+        return self.observe(request, response, time.perf_counter() - started, queries)
+
+    def observe(self, request, response, duration, queries):
+        if response.streaming:
+            size = int(response.get('Content-Length') or 0)
+        else:
+            size = len(response.content)
+        match = getattr(request, 'resolver_match', None)
+        metrics.get_store().observe(
+            getattr(match, 'url_name', None), request.method, duration, queries, size, response.status_code,
+        )
+        return response
@@ -29,6 +29,25 @@ PATIENT_STATUS_CHOICES = (
     ('canceled', _('Canceled')),
 )
 
+NOTIFICATION_EVENT_CHOICES = (
+    ('assigned', _('Assigned')),
+    ('unassigned', _('Unassigned')),
+)
+
+OUTBOX_STATUS_CHOICES = (
+    ('pending', _('Pending')),
+    ('sent', _('Sent')),
+    ('failed', _('Failed')),
+)
+
+# допустимые переходы статуса визита: из какого в какие
+PATIENT_STATUS_TRANSITIONS = {
+    'pre-registration': {'waiting', 'had an appointment', 'canceled'},
+    'waiting': {'had an appointment', 'canceled'},
+    'had an appointment': set(),
+    'canceled': set(),
+}
+
 
 class UserProfile(AbstractUser):
     profile_image = models.ImageField(upload_to='user_images/')
@@ -107,6 +126,65 @@ class ServiceType(models.Model):
         unique_together = ('type', 'department')
 
 
+def normalize_name(name):
+    return ' '.join(name.split()).casefold()
+
+
+class PatientCardManager(models.Manager):
+    def for_visit(self, name, phone):
+        card, _ = self.get_or_create(name_key=normalize_name(name), phone=phone, defaults={'name': name})
+        return card
+
+    def for_visits(self, visits):
+        """
+        Карточки для пачки визитов [(name, phone), ...]: существующие — одним запросом,
+        недостающие — через bulk_create. Возвращает {(name_key, phone): card};
+        card.has_visits — были ли у карточки визиты до этой пачки.
+        """
+        names = {}
+        for name, phone in visits:
+            names.setdefault((normalize_name(name), str(phone)), name)
+        if not names:
+            return {}
+
+        def existing():
+            cards = self.filter(
+                name_key__in={key for key, _ in names},
+                phone__in={phone for _, phone in names},
+            ).annotate(has_visits=models.Exists(Patient.objects.filter(card=models.OuterRef('pk'))))
+            # фильтр по двум IN шире нужного — лишние пары отбрасываем здесь
+            return {(card.name_key, str(card.phone)): card for card in cards if (card.name_key, str(card.phone)) in names}
+
+        cards = existing()
+        missing = [
+            self.model(name=name, name_key=key, phone=phone)
+            for (key, phone), name in names.items() if (key, phone) not in cards
+        ]
+        if missing:
+            self.bulk_create(missing, ignore_conflicts=True)
+            cards = existing()
+        return cards
+
+
+class PatientCard(models.Model):
+    """
+    Карточка пациента: один человек, к которому привязаны его визиты (Patient).
+    Определяется нормализованным именем и телефоном.
+    """
+    name = models.CharField(max_length=64)
+    name_key = models.CharField(max_length=64)
+    phone = PhoneNumberField()
+    created_date = models.DateField(auto_now_add=True)
+
+    objects = PatientCardManager()
+
+    def __str__(self):
+        return f'{self.id} {self.name} {self.phone}'
+
+    class Meta:
+        unique_together = ('name_key', 'phone')
+
+
 class Patient(models.Model):
     name = models.CharField(max_length=64)
     phone = PhoneNumberField()
@@ -123,10 +201,108 @@ class Patient(models.Model):
     created_date = models.DateField(auto_now_add=True)
     primary_patient = models.BooleanField(null=True, blank=True)
     info = models.TextField(null=True, blank=True)
+    card = models.ForeignKey(PatientCard, on_delete=models.SET_NULL, null=True, blank=True, related_name='visits')
 
     def __str__(self):
         return f'{self.id} {self.name}'
 
     class Meta:
-        ordering = ('-appointment_date',)
+        ordering = ('-appointment_date', '-id')
+        indexes = [
+            # курсорная пагинация (crm_med/pagination.py)
+            models.Index(fields=['appointment_date', 'id'], name='patient_date_id_idx'),
+            # окно календаря по доктору / отделению
+            models.Index(fields=['doctor', 'appointment_date'], name='patient_doctor_date_idx'),
+            models.Index(fields=['department', 'appointment_date'], name='patient_department_date_idx'),
+            # поиск по имени в отчётах
+            models.Index(fields=['name', 'appointment_date'], name='patient_name_date_idx'),
+        ]
+
+    def save(self, *args, **kwargs):
+        # визит всегда привязан к карточке, совпадающей по имени и телефону
+        card = self.card if self.card_id else None
+        if card is None or card.name_key != normalize_name(self.name) or card.phone != self.phone:
+            self.card = PatientCard.objects.for_visit(self.name, self.phone)
+        super().save(*args, **kwargs)
+
+
+class DailyRevenueRollup(models.Model):
+    """
+    Сводная таблица выручки по дням для отчётов.
+    Поддерживается сигналами Patient (crm_med/rollup.py), полностью
+    пересобирается командой rebuild_revenue_rollup.
+    """
+    date = models.DateField()
+    doctor = models.ForeignKey(Doctor, on_delete=models.CASCADE, related_name='revenue_rollups')
+    department = models.ForeignKey(Department, on_delete=models.CASCADE, related_name='revenue_rollups')
+    payment_type = models.CharField(max_length=32, choices=PAYMENT_TYPE_CHOICES)
+    patient_status = models.CharField(max_length=32, choices=PATIENT_STATUS_CHOICES)
+    patients_count = models.PositiveIntegerField(default=0)
+    gross = models.BigIntegerField(default=0)  # сумма с учётом скидок
+    discount_sum = models.BigIntegerField(default=0)
+    no_discount_sum = models.BigIntegerField(default=0)
+    doctor_share = models.BigIntegerField(default=0)  # цена * процент бонуса, в сотых
+
+    def __str__(self):
+        return f'{self.date} {self.doctor_id} {self.payment_type} {self.patient_status}'
+
+    class Meta:
+        unique_together = ('date', 'doctor', 'department', 'payment_type', 'patient_status')
+
+
+class ChangeCounter(models.Model):
+    """
+    Счётчик изменений визитов в области: доктор, отделение или все визиты
+    (crm_med/changes.py). Значение входит в ETag лент доктора и календаря.
+    """
+    scope = models.CharField(max_length=32, unique=True)
+    value = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return f'{self.scope} {self.value}'
+
 
+class DoctorNotificationEvent(models.Model):
+    """
+    Событие ленты уведомлений доктора: визит назначен ему или снят с него
+    (crm_med/notifications.py). id — курсор для ?since= и Last-Event-ID.
+    """
+    doctor = models.ForeignKey(Doctor, on_delete=models.CASCADE, related_name='notification_events')
+    # не внешний ключ: событие снятия остаётся и после удаления визита
+    patient_id = models.BigIntegerField()
+    kind = models.CharField(max_length=16, choices=NOTIFICATION_EVENT_CHOICES)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f'{self.id} {self.doctor_id} {self.kind} {self.patient_id}'
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['doctor', 'id'], name='notification_doctor_id_idx'),
+        ]
+
+
+class OutboxMessage(models.Model):
+    """
+    Письмо в очереди на отправку (crm_med/outbox.py): запрос только сохраняет
+    его, SMTP — дело фонового обработчика. next_attempt_at — когда письмо
+    можно брать в работу: сразу, после паузы повтора или после аренды.
+    """
+    subject = models.CharField(max_length=255)
+    body = models.TextField()
+    from_email = models.CharField(max_length=255)
+    recipients = models.JSONField()
+    status = models.CharField(max_length=16, choices=OUTBOX_STATUS_CHOICES, default='pending')
+    attempts = models.PositiveSmallIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f'{self.id} {self.status} {", ".join(self.recipients)}'
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at'], name='outbox_due_idx'),
+        ]
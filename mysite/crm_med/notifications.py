@@ -0,0 +1,146 @@
+import asyncio
+import json
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db.models import Max, Q
+from django.utils import timezone
+from rest_framework.utils.encoders import JSONEncoder
+
+from .authentication import ClaimsJWTAuthentication, user_from_token
+from .models import DoctorNotificationEvent, Patient
+
+
+# Лента уведомлений доктора: события назначения визитов (DoctorNotificationEvent)
+# пишутся сигналами в той же транзакции, что и визит. Клиент читает их
+# порциями после курсора (?since=) или получает потоком Server-Sent Events.
+#
+# Курсор — id события. В SQLite записи сериализованы, и события видны в порядке
+# id. В PostgreSQL конкурентные транзакции фиксируются в любом порядке: событие
+# с меньшим id может стать видимым уже после того, как курсор ушёл дальше.
+# Поток поэтому досматривает события последних NOTIFICATION_STREAM_LOOKBACK
+# секунд; ?since= без состояния такое событие пропустит — после переподключения
+# клиенту надёжнее перечитать полный список.
+
+ASSIGNED = 'assigned'
+UNASSIGNED = 'unassigned'
+
+FEED_LIMIT = 200
+
+
+def record(events):
+    """events — [(doctor_id, patient_id, kind), ...]."""
+    DoctorNotificationEvent.objects.bulk_create([
+        DoctorNotificationEvent(doctor_id=doctor_id, patient_id=patient_id, kind=kind)
+        for doctor_id, patient_id, kind in events
+    ])
+
+
+def latest_cursor(doctor_id):
+    return DoctorNotificationEvent.objects.filter(doctor_id=doctor_id).aggregate(cursor=Max('id'))['cursor'] or 0
+
+
+def lookback_start(lookback):
+    return timezone.now() - timedelta(seconds=lookback)
+
+
+def seen_ids(doctor_id, cursor, lookback):
+    """id событий окна lookback, которые клиент с этим курсором уже получил."""
+    return list(DoctorNotificationEvent.objects.filter(
+        doctor_id=doctor_id, id__lte=cursor, created_at__gte=lookback_start(lookback),
+    ).values_list('id', flat=True))
+
+
+def events_after(doctor_id, cursor, limit=None, lookback=None, delivered=()):
+    """
+    {'cursor', 'has_more', 'events'}: не больше limit событий после cursor.
+    Визиты назначений загружаются одним запросом; следующий запрос — с новым cursor.
+    С lookback (секунды) возвращаются и события с id <= cursor, созданные за это
+    время и ещё не отправленные (delivered — их id): транзакция, начатая раньше,
+    могла зафиксироваться позже.
+    """
+    # serializers импортирует signals, а signals — этот модуль
+    from .serializers import DoctorNotificationEventSerializer
+
+    limit = limit or FEED_LIMIT
+    query = Q(id__gt=cursor)
+    if lookback:
+        query |= Q(created_at__gte=lookback_start(lookback))
+    events = list(
+        DoctorNotificationEvent.objects.filter(query, doctor_id=doctor_id)
+        .exclude(id__in=delivered).order_by('id')[:limit + 1]
+    )
+    has_more = len(events) > limit
+    events = events[:limit]
+    patient_ids = {event.patient_id for event in events if event.kind == ASSIGNED}
+    patients = Patient.objects.select_related('department', 'registrar').in_bulk(patient_ids) if patient_ids else {}
+    return {
+        'cursor': max([cursor] + [event.id for event in events]),
+        'has_more': has_more,
+        'events': DoctorNotificationEventSerializer(events, many=True, context={'patients': patients}).data,
+    }
+
+
+def parse_cursor(value):
+    if value is None or value == '':
+        return None
+    if not str(value).isdigit():
+        raise ValueError("Cursor must be a non-negative integer")
+    return int(value)
+
+
+def authenticate(request):
+    """
+    Пользователь по JWT для потока: заголовок Authorization или ?access_token=
+    (EventSource в браузере не умеет отправлять заголовки).
+    """
+    raw_token = request.GET.get('access_token')
+    if raw_token:
+        return user_from_token(raw_token)
+    result = ClaimsJWTAuthentication().authenticate(request)
+    return result[0] if result else None
+
+
+def format_event(event, cursor):
+    # id — курсор потока, а не события: досмотренное событие бывает старше уже отправленных
+    data = json.dumps(event, cls=JSONEncoder, ensure_ascii=False)
+    return f'id: {cursor}\nevent: {event["kind"]}\ndata: {data}\n\n'
+
+
+async def stream(doctor_id, cursor):
+    """
+    Поток Server-Sent Events: новые события проверяются раз в
+    NOTIFICATION_STREAM_POLL_INTERVAL секунд (один запрос по индексу),
+    при тишине отправляется комментарий-keepalive. Через
+    NOTIFICATION_STREAM_TIMEOUT поток закрывается — EventSource
+    переподключается с Last-Event-ID, токен при этом проверяется заново.
+    События, зафиксированные позже курсора, досматриваются в окне
+    NOTIFICATION_STREAM_LOOKBACK секунд; отправленные за это время id
+    запоминаются, чтобы не повторить их.
+    """
+    poll_interval = getattr(settings, 'NOTIFICATION_STREAM_POLL_INTERVAL', 0.5)
+    keepalive = getattr(settings, 'NOTIFICATION_STREAM_KEEPALIVE', 15)
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + getattr(settings, 'NOTIFICATION_STREAM_TIMEOUT', 300)
+    lookback = getattr(settings, 'NOTIFICATION_STREAM_LOOKBACK', 5)
+    fetch = sync_to_async(events_after)
+
+    # клиент переподключается через секунду после разрыва
+    yield 'retry: 1000\n\n'
+    last_sent = loop.time()
+    # id отправленных событий -> время отправки; событие старше окна уже не вернётся
+    delivered = dict.fromkeys(await sync_to_async(seen_ids)(doctor_id, cursor, lookback), last_sent)
+    while loop.time() < deadline:
+        delivered = {id: sent for id, sent in delivered.items() if loop.time() - sent <= lookback}
+        feed = await fetch(doctor_id, cursor, lookback=lookback, delivered=list(delivered))
+        for event in feed['events']:
+            cursor = max(cursor, event['cursor'])
+            yield format_event(event, cursor)
+            last_sent = delivered[event['cursor']] = loop.time()
+        if feed['has_more']:
+            continue
+        if loop.time() - last_sent >= keepalive:
+            yield ': keepalive\n\n'
+            last_sent = loop.time()
+        await asyncio.sleep(poll_interval)
@@ -0,0 +1,172 @@
+import logging
+import threading
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+
+from .models import OutboxMessage
+
+
+# Очередь писем: запрос сохраняет OutboxMessage в своей транзакции и сразу
+# отвечает, письма отправляет обработчик — поток в процессе приложения
+# (OUTBOX_WORKER = 'thread') или management-команда send_outbox.
+# Неудачная отправка повторяется с экспоненциальной паузой.
+
+logger = logging.getLogger(__name__)
+
+
+def enqueue(subject, body, recipients, from_email=None):
+    message = OutboxMessage.objects.create(
+        subject=subject,
+        body=body,
+        from_email=from_email or settings.DEFAULT_FROM_EMAIL,
+        recipients=list(recipients),
+    )
+    # письмо не видно обработчику до коммита
+    transaction.on_commit(wake)
+    return message
+
+
+def retry_delay(attempts):
+    """Пауза перед повтором: OUTBOX_RETRY_BASE, дальше вдвое больше, не дольше OUTBOX_RETRY_MAX."""
+    base = getattr(settings, 'OUTBOX_RETRY_BASE', 30)
+    return timedelta(seconds=min(base * 2 ** (attempts - 1), getattr(settings, 'OUTBOX_RETRY_MAX', 3600)))
+
+
+def claim(batch_size):
+    """
+    Письма, которые пора отправить. Взятые письма арендуются на OUTBOX_LEASE
+    секунд: другой обработчик их не возьмёт, а после сбоя процесса они
+    вернутся в очередь сами.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        messages = list(
+            OutboxMessage.objects
+            .select_for_update(skip_locked=True)
+            .filter(status='pending', next_attempt_at__lte=now)
+            .order_by('next_attempt_at', 'id')[:batch_size]
+        )
+        OutboxMessage.objects.filter(id__in=[message.id for message in messages]).update(
+            next_attempt_at=now + timedelta(seconds=getattr(settings, 'OUTBOX_LEASE', 300)),
+        )
+    return messages
+
+
+def send_batch(batch_size=None):
+    """Одна пачка через одно SMTP-соединение: {'sent', 'retried', 'failed'}."""
+    messages = claim(batch_size or getattr(settings, 'OUTBOX_BATCH_SIZE', 50))
+    result = {'sent': 0, 'retried': 0, 'failed': 0}
+    if not messages:
+        return result
+
+    connection = get_connection()
+    try:
+        connection.open()
+    except Exception as exc:
+        # сервер недоступен: повтор всей пачки
+        for message in messages:
+            result[failure(message, exc)] += 1
+        return result
+
+    try:
+        for message in messages:
+            email = EmailMessage(
+                message.subject, message.body, message.from_email, message.recipients, connection=connection,
+            )
+            try:
+                email.send()
+            except Exception as exc:
+                result[failure(message, exc)] += 1
+                continue
+            message.status = 'sent'
+            message.sent_at = timezone.now()
+            message.attempts += 1
+            message.save(update_fields=['status', 'sent_at', 'attempts'])
+            result['sent'] += 1
+    finally:
+        connection.close()
+    return result
+
+
+def failure(message, exc):
+    message.attempts += 1
+    message.last_error = f'{type(exc).__name__}: {exc}'
+    if message.attempts >= getattr(settings, 'OUTBOX_MAX_ATTEMPTS', 8):
+        message.status = 'failed'
+        logger.error("Outbox message %s failed after %d attempts: %s", message.id, message.attempts, message.last_error)
+    else:
+        message.next_attempt_at = timezone.now() + retry_delay(message.attempts)
+        logger.warning("Outbox message %s attempt %d failed: %s", message.id, message.attempts, message.last_error)
+    message.save(update_fields=['attempts', 'last_error', 'status', 'next_attempt_at'])
+    return 'failed' if message.status == 'failed' else 'retried'
+
+
+def deliver(batch_size=None):
+    """Отправляет пачками, пока есть письма, которые пора отправить."""
+    total = {'sent': 0, 'retried': 0, 'failed': 0}
+    while True:
+        result = send_batch(batch_size)
+        for key, value in result.items():
+            total[key] += value
+        if not any(result.values()):
+            return total
+
+
+def run(stop, wakeup=None, batch_size=None, poll_interval=None):
+    """
+    Цикл обработчика до stop.set(): пачки, затем ожидание wakeup (новое
+    письмо в этом процессе) или OUTBOX_POLL_INTERVAL секунд — за это время
+    подходят повторы и письма из других процессов.
+    """
+    poll_interval = poll_interval or getattr(settings, 'OUTBOX_POLL_INTERVAL', 5)
+    wakeup = wakeup or threading.Event()
+    while not stop.is_set():
+        # письма, пришедшие во время отправки, разбудят следующий круг
+        wakeup.clear()
+        close_old_connections()
+        try:
+            deliver(batch_size)
+        except Exception:
+            logger.exception("Outbox delivery failed")
+        wakeup.wait(poll_interval)
+    close_old_connections()
+
+
+# --- обработчик в процессе приложения ---
+
+_worker = None
+_worker_lock = threading.Lock()
+_stop = threading.Event()
+_wakeup = threading.Event()
+
+
+def wake():
+    if getattr(settings, 'OUTBOX_WORKER', 'thread') != 'thread':
+        return
+    start_worker()
+    _wakeup.set()
+
+
+def start_worker():
+    """Фоновый поток запускается при первом письме; daemon — не держит процесс при выходе."""
+    global _worker
+    with _worker_lock:
+        if _worker is None or not _worker.is_alive():
+            _stop.clear()
+            _worker = threading.Thread(target=run, args=(_stop, _wakeup), name='crm-med-outbox', daemon=True)
+            _worker.start()
+    return _worker
+
+
+def stop_worker(timeout=None):
+    global _worker
+    with _worker_lock:
+        worker, _worker = _worker, None
+    if worker is not None:
+        _stop.set()
+        _wakeup.set()
+        worker.join(timeout)
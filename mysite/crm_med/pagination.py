@@ -0,0 +1,14 @@
+from django.conf import settings
+from rest_framework.pagination import CursorPagination
+
+
+class PatientCursorPagination(CursorPagination):
+    """
+    Курсорная пагинация визитов по (appointment_date, id) — как в Patient.Meta.ordering.
+    Следующая страница выбирается условием по индексу, а не OFFSET,
+    поэтому глубокие страницы стоят столько же, сколько первая.
+    """
+    ordering = ('-appointment_date', '-id')
+    page_size = getattr(settings, 'PATIENT_PAGE_SIZE', 50)
+    page_size_query_param = 'page_size'
+    max_page_size = 500
@@ -0,0 +1,213 @@
+from bisect import bisect_right
+from datetime import datetime, time, timedelta
+
+from django.db.models import F, Sum, Count, Value, Q
+from django.db.models.functions import Coalesce, Trunc
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from rest_framework.exceptions import ValidationError
+
+
+def day_bounds(day):
+    """Границы локального дня [start, end) для фильтрации appointment_date по диапазону."""
+    start = timezone.make_aware(datetime.combine(day, time.min))
+    end = timezone.make_aware(datetime.combine(day + timedelta(days=1), time.min))
+    return start, end
+
+
+def appointment_on(day):
+    """
+    Фильтр визитов за локальный день диапазоном вместо appointment_date__date=day:
+    __date оборачивает колонку в функцию и не даёт использовать индекс.
+    """
+    start, end = day_bounds(day)
+    return Q(appointment_date__gte=start, appointment_date__lt=end)
+
+
+# максимальная длина окна календаря (месячный вид с соседними неделями)
+CALENDAR_MAX_WINDOW = timedelta(days=62)
+
+
+def parse_window_bound(value, name, end=False):
+    """
+    Граница окна календаря: YYYY-MM-DD или дата со временем в ISO формате.
+    Для даты без времени end включает весь день.
+    """
+    if not value:
+        raise ValidationError({name: "This parameter is required, use YYYY-MM-DD or ISO datetime"})
+    try:
+        day = parse_date(value)
+        moment = None if day else parse_datetime(value)
+    except ValueError:
+        day = moment = None
+
+    if day:
+        start, stop = day_bounds(day)
+        return stop if end else start
+    if moment is None:
+        raise ValidationError({name: "Invalid date format, use YYYY-MM-DD or ISO datetime"})
+    if timezone.is_naive(moment):
+        moment = timezone.make_aware(moment)
+    return moment
+
+
+def calendar_window(start, end):
+    """Окно календаря [start, end) из параметров запроса; ValidationError, если оно некорректно."""
+    start = parse_window_bound(start, 'start')
+    end = parse_window_bound(end, 'end', end=True)
+    if end <= start:
+        raise ValidationError({"end": "end must be after start"})
+    if end - start > CALENDAR_MAX_WINDOW:
+        raise ValidationError({"end": f"Window is limited to {CALENDAR_MAX_WINDOW.days} days"})
+    return start, end
+
+
+def effective_price():
+    """
+    Цена визита: скидочная цена, если она указана (в том числе 0 — бесплатный
+    визит), иначе цена услуги. То же правило, что у visit_price и у разделения
+    sum_discount / sum_no_discount по with_discount__isnull.
+    """
+    return Coalesce(F('with_discount'), F('service_type__price'))
+
+
+def visit_price(patient):
+    """effective_price() для загруженного визита."""
+    return patient.with_discount if patient.with_discount is not None else patient.service_type.price
+
+
+def patient_totals(queryset):
+    """
+    Все итоги отчёта по пациентам за один агрегирующий запрос.
+
+    Доли докторов (doctor_share_cash/doctor_share_card) хранятся в сотых:
+    цена * процент бонуса, чтобы суммировать без потери точности.
+    """
+    price = effective_price()
+    return queryset.aggregate(
+        patients_count=Count('id'),
+        sum_discount=Coalesce(Sum('with_discount', filter=Q(with_discount__isnull=False)), Value(0)),
+        sum_no_discount=Coalesce(Sum('service_type__price', filter=Q(with_discount__isnull=True)), Value(0)),
+        total_cash=Coalesce(Sum(price, filter=Q(payment_type='cash')), Value(0)),
+        total_card=Coalesce(Sum(price, filter=Q(payment_type='card')), Value(0)),
+        doctor_share_cash=Coalesce(Sum(price * F('doctor__bonus'), filter=Q(payment_type='cash')), Value(0)),
+        doctor_share_card=Coalesce(Sum(price * F('doctor__bonus'), filter=Q(payment_type='card')), Value(0)),
+    )
+
+
+def rollup_totals(queryset):
+    """Те же итоги, что и patient_totals, но по сводной таблице DailyRevenueRollup."""
+    cash = Q(payment_type='cash')
+    card = Q(payment_type='card')
+    return queryset.aggregate(
+        patients_count=Coalesce(Sum('patients_count'), Value(0)),
+        sum_discount=Coalesce(Sum('discount_sum'), Value(0)),
+        sum_no_discount=Coalesce(Sum('no_discount_sum'), Value(0)),
+        total_cash=Coalesce(Sum('gross', filter=cash), Value(0)),
+        total_card=Coalesce(Sum('gross', filter=card), Value(0)),
+        doctor_share_cash=Coalesce(Sum('doctor_share', filter=cash), Value(0)),
+        doctor_share_card=Coalesce(Sum('doctor_share', filter=card), Value(0)),
+    )
+
+
+def doctor_earnings(totals):
+    return round((totals['doctor_share_cash'] + totals['doctor_share_card']) / 100, 2)
+
+
+def summary_from_totals(totals):
+    """
+    Разделение выручки между докторами и клиникой (ReportSummaryAPIView).
+    Всё считается в целых числах: доли докторов хранятся в сотых.
+    """
+    doctor_cash = totals['doctor_share_cash']
+    doctor_card = totals['doctor_share_card']
+    clinic_cash = totals['total_cash'] * 100 - doctor_cash
+    clinic_card = totals['total_card'] * 100 - doctor_card
+
+    return {
+        'doctor_cash': doctor_cash // 100,
+        'doctor_card': doctor_card // 100,
+
+        'clinic_cash': clinic_cash // 100,
+        'clinic_card': clinic_card // 100,
+
+        'total_cash': totals['total_cash'],
+        'total_card': totals['total_card'],
+
+        'total_clinic': (clinic_cash + clinic_card) // 100,
+        'total_doctor': (doctor_cash + doctor_card) // 100,
+    }
+
+
+# период: (единица усечения, размер интервала в единицах, количество интервалов)
+ANALYSIS_PERIODS = {
+    'daily': ('hour', 2, 12),
+    'weekly': ('day', 1, 7),
+    'monthly': ('day', 2, 15),
+    'yearly': ('month', 1, 12),
+}
+
+
+def truncate(moment, unit):
+    local = timezone.localtime(moment)
+    if unit == 'hour':
+        return local.replace(minute=0, second=0, microsecond=0)
+    if unit == 'day':
+        return timezone.make_aware(datetime.combine(local.date(), time.min))
+    return timezone.make_aware(datetime(local.year, local.month, 1))
+
+
+def shift(moment, unit, count):
+    if unit == 'hour':
+        return moment + timedelta(hours=count)
+    if unit == 'day':
+        return timezone.make_aware(datetime.combine(moment.date() + timedelta(days=count), time.min))
+    year, month = divmod(moment.year * 12 + moment.month - 1 + count, 12)
+    return timezone.make_aware(datetime(year, month + 1, 1))
+
+
+def analysis_buckets(period, now):
+    """Начала интервалов графика; последний интервал содержит текущий момент."""
+    unit, step, count = ANALYSIS_PERIODS[period]
+    start = shift(truncate(now, unit), unit, -(step * count - 1))
+    return unit, [shift(start, unit, i * step) for i in range(count)]
+
+
+def analysis_report(queryset, period, now):
+    """
+    График и итоги для AnalysisAPIView одним GROUP BY запросом.
+    Пустые интервалы заполняются нулями уже в Python.
+    """
+    starts, rows = analysis_rows(queryset, period, now)
+    return analysis_chart(starts, rows)
+
+
+def analysis_rows(queryset, period, now):
+    """Начала интервалов и ещё не выполненный GROUP BY запрос (async-версия выполняет его сама)."""
+    unit, starts = analysis_buckets(period, now)
+    rows = (
+        queryset
+        .filter(appointment_date__gte=starts[0], appointment_date__lte=now)
+        .annotate(moment=Trunc('appointment_date', unit))
+        .values('moment')
+        .order_by()
+        .annotate(
+            total=Count('id'),
+            canceled=Count('id', filter=Q(patient_status='canceled')),
+            primary=Count('id', filter=Q(primary_patient=True)),
+        )
+    )
+    return starts, rows
+
+
+def analysis_chart(starts, rows):
+    chart = [{'appointment_date': start, 'had_an_appointment': 0, 'canceled': 0} for start in starts]
+    totals = {'total': 0, 'canceled': 0, 'primary': 0}
+    for row in rows:
+        bucket = chart[bisect_right(starts, row['moment']) - 1]
+        bucket['had_an_appointment'] += row['total'] - row['canceled']
+        bucket['canceled'] += row['canceled']
+        for key in totals:
+            totals[key] += row[key]
+
+    return totals, chart
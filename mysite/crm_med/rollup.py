@@ -0,0 +1,96 @@
+from functools import reduce
+from operator import or_
+
+from django.db import transaction
+from django.db.models import F, Q, Sum, Count, Value
+from django.db.models.functions import Coalesce, TruncDate
+from django.utils import timezone
+
+from .models import Patient, DailyRevenueRollup
+from .reports import effective_price, visit_price, appointment_on
+
+
+ROLLUP_KEY_FIELDS = ('date', 'doctor_id', 'department_id', 'payment_type', 'patient_status')
+
+
+def contribution(patient):
+    """Ключ строки сводной таблицы и вклад в неё одного визита."""
+    price = visit_price(patient)
+    key = {
+        'date': timezone.localtime(patient.appointment_date).date(),
+        'doctor_id': patient.doctor_id,
+        'department_id': patient.department_id,
+        'payment_type': patient.payment_type,
+        'patient_status': patient.patient_status,
+    }
+    values = {
+        'patients_count': 1,
+        'gross': price,
+        'discount_sum': patient.with_discount or 0,
+        'no_discount_sum': patient.service_type.price if patient.with_discount is None else 0,
+        'doctor_share': price * (patient.doctor.bonus or 0),
+    }
+    return key, values
+
+
+def apply_contribution(key, values, sign):
+    rollups = DailyRevenueRollup.objects.filter(**key)
+    updated = rollups.update(**{field: F(field) + sign * value for field, value in values.items()})
+    if sign < 0:
+        rollups.filter(patients_count=0).delete()
+    elif not updated:
+        rollup, created = DailyRevenueRollup.objects.get_or_create(**key, defaults=values)
+        if not created:
+            rollups.update(**{field: F(field) + value for field, value in values.items()})
+
+
+def patient_changed(patient, previous=None):
+    """Инкрементальное обновление после сохранения визита; previous — состояние до сохранения."""
+    with transaction.atomic():
+        if previous is not None:
+            apply_contribution(*contribution(previous), sign=-1)
+        apply_contribution(*contribution(patient), sign=1)
+
+
+def patient_deleted(patient):
+    with transaction.atomic():
+        apply_contribution(*contribution(patient), sign=-1)
+
+
+def rebuild_rollup(dates=None, doctor_ids=None):
+    """
+    Пересобирает сводную таблицу из Patient.
+    Без аргументов — целиком, иначе только указанные дни и/или доктора.
+    """
+    patients = Patient.objects.all()
+    rollups = DailyRevenueRollup.objects.all()
+    if dates is not None:
+        dates = set(dates)
+        if not dates:
+            return
+        patients = patients.filter(reduce(or_, map(appointment_on, dates)))
+        rollups = rollups.filter(date__in=dates)
+    if doctor_ids is not None:
+        patients = patients.filter(doctor_id__in=doctor_ids)
+        rollups = rollups.filter(doctor_id__in=doctor_ids)
+
+    price = effective_price()
+    rows = (
+        patients
+        .annotate(date=TruncDate('appointment_date'))
+        .values(*ROLLUP_KEY_FIELDS)
+        .order_by()
+        .annotate(
+            patients_count=Count('id'),
+            gross=Sum(price),
+            discount_sum=Coalesce(Sum('with_discount'), Value(0)),
+            no_discount_sum=Coalesce(Sum('service_type__price', filter=Q(with_discount__isnull=True)), Value(0)),
+            doctor_share=Sum(price * F('doctor__bonus')),
+        )
+    )
+    with transaction.atomic():
+        rollups.delete()
+        DailyRevenueRollup.objects.bulk_create(
+            (DailyRevenueRollup(**row) for row in rows.iterator()),
+            batch_size=1000,
+        )
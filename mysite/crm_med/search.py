@@ -0,0 +1,234 @@
+import re
+
+from django.db import connections, router
+from django.db.models import Q
+from django.db.models.expressions import RawSQL
+
+from .models import Patient
+
+
+# Полнотекстовый индекс визитов (SQLite FTS5) по имени, телефону и примечанию.
+# Таблица external content: текст хранится только в crm_med_patient,
+# в индексе — токены. Синхронизируется триггерами, поэтому работает и
+# для bulk_create / update(), которые не отправляют сигналы.
+FTS_TABLE = 'crm_med_patient_fts'
+VOCAB_TABLE = 'crm_med_patient_fts_vocab'
+
+# Ранжирование bm25: совпадение в имени важнее телефона, телефон — примечания
+RANK_WEIGHTS = (10.0, 5.0, 1.0)
+
+# Сколько самых свежих совпадений ранжировать. Короткий префикс ("ас")
+# у миллиона визитов даёт сотни тысяч совпадений — считать bm25 для всех
+# слишком дорого, а нужен пациент, который пришёл недавно.
+SEARCH_CANDIDATES = 200
+
+# Слова сверх MAX_TOKENS отбрасываются: на каждое слово с опечаткой — отдельный запрос к словарю
+MAX_TOKENS = 5
+
+# Токены короче не ищем. Префиксы до 6 символов индексируются отдельно:
+# более длинный префикс FTS5 собирает из всех подходящих слов, а это уже медленно
+MIN_TOKEN_LENGTH = 2
+
+TRIGGERS = ('crm_med_patient_fts_ai', 'crm_med_patient_fts_ad', 'crm_med_patient_fts_au')
+
+SCHEMA = [
+    f"""
+    CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5(
+        name, phone, info,
+        content='crm_med_patient', content_rowid='id',
+        tokenize='unicode61', prefix='2 3 4 5 6'
+    )
+    """,
+    f"CREATE VIRTUAL TABLE IF NOT EXISTS {VOCAB_TABLE} USING fts5vocab({FTS_TABLE}, 'row')",
+    f"""
+    CREATE TRIGGER IF NOT EXISTS crm_med_patient_fts_ai AFTER INSERT ON crm_med_patient BEGIN
+        INSERT INTO {FTS_TABLE}(rowid, name, phone, info) VALUES (new.id, new.name, new.phone, new.info);
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS crm_med_patient_fts_ad AFTER DELETE ON crm_med_patient BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, name, phone, info)
+        VALUES ('delete', old.id, old.name, old.phone, old.info);
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS crm_med_patient_fts_au AFTER UPDATE OF name, phone, info ON crm_med_patient BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, name, phone, info)
+        VALUES ('delete', old.id, old.name, old.phone, old.info);
+        INSERT INTO {FTS_TABLE}(rowid, name, phone, info) VALUES (new.id, new.name, new.phone, new.info);
+    END
+    """,
+]
+
+
+def get_connection():
+    return connections[router.db_for_read(Patient)]
+
+
+def is_supported(connection=None):
+    return (connection or get_connection()).vendor == 'sqlite'
+
+
+def install(connection, rebuild=False):
+    """Создаёт FTS-таблицу и триггеры; новую таблицу сразу заполняет из crm_med_patient."""
+    if Patient._meta.db_table not in connection.introspection.table_names():
+        return
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE name = %s", [FTS_TABLE])
+        created = cursor.fetchone() is None
+        for statement in SCHEMA:
+            cursor.execute(statement)
+        if created or rebuild:
+            cursor.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')")
+
+
+def drop_triggers(connection):
+    """
+    Отключает синхронизацию индекса, например на время массовой загрузки:
+    после неё install(connection, rebuild=True) вернёт триггеры и пересоберёт индекс целиком.
+    """
+    with connection.cursor() as cursor:
+        for trigger in TRIGGERS:
+            cursor.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+
+
+def optimize(connection):
+    with connection.cursor() as cursor:
+        cursor.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('optimize')")
+
+
+def tokenize(query):
+    """'Асан  +996 (700) 12-34' -> ['асан', '9967001234']"""
+    # телефон вводят группами цифр — склеиваем их, в индексе номер один токен
+    query = re.sub(r'(?<=\d)[\s()-]+(?=\d)', '', query.casefold())
+    return [token for token in re.findall(r'\w+', query) if len(token) >= MIN_TOKEN_LENGTH][:MAX_TOKENS]
+
+
+def match_expression(tokens):
+    # каждый токен в кавычках — спецсимволы FTS5 в запросе не интерпретируются
+    return ' AND '.join(
+        '(' + ' OR '.join(f'"{variant}"*' for variant in variants) + ')'
+        for variants in tokens
+    )
+
+
+def edit_distance(a, b, limit):
+    """
+    Расстояние Дамерау-Левенштейна (перестановка соседних букв — одна правка),
+    если оно не больше limit, иначе limit + 1. Считается только полоса |i - j| <= limit,
+    с выходом, как только вся строка превысила limit.
+    """
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    over = limit + 1
+    before = None
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, start=1):
+        current = [over] * (len(b) + 1)
+        current[0] = i if i <= limit else over
+        row_min = current[0]
+        for j in range(max(1, i - limit), min(len(b), i + limit) + 1):
+            cost = min(previous[j - 1] + (ca != b[j - 1]), previous[j] + 1, current[j - 1] + 1)
+            if before and j > 1 and ca == b[j - 2] and a[i - 2] == b[j - 1]:
+                cost = min(cost, before[j - 2] + 1)
+            current[j] = cost
+            row_min = min(row_min, cost)
+        if row_min > limit:
+            return over
+        before, previous = previous, current
+    return min(previous[-1], over)
+
+
+def bigrams(word):
+    return {word[i:i + 2] for i in range(len(word) - 1)}
+
+
+def similar_terms(cursor, token, limit=10):
+    """
+    Слова из словаря индекса, отличающиеся от token опечаткой.
+    Кандидаты берутся по первым двум буквам — опечатку в них не исправляем,
+    зато словарь читается узким диапазоном, а не целиком.
+    Если token сам является началом слова из словаря, опечатки нет — возвращает [].
+    """
+    if token.isdigit() or len(token) < 4:
+        return []
+    max_distance = 1 if len(token) <= 5 else 2
+    cursor.execute(
+        f"SELECT term FROM {VOCAB_TABLE} WHERE term >= %s AND term < %s",
+        [token[:2], token[0] + chr(ord(token[1]) + 1)],
+    )
+    token_bigrams = bigrams(token)
+    # каждая правка убирает не больше двух биграмм — остальные слова можно не сравнивать
+    min_common = len(token_bigrams) - 2 * max_distance
+    terms = [term for (term,) in cursor.fetchall()]
+    if any(term.startswith(token) for term in terms):
+        return []
+    scored = []
+    for term in terms:
+        if len(token_bigrams & bigrams(term)) < min_common:
+            continue
+        distance = edit_distance(token, term, max_distance)
+        if len(term) > len(token) + max_distance:
+            # запрос может быть началом длинного слова с опечаткой — сравниваем с началом
+            distance = min(distance, edit_distance(token, term[:len(token)], max_distance))
+        if distance <= max_distance:
+            scored.append((distance, term))
+    scored.sort()
+    return [term for _, term in scored[:limit]]
+
+
+def search_ids(query, limit=20):
+    """
+    id визитов, подходящих под запрос, от лучшего совпадения к худшему.
+    Каждое слово запроса — префикс (AND между словами). Если точных
+    совпадений нет, слова заменяются на похожие из словаря индекса.
+    """
+    tokens = tokenize(query)
+    if not tokens:
+        return []
+
+    sql = f"""
+        SELECT id FROM (
+            SELECT rowid AS id, bm25({FTS_TABLE}, %s, %s, %s) AS score
+            FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s
+            ORDER BY rowid DESC LIMIT %s
+        ) ORDER BY score, id DESC LIMIT %s
+    """
+    with get_connection().cursor() as cursor:
+        cursor.execute(sql, [*RANK_WEIGHTS, match_expression([[t] for t in tokens]), SEARCH_CANDIDATES, limit])
+        ids = [row[0] for row in cursor.fetchall()]
+        if ids:
+            return ids
+
+        # опечатку ищем только в словах, которые сами по себе ничего не находят
+        variants = [[token, *similar_terms(cursor, token)] for token in tokens]
+        if all(len(v) == 1 for v in variants):
+            return []
+        cursor.execute(sql, [*RANK_WEIGHTS, match_expression(variants), SEARCH_CANDIDATES, limit])
+        return [row[0] for row in cursor.fetchall()]
+
+
+def filter_patients(queryset, query):
+    """Фильтр queryset визитов по поисковой строке (для ?q= в списках и отчётах)."""
+    tokens = tokenize(query)
+    if not tokens:
+        return queryset.none()
+    if not is_supported():
+        # без FTS5 (не SQLite) — обычный, неиндексируемый поиск по подстроке
+        condition = Q()
+        for token in tokens:
+            condition &= Q(name__icontains=token) | Q(phone__icontains=token) | Q(info__icontains=token)
+        return queryset.filter(condition)
+    return queryset.filter(id__in=RawSQL(
+        f"SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s",
+        [match_expression([[t] for t in tokens])],
+    ))
+
+
+def search_patients(query, limit=20):
+    """Визиты по поисковой строке в порядке релевантности."""
+    if not is_supported():
+        return list(filter_patients(Patient.objects.all(), query)[:limit])
+    ids = search_ids(query, limit)
+    patients = Patient.objects.select_related('doctor', 'department').in_bulk(ids)
+    return [patients[i] for i in ids if i in patients]
@@ -0,0 +1,348 @@
+import multiprocessing
+import random
+from bisect import bisect
+from contextlib import contextmanager
+from datetime import date, datetime, time, timedelta
+from itertools import accumulate
+
+from django.contrib.auth.hashers import make_password
+from django.db import connection, transaction
+from django.utils import timezone
+
+from .cache import bump_version, PATIENT_DATA
+from .models import (
+    UserProfile, Admin, Receptionist, Doctor, Department, JobTitle, Room, ServiceType,
+    Patient, PatientCard, DailyRevenueRollup, normalize_name,
+)
+from .rollup import rebuild_rollup
+from . import changes, search
+
+
+# Генератор синтетических данных (management-команда seed_data, бенчмарк).
+#
+# Визиты генерируются кусками по CHUNK_VISITS в отдельных процессах и пишутся
+# в базу одним executemany на кусок, минуя модели. Каждый кусок использует свой
+# random.Random(seed, номер куска), поэтому данные не зависят от числа процессов.
+
+PASSWORD = 'password123'
+ADMIN_EMAIL = 'admin@seed.local'
+
+CHUNK_VISITS = 10_000
+
+FIRST_NAMES = {
+    'male': ['Асан', 'Үсөн', 'Бакыт', 'Нурлан', 'Эрлан', 'Азамат', 'Данияр', 'Тимур', 'Максат', 'Улан',
+             'Адилет', 'Бекзат', 'Жоомарт', 'Канат', 'Марат', 'Руслан', 'Сыймык', 'Талант', 'Эмир', 'Арген'],
+    'female': ['Айгуль', 'Айпери', 'Жылдыз', 'Гулзат', 'Назира', 'Бермет', 'Мээрим', 'Айжан', 'Динара', 'Асель',
+               'Чолпон', 'Элнура', 'Каныкей', 'Нургуль', 'Салтанат', 'Алина', 'Айдана', 'Бегимай', 'Сезим', 'Толгонай'],
+}
+LAST_NAMES = ['Асанов', 'Токтогулов', 'Садыков', 'Абдыкадыров', 'Жумабеков', 'Мамытов', 'Осмонов', 'Кадыров',
+              'Исаков', 'Бакиев', 'Алиев', 'Турдубаев', 'Ибраимов', 'Орозбеков', 'Эсенов', 'Шарипов',
+              'Калыков', 'Маматов', 'Сатыбалдиев', 'Омуралиев', 'Ким', 'Иванов', 'Петров', 'Сидоров']
+PHONE_PREFIXES = ['700', '701', '702', '705', '707', '550', '555', '557', '770', '775', '777', '220', '222']
+COMPLAINTS = ['Головная боль', 'Боль в спине', 'Повторный осмотр', 'Контроль анализов', 'Кашель',
+              'Давление', 'Справка', 'Консультация', 'Боль в горле', 'Плановый осмотр']
+
+DEPARTMENTS = [('Therapy', 'Терапия'), ('Cardiology', 'Кардиология'), ('Neurology', 'Неврология'),
+               ('Pediatrics', 'Педиатрия'), ('Dentistry', 'Стоматология'), ('Surgery', 'Хирургия'),
+               ('Ophthalmology', 'Офтальмология'), ('Gynecology', 'Гинекология'), ('Urology', 'Урология'),
+               ('Dermatology', 'Дерматология'), ('Endocrinology', 'Эндокринология'), ('Radiology', 'Рентгенология')]
+JOB_TITLES = [('Doctor', 'Врач'), ('Senior doctor', 'Старший врач'), ('Head of department', 'Заведующий'),
+              ('Resident', 'Ординатор'), ('Consultant', 'Консультант'), ('Nurse', 'Медсестра')]
+SERVICES = [('Consultation', 'Консультация'), ('Repeat consultation', 'Повторная консультация'),
+            ('Examination', 'Обследование'), ('Procedure', 'Процедура'), ('Ultrasound', 'УЗИ'),
+            ('Analysis', 'Анализ'), ('Treatment', 'Лечение'), ('Certificate', 'Справка')]
+
+# приём с 8 до 19, пики утром и после обеда
+HOUR_WEIGHTS = {8: 4, 9: 9, 10: 12, 11: 11, 12: 6, 13: 4, 14: 8, 15: 10, 16: 9, 17: 6, 18: 3}
+# понедельник..воскресенье
+WEEKDAY_WEIGHTS = [10, 9, 9, 9, 8, 4, 1]
+# скидка у части визитов, в процентах от цены услуги
+DISCOUNT_SHARE = 0.2
+DISCOUNT_PERCENTS = [5, 10, 15, 20, 30]
+
+PATIENT_COLUMNS = [
+    'name', 'phone', 'service_type', 'birthday', 'department', 'registrar', 'appointment_date', 'gender',
+    'doctor', 'payment_type', 'patient_status', 'with_discount', 'created_date', 'primary_patient', 'info', 'card',
+]
+CARD_COLUMNS = ['id', 'name', 'name_key', 'phone', 'created_date']
+
+
+def insert_rows(model, field_names, rows):
+    """INSERT без моделей; значения уже в формате базы (adapt_*field_value, get_db_prep_save)."""
+    fields = [model._meta.get_field(name) for name in field_names]
+    quote = connection.ops.quote_name
+    sql = 'INSERT INTO {} ({}) VALUES ({})'.format(
+        quote(model._meta.db_table),
+        ', '.join(quote(field.column) for field in fields),
+        ', '.join(['%s'] * len(fields)),
+    )
+    with connection.cursor() as cursor:
+        cursor.executemany(sql, rows)
+
+
+def bulk_create_users(model, users, password, batch_size=1000):
+    """
+    bulk_create для наследников UserProfile: Django не умеет bulk_create для
+    multi-table inheritance, поэтому строки UserProfile создаются bulk_create,
+    а строки дочерней таблицы — одним INSERT с их id.
+    """
+    parent_fields = [f for f in UserProfile._meta.concrete_fields if not f.primary_key]
+    for user in users:
+        user.password = password
+    parents = UserProfile.objects.bulk_create(
+        [UserProfile(**{f.attname: getattr(user, f.attname) for f in parent_fields}) for user in users],
+        batch_size=batch_size,
+    )
+    child_fields = model._meta.local_concrete_fields
+    for user, parent in zip(users, parents):
+        user.id = user.pk = parent.pk
+    insert_rows(model, [f.name for f in child_fields], [
+        [f.get_db_prep_save(getattr(user, f.attname), connection) for f in child_fields] for user in users
+    ])
+    return users
+
+
+def localized(pairs, count):
+    """count названий (en, ru) из списка, с номером при повторе."""
+    result = []
+    for i in range(count):
+        en, ru = pairs[i % len(pairs)]
+        suffix = f' {i // len(pairs) + 1}' if i >= len(pairs) else ''
+        result.append((en + suffix, ru + suffix))
+    return result
+
+
+def reuse_or_create(model, key, objects, create=None):
+    """
+    Объекты, для которых в базе уже есть строка с тем же key (уникальное поле),
+    берутся из базы — seed_data --keep поверх заполненной базы; остальные создаются.
+    """
+    existing = model.objects.in_bulk([getattr(obj, key) for obj in objects], field_name=key)
+    new = [obj for obj in objects if getattr(obj, key) not in existing]
+    created = iter((create or model.objects.bulk_create)(new) if new else ())
+    return [existing.get(getattr(obj, key)) or next(created) for obj in objects]
+
+
+def seed_reference(rnd, password, departments, job_titles, rooms, services, receptionists, doctors):
+    departments = reuse_or_create(Department, 'department_name_ru', [
+        Department(department_name_en=en, department_name_ru=ru) for en, ru in localized(DEPARTMENTS, departments)
+    ])
+    job_titles = reuse_or_create(JobTitle, 'job_title_ru', [
+        JobTitle(job_title_en=en, job_title_ru=ru) for en, ru in localized(JOB_TITLES, job_titles)
+    ])
+    rooms = reuse_or_create(Room, 'room_number', [Room(room_number=100 + i) for i in range(rooms)])
+    # у отделения, которое уже есть в базе, остаются его услуги
+    stocked = set(ServiceType.objects.filter(department__in=departments).values_list('department_id', flat=True))
+    new_services = [
+        ServiceType(department=department, type_en=en, type_ru=ru, price=rnd.randrange(500, 5001, 50))
+        for department in departments
+        for en, ru in localized(SERVICES, services)
+    ]
+    ServiceType.objects.bulk_create(service for service in new_services if service.department_id not in stocked)
+    services = list(ServiceType.objects.filter(department__in=departments).order_by('id'))
+
+    reuse_or_create(Admin, 'username', [
+        Admin(username='seed-admin', email=ADMIN_EMAIL, user_role='admin', is_staff=True, is_superuser=True),
+    ], lambda users: bulk_create_users(Admin, users, password))
+    receptionists = reuse_or_create(Receptionist, 'username', [
+        Receptionist(username=f'receptionist{i}', email=f'receptionist{i}@seed.local', user_role='receptionist',
+                     first_name=rnd.choice(FIRST_NAMES['female']), last_name=rnd.choice(LAST_NAMES))
+        for i in range(receptionists)
+    ], lambda users: bulk_create_users(Receptionist, users, password))
+    doctors = reuse_or_create(Doctor, 'username', [
+        Doctor(username=f'doctor{i}', email=f'doctor{i}@seed.local', user_role='doctor',
+               first_name=rnd.choice(FIRST_NAMES['male'] + FIRST_NAMES['female']), last_name=rnd.choice(LAST_NAMES),
+               department=departments[i % len(departments)], job_title=rnd.choice(job_titles),
+               room=rooms[i % len(rooms)], bonus=rnd.randrange(5, 41, 5))
+        for i in range(doctors)
+    ], lambda users: bulk_create_users(Doctor, users, password))
+    return doctors, receptionists, services
+
+
+class VisitGenerator:
+    """
+    Визиты одного куска: люди с повторными визитами (чаще всего к тому же врачу),
+    запись по часам приёма, скидки у части визитов, статус по дате визита.
+    Первый по времени визит человека — первичный (primary_patient).
+    """
+
+    def __init__(self, seed, doctors, services, receptionists, start, days, now, card_base):
+        self.seed = seed
+        self.doctors = doctors  # [(id, department_id)]
+        self.services = services  # {department_id: [(id, price)]}
+        self.receptionists = receptionists
+        self.start = start
+        self.days = days
+        self.now = now
+        self.card_base = card_base
+        self.hours = list(HOUR_WEIGHTS)
+        self.hour_weights = list(accumulate(HOUR_WEIGHTS.values()))
+        self.weekday_weights = list(accumulate(WEEKDAY_WEIGHTS))
+
+    def appointment(self, rnd, day):
+        hour = self.hours[bisect(self.hour_weights, rnd.random() * self.hour_weights[-1])]
+        return self.start + timedelta(days=day, hours=hour, minutes=rnd.choice((0, 15, 30, 45)))
+
+    def first_day(self, rnd):
+        # будни загружены сильнее выходных
+        while True:
+            day = rnd.randrange(self.days)
+            weekday = (self.start + timedelta(days=day)).weekday()
+            if rnd.random() * WEEKDAY_WEIGHTS[0] < WEEKDAY_WEIGHTS[weekday]:
+                return day
+
+    def status(self, rnd, moment):
+        if moment > self.now:
+            return 'pre-registration' if rnd.random() < 0.85 else 'waiting'
+        if moment.date() == self.now.date():
+            return rnd.choice(['waiting', 'had an appointment'])
+        return 'canceled' if rnd.random() < 0.12 else 'had an appointment'
+
+    def __call__(self, chunk_and_size):
+        chunk, size = chunk_and_size
+        rnd = random.Random(f'{self.seed}:{chunk}')
+        # значения сразу в формате базы: адаптер берётся один раз на кусок
+        ops = connection.ops
+        today = ops.adapt_datefield_value(self.now.date())
+        visits, cards = [], []
+        person = 0
+        while len(visits) < size:
+            card_id = self.card_base + chunk * CHUNK_VISITS + person
+            gender = rnd.choice(('male', 'female'))
+            last_name = rnd.choice(LAST_NAMES)
+            if gender == 'female':
+                last_name += 'а'
+            name = f'{rnd.choice(FIRST_NAMES[gender])} {last_name}'
+            # номер выводится из id карточки — телефоны разных людей не совпадают
+            number = card_id % (len(PHONE_PREFIXES) * 1_000_000)
+            phone = f'+996{PHONE_PREFIXES[number % len(PHONE_PREFIXES)]}{number // len(PHONE_PREFIXES):06d}'
+            birthday = ops.adapt_datefield_value(date(1940, 1, 1) + timedelta(days=rnd.randrange(80 * 365)))
+            doctor_id, department_id = rnd.choice(self.doctors)
+            # сколько раз человек приходил: чаще один-два, иногда десятки
+            count = min(1 + int(rnd.expovariate(1 / 1.6)), 30, size - len(visits))
+
+            day = self.first_day(rnd)
+            moments = []
+            for _ in range(count):
+                if day >= self.days:
+                    break
+                moments.append(self.appointment(rnd, day))
+                day += rnd.randint(3, 60)
+            for index, moment in enumerate(moments):
+                if rnd.random() < 0.25:
+                    doctor_id, department_id = rnd.choice(self.doctors)
+                service_id, price = rnd.choice(self.services[department_id])
+                discount = None
+                if rnd.random() < DISCOUNT_SHARE:
+                    discount = price * (100 - rnd.choice(DISCOUNT_PERCENTS)) // 100
+                visits.append((
+                    name, phone, service_id, birthday, department_id, rnd.choice(self.receptionists),
+                    ops.adapt_datetimefield_value(moment), gender, doctor_id,
+                    'card' if rnd.random() < 0.4 else 'cash', self.status(rnd, moment), discount,
+                    today if moment > self.now else ops.adapt_datefield_value(moment.date()), index == 0,
+                    rnd.choice(COMPLAINTS) if rnd.random() < 0.3 else None, card_id,
+                ))
+            if moments:
+                cards.append((card_id, name, normalize_name(name), phone, ops.adapt_datefield_value(moments[0].date())))
+            person += 1
+        return cards, visits
+
+
+def seed(patients, doctors=30, receptionists=10, departments=10, job_titles=6, rooms=20, services=5,
+         days=365, future_days=14, workers=1, seed=42, password=PASSWORD, stdout=None):
+    """
+    Справочники, пользователи и patients визитов за days дней до сегодня и future_days после.
+    Визиты добавляются к существующим; для чистой базы см. clear().
+    """
+    rnd = random.Random(seed)
+    # один хэш на всех пользователей: PBKDF2 на каждого — это секунды на сотню пользователей
+    password = make_password(password)
+    doctors, receptionists, services = seed_reference(
+        rnd, password, departments, job_titles, rooms, services, receptionists, doctors,
+    )
+
+    services_by_department = {}
+    for service in services:
+        services_by_department.setdefault(service.department_id, []).append((service.id, service.price))
+    now = timezone.localtime()
+    start = timezone.make_aware(datetime.combine(now.date() - timedelta(days=days), time()))
+    last_card = PatientCard.objects.order_by('-id').values_list('id', flat=True).first() or 0
+    generator = VisitGenerator(
+        seed, [(d.id, d.department_id) for d in doctors], services_by_department,
+        [r.id for r in receptionists], start, days + future_days, now, last_card + 1,
+    )
+    chunks = [(i, min(CHUNK_VISITS, patients - i * CHUNK_VISITS)) for i in range(-(-patients // CHUNK_VISITS))]
+
+    # индексы визитов пересоздаются после загрузки, если она хотя бы удваивает таблицу
+    with bulk_load(drop_indexes=patients >= Patient.objects.count()):
+        if workers > 1:
+            with multiprocessing.get_context('fork').Pool(workers) as pool:
+                write_chunks(pool.imap(generator, chunks), patients, stdout)
+        else:
+            write_chunks(map(generator, chunks), patients, stdout)
+
+    rebuild_rollup()
+    bump_version(PATIENT_DATA)
+    changes.bump_existing()
+
+
+@contextmanager
+def bulk_load(drop_indexes=False):
+    """
+    Массовая загрузка визитов в SQLite: без триггеров полнотекстового индекса
+    (он пересобирается один раз в конце) и, если drop_indexes, без индексов
+    crm_med_patient — построить индекс заново быстрее, чем обновлять его на
+    каждую вставку. На других базах ничего не меняет.
+    """
+    if not search.is_supported(connection):
+        yield
+        return
+    indexes = []
+    search.drop_triggers(connection)
+    try:
+        if drop_indexes:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "SELECT name, sql FROM sqlite_master WHERE type = 'index' AND tbl_name = %s AND sql IS NOT NULL",
+                    [Patient._meta.db_table],
+                )
+                indexes = cursor.fetchall()
+                for name, _ in indexes:
+                    cursor.execute(f'DROP INDEX {connection.ops.quote_name(name)}')
+        yield
+    finally:
+        with connection.cursor() as cursor:
+            for _, sql in indexes:
+                cursor.execute(sql)
+        search.install(connection, rebuild=True)
+
+
+def write_chunks(chunks, total, stdout):
+    written = 0
+    for cards, visits in chunks:
+        with transaction.atomic():
+            insert_rows(PatientCard, CARD_COLUMNS, cards)
+            insert_rows(Patient, PATIENT_COLUMNS, visits)
+        written += len(visits)
+        if stdout:
+            stdout.write(f"Visits: {written}/{total}")
+
+
+def clear():
+    """Удаляет визиты, карточки, справочники и врачей/регистраторов (администраторы остаются)."""
+    quote = connection.ops.quote_name
+    # без проверки внешних ключей SQLite очищает таблицу целиком, а не построчно
+    with bulk_load(), connection.constraint_checks_disabled():
+        with transaction.atomic(), connection.cursor() as cursor:
+            # визиты — одним DELETE: delete() через ORM отправил бы сигнал на каждую строку
+            for model in (Patient, PatientCard, DailyRevenueRollup):
+                cursor.execute(f'DELETE FROM {quote(model._meta.db_table)}')
+            Doctor.objects.all().delete()
+            Receptionist.objects.all().delete()
+            Admin.objects.filter(email=ADMIN_EMAIL).delete()
+            ServiceType.objects.all().delete()
+            Room.objects.all().delete()
+            JobTitle.objects.all().delete()
+            Department.objects.all().delete()
+    bump_version(PATIENT_DATA)
+    changes.bump_existing()
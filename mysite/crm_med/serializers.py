@@ -1,5 +1,6 @@
 from datetime import timedelta
 from django.utils.dateparse import parse_date
+from django.db import transaction
 from rest_framework import serializers
 from rest_framework.response import Response
 from rest_framework import status
@@ -9,6 +10,9 @@ from rest_framework_simplejwt.tokens import RefreshToken
 from django.contrib.auth import authenticate
 from django.contrib.auth import get_user_model
 from django_rest_passwordreset.models import ResetPasswordToken
+from .signals import patients_bulk_changed
+from .authentication import add_claims
+from .reports import visit_price
 
 
 User = get_user_model()
@@ -37,7 +41,8 @@ class LoginSerializer(serializers.Serializer):
 
     def to_representation(self, instance):
         user = self.context['user']
-        refresh = RefreshToken.for_user(user)
+        # роль в токене: ClaimsJWTAuthentication не загружает пользователя на каждый запрос
+        refresh = add_claims(RefreshToken.for_user(user), user)
 
         return {
             'user': {
@@ -110,6 +115,22 @@ class DoctorNotificationSerializer(serializers.ModelSerializer):
         fields = ['id', 'name', 'appointment_date', 'department', 'registrar']
 
 
+class DoctorNotificationEventSerializer(serializers.ModelSerializer):
+    """Событие ленты; patient — визит, если он ещё у этого доктора (context['patients'])."""
+    cursor = serializers.IntegerField(source='id')
+    patient = serializers.SerializerMethodField()
+
+    class Meta:
+        model = DoctorNotificationEvent
+        fields = ['cursor', 'kind', 'created_at', 'patient_id', 'patient']
+
+    def get_patient(self, obj):
+        patient = self.context['patients'].get(obj.patient_id)
+        if patient is None or patient.doctor_id != obj.doctor_id:
+            return None
+        return DoctorNotificationSerializer(patient).data
+
+
 class DoctorListSerializer(serializers.ModelSerializer):
     department = DepartmentNameSerializer()
     job_title = JobTitleSerializer()
@@ -181,6 +202,78 @@ class PatientCreateSerializer(serializers.ModelSerializer):
                   'with_discount']
 
 
+class PreloadedRelatedField(serializers.PrimaryKeyRelatedField):
+    """
+    PrimaryKeyRelatedField, который берёт объект из context['preloaded'][model] = {pk: obj},
+    а не делает запрос на каждую строку. Без предзагрузки работает как обычно.
+    """
+
+    def to_internal_value(self, data):
+        preloaded = self.context.get('preloaded', {}).get(self.get_queryset().model)
+        if preloaded is None:
+            return super().to_internal_value(data)
+        if isinstance(data, bool):
+            self.fail('incorrect_type', data_type=type(data).__name__)
+        try:
+            return preloaded[int(data)]
+        except KeyError:
+            self.fail('does_not_exist', pk_value=data)
+        except (TypeError, ValueError):
+            self.fail('incorrect_type', data_type=type(data).__name__)
+
+
+class PatientBulkCreateListSerializer(serializers.ListSerializer):
+    def to_internal_value(self, data):
+        if isinstance(data, list):
+            self._context['preloaded'] = self.preload_related(data)
+        return super().to_internal_value(data)
+
+    def preload_related(self, rows):
+        """Все объекты, на которые ссылаются строки, — по одному in_bulk на модель."""
+        preloaded = {}
+        for name, field in self.child.fields.items():
+            if field.read_only or not isinstance(field, PreloadedRelatedField):
+                continue
+            ids = {
+                int(row[name]) for row in rows
+                if isinstance(row, dict) and str(row.get(name, '')).isdigit()
+            }
+            queryset = field.get_queryset()
+            preloaded[queryset.model] = queryset.in_bulk(ids)
+        return preloaded
+
+    def create(self, validated_data):
+        with transaction.atomic():
+            cards = PatientCard.objects.for_visits((row['name'], row['phone']) for row in validated_data)
+            patients = [Patient(**row) for row in validated_data]
+
+            # первичный — самый ранний визит пачки у карточки без прежних визитов
+            seen = set()
+            for patient in sorted(patients, key=lambda p: p.appointment_date):
+                key = (normalize_name(patient.name), str(patient.phone))
+                patient.card = cards[key]
+                patient.primary_patient = key not in seen and not patient.card.has_visits
+                seen.add(key)
+
+            patients = Patient.objects.bulk_create(patients)
+            patients_bulk_changed.send(sender=Patient, patients=patients, created=True)
+        return patients
+
+
+class PatientBulkCreateSerializer(PatientCreateSerializer):
+    serializer_related_field = PreloadedRelatedField
+
+    class Meta(PatientCreateSerializer.Meta):
+        fields = ['id', 'card', 'primary_patient'] + PatientCreateSerializer.Meta.fields
+        read_only_fields = ['card', 'primary_patient']
+        list_serializer_class = PatientBulkCreateListSerializer
+
+
+class PatientStatusBulkSerializer(serializers.Serializer):
+    ids = serializers.ListField(child=serializers.IntegerField(min_value=1), allow_empty=False, max_length=500)
+    patient_status = serializers.ChoiceField(choices=PATIENT_STATUS_CHOICES)
+
+
 class PatientHistoryAppointmentSerializer(serializers.ModelSerializer):
     registrar = ReceptionistNameSerializer()
     department = DepartmentNameSerializer()
@@ -210,9 +303,7 @@ class PatientHistoryPaymentSerializer(serializers.ModelSerializer):
                   'appointment_date', 'payment_type_display', 'price']
 
     def get_price(self, obj):
-        if obj.with_discount:
-            return obj.with_discount
-        return obj.service_type.price
+        return visit_price(obj)
 
 
 class PatientInfoSerializer(serializers.ModelSerializer):
@@ -220,7 +311,19 @@ class PatientInfoSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Patient
-        fields = ['id', 'name', 'phone', 'gender_display', 'info']
+        fields = ['id', 'name', 'phone', 'gender_display', 'info', 'card']
+
+
+class PatientSearchSerializer(serializers.ModelSerializer):
+    doctor = DoctorNameSerializer()
+    department = DepartmentNameSerializer()
+    appointment_date = serializers.DateTimeField(format='%d-%m-%Y %H:%M')
+    patient_status_display = serializers.CharField(source='get_patient_status_display', read_only=True)
+
+    class Meta:
+        model = Patient
+        fields = ['id', 'card', 'name', 'phone', 'appointment_date', 'department', 'doctor',
+                  'patient_status_display', 'info']
 
 
 class PatientListSerializer(serializers.ModelSerializer):
@@ -235,9 +338,7 @@ class PatientListSerializer(serializers.ModelSerializer):
                   'payment_type_display', 'price']
 
     def get_price(self, obj):
-        if obj.with_discount:
-            return obj.with_discount
-        return obj.service_type.price
+        return visit_price(obj)
 
 
 class DepartmentPatientSerializer(serializers.ModelSerializer):
@@ -271,9 +372,7 @@ class ReportPatientSerializer(serializers.ModelSerializer):
         fields = ['id', 'name', 'appointment_date', 'price']
 
     def get_price(self, obj):
-        if obj.with_discount:
-            return obj.with_discount
-        return obj.service_type.price
+        return visit_price(obj)
 
 
 class ReportDoctorSerializer(serializers.ModelSerializer):
@@ -285,7 +384,7 @@ class ReportDoctorSerializer(serializers.ModelSerializer):
         fields = ['id', 'name', 'appointment_date', 'price']
 
     def get_price(self, obj):
-        return obj.with_discount if obj.with_discount else obj.service_type.price
+        return visit_price(obj)
 
 
 class DoctorBonusSerializer(serializers.ModelSerializer):
@@ -309,11 +408,11 @@ class ReportExactSerializer(serializers.ModelSerializer):
                   'doctor']
 
     def get_price(self, obj):
-        return '-' if obj.with_discount else obj.service_type.price
+        return '-' if obj.with_discount is not None else obj.service_type.price
 
     def get_discount_price(self, obj):
         discount_price = obj.with_discount
-        return discount_price if discount_price else '-'
+        return discount_price if discount_price is not None else '-'
 
 
 class ReportSummarySerializer(serializers.SerializerMethodField):
@@ -1,7 +1,19 @@
 import random
-from django.core.mail import send_mail
 from django_rest_passwordreset.signals import reset_password_token_created
-from django.dispatch import receiver
+from django.dispatch import receiver, Signal
+from django.db import connections, transaction
+from django.utils import timezone
+from django.db.models.signals import pre_save, post_save, post_delete, post_migrate
+from .models import Patient, ServiceType, Doctor, Receptionist, UserProfile, Department, JobTitle, Room
+from . import changes, live, notifications, outbox, rollup, search
+from .cache import bump_version_on_commit, PATIENT_DATA, REFERENCE_DATA
+from .authentication import forget_user_state
+
+
+# bulk_create() и queryset.update() не отправляют post_save — код, который
+# массово создаёт или меняет визиты, отправляет этот сигнал с patients=[...]
+# (и created=True для новых визитов)
+patients_bulk_changed = Signal()
 
 
 @receiver(reset_password_token_created)
@@ -16,11 +28,152 @@ def password_reset_token_created(sender, instance, reset_password_token, *args,
     # Текст сообщения
     email_plaintext_message = f"Ваш код для сброса пароля: {reset_code}"
 
-    # Отправка email
-    send_mail(
+    # Письмо в очередь: SMTP не задерживает ответ (crm_med/outbox.py)
+    outbox.enqueue(
         "Сброс пароля",  # Тема письма
         email_plaintext_message,  # Текст письма
-        "noreply@somehost.local",  # От кого
         [reset_password_token.user.email],  # Список получателей
-        fail_silently=False,
-    )
\ No newline at end of file
+        "noreply@somehost.local",  # От кого
+    )
+
+
+@receiver(pre_save, sender=Patient)
+def remember_previous_patient(sender, instance, raw=False, **kwargs):
+    # состояние визита до сохранения: нужно, чтобы вычесть его из сводных данных
+    instance._previous = None
+    if instance.pk and not raw:
+        instance._previous = Patient.objects.select_related('service_type', 'doctor').filter(pk=instance.pk).first()
+
+
+@receiver(post_save, sender=Patient)
+def patient_saved(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    previous = getattr(instance, '_previous', None)
+    rollup.patient_changed(instance, previous)
+    bump_version_on_commit(PATIENT_DATA)
+    # при переносе визита меняются ленты и прежнего доктора / отделения
+    changes.bump(changes.patient_scopes([instance, previous] if previous else [instance]))
+
+    live.queue_changes(live.patient_changes(instance, previous))
+
+    if previous is None:
+        notifications.record([(instance.doctor_id, instance.pk, notifications.ASSIGNED)])
+    elif previous.doctor_id != instance.doctor_id:
+        notifications.record([
+            (previous.doctor_id, instance.pk, notifications.UNASSIGNED),
+            (instance.doctor_id, instance.pk, notifications.ASSIGNED),
+        ])
+
+
+@receiver(post_delete, sender=Patient)
+def patient_deleted(sender, instance, **kwargs):
+    rollup.patient_deleted(instance)
+    bump_version_on_commit(PATIENT_DATA)
+    changes.bump(changes.patient_scopes([instance]))
+    notifications.record([(instance.doctor_id, instance.pk, notifications.UNASSIGNED)])
+    live.queue_changes([(live.DELETED, instance.pk, instance.department_id, instance.appointment_date, None)])
+
+
+@receiver(pre_save, sender=ServiceType)
+def remember_previous_price(sender, instance, raw=False, **kwargs):
+    instance._previous_price = None
+    if instance.pk and not raw:
+        instance._previous_price = ServiceType.objects.filter(pk=instance.pk).values_list('price', flat=True).first()
+
+
+@receiver(post_save, sender=ServiceType)
+def service_type_saved(sender, instance, raw=False, **kwargs):
+    bump_version_on_commit(PATIENT_DATA)
+    previous_price = getattr(instance, '_previous_price', None)
+    if previous_price is not None and previous_price != instance.price:
+        # цена услуги входит в выручку всех её визитов — пересчитываем затронутых докторов
+        doctor_ids = Patient.objects.filter(service_type=instance).values_list('doctor_id', flat=True).distinct()
+        rollup.rebuild_rollup(doctor_ids=list(doctor_ids))
+
+
+@receiver(pre_save, sender=Doctor)
+def remember_previous_bonus(sender, instance, raw=False, **kwargs):
+    instance._previous_bonus = None
+    if instance.pk and not raw:
+        instance._previous_bonus = Doctor.objects.filter(pk=instance.pk).values_list('bonus', flat=True).first()
+
+
+@receiver(post_save, sender=Doctor)
+def doctor_saved(sender, instance, raw=False, **kwargs):
+    bump_version_on_commit(PATIENT_DATA)
+    previous_bonus = getattr(instance, '_previous_bonus', None)
+    if previous_bonus is not None and previous_bonus != instance.bonus:
+        rollup.rebuild_rollup(doctor_ids=[instance.pk])
+
+
+@receiver(post_delete, sender=ServiceType)
+@receiver(post_delete, sender=Doctor)
+def reference_deleted(sender, instance, **kwargs):
+    # названия услуг и бонусы докторов входят в ответы отчётов
+    bump_version_on_commit(PATIENT_DATA)
+
+
+@receiver(post_save, sender=Department)
+@receiver(post_save, sender=JobTitle)
+@receiver(post_save, sender=Room)
+@receiver(post_save, sender=ServiceType)
+@receiver(post_delete, sender=Department)
+@receiver(post_delete, sender=JobTitle)
+@receiver(post_delete, sender=Room)
+@receiver(post_delete, sender=ServiceType)
+def reference_data_changed(sender, instance, raw=False, **kwargs):
+    # списки отделений, должностей, кабинетов и услуг (ReferenceDataMixin)
+    if not raw:
+        bump_version_on_commit(REFERENCE_DATA)
+
+
+@receiver(post_save, sender=Doctor)
+@receiver(post_save, sender=Receptionist)
+@receiver(post_delete, sender=Doctor)
+@receiver(post_delete, sender=Receptionist)
+def profile_changed(sender, instance, raw=False, update_fields=None, **kwargs):
+    # имена докторов и регистраторов входят в ленты визитов (ChangeCounterETagMixin)
+    if raw or (update_fields and set(update_fields) <= {'last_login'}):
+        return
+    changes.bump([changes.PROFILES_SCOPE])
+
+
+@receiver(post_save)
+@receiver(post_delete)
+def user_changed(sender, instance, **kwargs):
+    # кэш состояния пользователя для ClaimsJWTAuthentication: отключение, смена роли
+    # или пароля действуют сразу, а не через AUTH_USER_STATE_TIMEOUT
+    if isinstance(instance, UserProfile):
+        transaction.on_commit(lambda: forget_user_state(instance.pk))
+
+
+@receiver(post_migrate)
+def install_patient_search(sender, using='default', **kwargs):
+    # миграции не хранятся в репозитории, поэтому FTS-таблица и триггеры
+    # создаются здесь, после каждого migrate (идемпотентно)
+    if sender.name != 'crm_med':
+        return
+    connection = connections[using]
+    if search.is_supported(connection):
+        search.install(connection)
+
+
+@receiver(patients_bulk_changed)
+def patients_bulk_changed_refresh(sender, patients, created=False, **kwargs):
+    # пересчитываем сводную таблицу за затронутые дни и докторов одним проходом
+    if not patients:
+        return
+    rollup.rebuild_rollup(
+        dates={timezone.localtime(patient.appointment_date).date() for patient in patients},
+        doctor_ids={patient.doctor_id for patient in patients},
+    )
+    bump_version_on_commit(PATIENT_DATA)
+    changes.bump(changes.patient_scopes(patients))
+    if created:
+        notifications.record([(patient.doctor_id, patient.pk, notifications.ASSIGNED) for patient in patients])
+    kind = live.CREATED if created else live.UPDATED
+    live.queue_changes([
+        (kind, patient.pk, patient.department_id, patient.appointment_date, None if created else patient.appointment_date)
+        for patient in patients
+    ])
@@ -1,3 +1,1833 @@
-from django.test import TestCase
+import asyncio
+import io
+import json
+import os
+import random
+import re
+import smtplib
+import tempfile
+import time
+from datetime import datetime, timedelta
+from urllib.parse import urlencode
+from unittest import mock, skipUnless
+
+from django.core import mail
+from django.core.management import call_command
+from django.db.models import Count, Q, Sum, Value
+from django.db.models.functions import Coalesce
+from django.db import connection, transaction
+from asgiref.sync import async_to_sync, sync_to_async
+from asgiref.testing import ApplicationCommunicator
+from django.test import AsyncClient, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse, resolve
+from django.utils import timezone, translation
+from rest_framework import generics
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import RefreshToken
+import openpyxl
+
+from .models import *
+from .cache import get_cache, bump_version, cache_stats, record, PATIENT_DATA
+from .authentication import add_claims
+from .reports import analysis_buckets, day_bounds, ANALYSIS_PERIODS
+from .rollup import rebuild_rollup
+from .views import DoctorListAPIView
+from . import benchmark, changes, live, metrics, notifications, outbox, search, seeding
+from .serializers import CalendarReport
+from mysite import asgi
+from . import urls as crm_urls
+
+
+class CrmTestCase(TestCase):
+    """
+    Базовый набор справочников и генератор пациентов для тестов.
+    Данные детерминированы через random.Random(seed).
+    """
+    seed = 42
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.rnd = random.Random(cls.seed)
+        cls.departments = [Department.objects.create(department_name=f'Department {i}') for i in range(3)]
+        cls.job_titles = [JobTitle.objects.create(job_title=f'Job {i}') for i in range(2)]
+        cls.rooms = [Room.objects.create(room_number=100 + i) for i in range(3)]
+        cls.services = [
+            ServiceType.objects.create(department=department, type=f'Service {i}', price=cls.rnd.randint(500, 5000))
+            for department in cls.departments for i in range(3)
+        ]
+        cls.admin = Admin.objects.create(username='admin', email='admin@test.local', user_role='admin')
+        cls.receptionist = Receptionist.objects.create(
+            username='receptionist', email='receptionist@test.local', user_role='receptionist'
+        )
+        cls.doctors = [
+            Doctor.objects.create(
+                username=f'doctor{i}', email=f'doctor{i}@test.local', user_role='doctor',
+                department=cls.departments[i % len(cls.departments)],
+                job_title=cls.job_titles[i % len(cls.job_titles)],
+                room=cls.rooms[i % len(cls.rooms)],
+                bonus=cls.rnd.randint(5, 60),
+            )
+            for i in range(4)
+        ]
+
+    @classmethod
+    def make_patients(cls, count, start=None, days=30, **fields):
+        start = start or timezone.now() - timedelta(days=days)
+        patients = []
+        for i in range(count):
+            doctor = fields.get('doctor') or cls.rnd.choice(cls.doctors)
+            service = cls.rnd.choice([s for s in cls.services if s.department_id == doctor.department_id])
+            patients.append(Patient(
+                name=fields.get('name') or f'Patient {cls.rnd.randint(1, count)}',
+                phone=f'+996700{cls.rnd.randint(0, 999999):06d}',
+                service_type=service,
+                birthday=datetime(1990, 1, 1).date(),
+                department=doctor.department,
+                registrar=cls.receptionist,
+                appointment_date=start + timedelta(minutes=cls.rnd.randint(0, days * 24 * 60 - 1)),
+                gender=cls.rnd.choice(['male', 'female']),
+                doctor=doctor,
+                payment_type=cls.rnd.choice(['cash', 'card']),
+                patient_status=fields.get('patient_status') or cls.rnd.choice([s for s, _ in PATIENT_STATUS_CHOICES]),
+                with_discount=cls.rnd.choice([None, None, cls.rnd.randint(300, 4000)]),
+                primary_patient=cls.rnd.choice([True, False]),
+            ))
+        patients = Patient.objects.bulk_create(patients)
+        # bulk_create не отправляет сигналы и не вызывает save() — карточки,
+        # сводную таблицу и версию данных обновляем вручную
+        call_command('backfill_patient_cards', stdout=io.StringIO())
+        rebuild_rollup()
+        bump_version(PATIENT_DATA)
+        return patients
+
+    def setUp(self):
+        get_cache().clear()
+
+    def client_for(self, user):
+        client = APIClient()
+        client.force_authenticate(user)
+        return client
+
+
+def legacy_exact_totals(queryset):
+    """Итоги ReportExactAPIView в том виде, в котором они считались до агрегации в SQL."""
+    sum_discount = queryset.aggregate(
+        total=Coalesce(Sum('with_discount', filter=Q(with_discount__isnull=False)), Value(0))
+    )['total']
+    sum_no_discount = queryset.aggregate(
+        total=Coalesce(Sum('service_type__price', filter=Q(with_discount__isnull=True)), Value(0))
+    )['total']
+
+    doctor_earnings = 0
+    total_cash = 0
+    total_card = 0
+    for patient in queryset:
+        # как в When(with_discount__isnull=False) исходного запроса: скидка 0 — бесплатный визит
+        price = patient.with_discount if patient.with_discount is not None else patient.service_type.price
+        doctor_earnings += price * (patient.doctor.bonus or 0) / 100
+        if patient.payment_type == 'cash':
+            total_cash += price
+        else:
+            total_card += price
+
+    return {
+        'sum_discount': sum_discount,
+        'sum_no_discount': sum_no_discount,
+        'doctor_earnings': round(doctor_earnings, 2),
+        'patients_count': queryset.count(),
+        'total_cash': total_cash,
+        'total_card': total_card,
+    }
+
+
+class ReportExactTotalsTests(CrmTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.make_patients(300)
+
+    def test_totals_match_legacy_computation(self):
+        client = self.client_for(self.admin)
+        day = Patient.objects.first().appointment_date.astimezone(timezone.get_current_timezone()).date()
+        cases = [
+            ({}, Patient.objects.all()),
+            ({'doctor': self.doctors[0].id}, Patient.objects.filter(doctor=self.doctors[0])),
+            ({'department': self.departments[1].id}, Patient.objects.filter(department=self.departments[1])),
+            ({'date': day.isoformat()}, Patient.objects.filter(appointment_date__date=day)),
+        ]
+        for params, queryset in cases:
+            with self.subTest(params=params):
+                response = client.get(reverse('report_exact'), {**params, 'page_size': 500})
+                self.assertEqual(response.status_code, 200)
+                expected = legacy_exact_totals(queryset)
+                for key, value in expected.items():
+                    self.assertEqual(response.data[key], value, key)
+                self.assertEqual(len(response.data['patients']), expected['patients_count'])
+
+    def test_zero_discount(self):
+        # make_patients не создаёт скидку 0: бесплатные визиты проверяются отдельно
+        free = list(Patient.objects.order_by('id').values_list('id', flat=True)[:20])
+        Patient.objects.filter(id__in=free).update(with_discount=0)
+        rebuild_rollup()
+        bump_version(PATIENT_DATA)
+        response = self.client_for(self.admin).get(reverse('report_exact'), {'page_size': 500})
+        expected = legacy_exact_totals(Patient.objects.all())
+        for key, value in expected.items():
+            self.assertEqual(response.data[key], value, key)
+        self.assertEqual(
+            response.data['sum_discount'] + response.data['sum_no_discount'],
+            response.data['total_cash'] + response.data['total_card'],
+        )
+        rows = {row['id']: row for row in response.data['patients']}
+        self.assertEqual((rows[free[0]]['price'], rows[free[0]]['discount_price']), ('-', 0))
+
+    def test_totals_use_single_query(self):
+        client = self.client_for(self.admin)
+        # totals + одна страница строк (курсорная пагинация не делает count)
+        with self.assertNumQueries(2):
+            response = client.get(reverse('report_exact'), {'page_size': 20})
+        self.assertEqual(len(response.data['patients']), 20)
+        self.assertEqual(response.data['patients_count'], 300)
+        self.assertIsNotNone(response.data['next'])
+
+
+def legacy_summary(queryset):
+    """Разделение доктор/клиника в том виде, в котором оно считалось циклом по пациентам."""
+    doctor_cash = doctor_card = clinic_cash = clinic_card = 0
+    for patient in queryset:
+        price = patient.with_discount if patient.with_discount is not None else patient.service_type.price
+        doctor_part = price / 100 * patient.doctor.bonus
+        if patient.payment_type == 'cash':
+            doctor_cash += doctor_part
+            clinic_cash += price - doctor_part
+        else:
+            doctor_card += doctor_part
+            clinic_card += price - doctor_part
+    return {
+        'doctor_cash': int(doctor_cash),
+        'doctor_card': int(doctor_card),
+        'clinic_cash': int(clinic_cash),
+        'clinic_card': int(clinic_card),
+        'total_cash': int(doctor_cash + clinic_cash),
+        'total_card': int(doctor_card + clinic_card),
+        'total_clinic': int(clinic_cash + clinic_card),
+        'total_doctor': int(doctor_cash + doctor_card),
+    }
+
+
+class ReportSummaryTests(CrmTestCase):
+    def test_summary_matches_legacy_computation(self):
+        self.make_patients(200)
+        client = self.client_for(self.receptionist)
+        today = timezone.localdate()
+        date_from = (today - timedelta(days=10)).isoformat()
+        cases = [
+            ({}, Patient.objects.all()),
+            ({'date_from': date_from}, Patient.objects.filter(appointment_date__date__gte=date_from)),
+            ({'date_to': date_from}, Patient.objects.filter(appointment_date__date__lte=date_from)),
+        ]
+        for params, queryset in cases:
+            with self.subTest(params=params):
+                response = client.get(reverse('report_summary'), params)
+                self.assertEqual(response.status_code, 200)
+                expected = legacy_summary(queryset)
+                for key, value in expected.items():
+                    # int() от суммы float может отличаться на единицу из-за округления
+                    self.assertAlmostEqual(response.data[key], value, delta=1, msg=key)
+                self.assertEqual(response.data['total_cash'], expected['total_cash'])
+                self.assertEqual(response.data['total_card'], expected['total_card'])
+
+    def test_query_count_does_not_depend_on_rows(self):
+        client = self.client_for(self.admin)
+        for count in (5, 100):
+            self.make_patients(count)
+            with self.assertNumQueries(1):
+                response = client.get(reverse('report_summary'))
+            self.assertEqual(response.status_code, 200)
+
+
+class ExcelExportTests(CrmTestCase):
+    def test_exact_export_streams_rows_and_totals(self):
+        patients = self.make_patients(50)
+        client = self.client_for(self.admin)
+        response = client.get(reverse('report_exact'), {'export': 'excel'})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+
+        workbook = openpyxl.load_workbook(io.BytesIO(b''.join(response.streaming_content)))
+        rows = list(workbook.active.values)
+        self.assertEqual(len(rows), 1 + 50 + 3)
+        self.assertEqual(rows[-2][1], 50)
+        self.assertEqual(rows[-1][1], sum(p.with_discount or p.service_type.price for p in patients))
+
+    def test_doctor_export_total(self):
+        doctor = self.doctors[1]
+        patients = self.make_patients(20, doctor=doctor)
+        client = self.client_for(self.receptionist)
+        response = client.get(reverse('report_doctor'), {'export': 'excel', 'doctor': doctor.id})
+        workbook = openpyxl.load_workbook(io.BytesIO(b''.join(response.streaming_content)))
+        rows = list(workbook.active.values)
+        self.assertEqual(rows[-1][3], sum(p.with_discount or p.service_type.price for p in patients))
+
+
+def rollup_snapshot():
+    return sorted(DailyRevenueRollup.objects.values_list(
+        'date', 'doctor_id', 'department_id', 'payment_type', 'patient_status',
+        'patients_count', 'gross', 'discount_sum', 'no_discount_sum', 'doctor_share',
+    ))
+
+
+class RevenueRollupTests(CrmTestCase):
+    def assertRollupConsistent(self):
+        incremental = rollup_snapshot()
+        rebuild_rollup()
+        self.assertEqual(incremental, rollup_snapshot())
+
+    def test_rollup_follows_patient_writes(self):
+        self.make_patients(40)
+        patient = Patient.objects.first()
+        other_doctor = next(d for d in self.doctors if d.id != patient.doctor_id)
+
+        client = self.client_for(self.admin)
+        response = client.post(reverse('patient_create'), {
+            'name': 'New Patient', 'phone': '+996700111222', 'service_type': patient.service_type_id,
+            'birthday': '1990-01-01', 'department': patient.department_id, 'registrar': self.receptionist.id,
+            'appointment_date': timezone.now().isoformat(), 'gender': 'male', 'doctor': patient.doctor_id,
+            'payment_type': 'cash', 'patient_status': 'waiting', 'with_discount': 700,
+        })
+        self.assertEqual(response.status_code, 201)
+        self.assertRollupConsistent()
+
+        patient.doctor = other_doctor
+        patient.payment_type = 'card' if patient.payment_type == 'cash' else 'cash'
+        patient.appointment_date -= timedelta(days=3)
+        patient.save()
+        self.assertRollupConsistent()
+
+        Patient.objects.last().delete()
+        self.assertRollupConsistent()
+
+    def test_rollup_follows_price_and_bonus_changes(self):
+        self.make_patients(40)
+        service = Patient.objects.first().service_type
+        service.price += 100
+        service.save()
+        self.assertRollupConsistent()
+
+        doctor = self.doctors[0]
+        doctor.bonus = 60 if doctor.bonus != 60 else 10
+        doctor.save()
+        self.assertRollupConsistent()
+
+    def test_reports_read_rollup(self):
+        self.make_patients(120)
+        client = self.client_for(self.admin)
+        expected = legacy_summary(Patient.objects.all())
+        with self.assertNumQueries(1):
+            response = client.get(reverse('report_summary'))
+        self.assertEqual(response.data['total_cash'], expected['total_cash'])
+
+        doctor = self.doctors[2]
+        response = client.get(reverse('report_doctor'), {'doctor': doctor.id})
+        self.assertEqual(response.data['total_price'], sum(
+            p.with_discount or p.service_type.price for p in Patient.objects.filter(doctor=doctor)
+        ))
+
+
+class AnalysisTests(CrmTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.make_patients(300, days=400)
+
+    def test_chart_matches_bucket_counts(self):
+        client = self.client_for(self.admin)
+        for period in ANALYSIS_PERIODS:
+            with self.subTest(period=period):
+                with self.assertNumQueries(2):
+                    response = client.get(reverse('analysis_regression'), {'period': period})
+                self.assertEqual(response.status_code, 200)
+
+                now = timezone.now()
+                _, starts = analysis_buckets(period, now)
+                window = Patient.objects.filter(appointment_date__gte=starts[0], appointment_date__lte=now)
+                self.assertEqual(response.data['total_patients'], window.count())
+                self.assertEqual(len(response.data['chart']), ANALYSIS_PERIODS[period][2])
+
+                ends = starts[1:] + [now + timedelta(seconds=1)]
+                for row, start, end in zip(response.data['chart'], starts, ends):
+                    bucket = window.filter(appointment_date__gte=start, appointment_date__lt=end)
+                    self.assertEqual(row['canceled'], bucket.filter(patient_status='canceled').count())
+                    self.assertEqual(row['had_an_appointment'], bucket.exclude(patient_status='canceled').count())
+
+    def test_yearly_chart_is_rolling_twelve_months(self):
+        _, starts = analysis_buckets('yearly', timezone.now())
+        today = timezone.localdate()
+        self.assertEqual((starts[-1].year, starts[-1].month), (today.year, today.month))
+        months = [start.year * 12 + start.month for start in starts]
+        self.assertEqual(months, list(range(months[0], months[0] + 12)))
+
+
+class TemporaryMetricsMixin:
+    """Свой файл метрик на тест: счётчики не копятся между тестами."""
+
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        settings_override = override_settings(METRICS_FILE=f'{directory.name}/metrics.mmap')
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+
+class ResponseCacheTests(TemporaryMetricsMixin, CrmTestCase):
+    def check_cache_cycle(self):
+        self.make_patients(30)
+        client = self.client_for(self.admin)
+        url = reverse('report_summary')
+
+        first = client.get(url, {'date_from': '2000-01-01', 'name': ''})
+        self.assertEqual(first['X-Cache'], 'MISS')
+        with self.assertNumQueries(0):
+            second = client.get(url, {'date_from': '2000-01-01'})
+        self.assertEqual(second['X-Cache'], 'HIT')
+        self.assertEqual(first.data, second.data)
+
+        # другой язык — другой ключ
+        with translation.override('ru'):
+            self.assertEqual(client.get(reverse('report_summary'), {'date_from': '2000-01-01'})['X-Cache'], 'MISS')
+
+        patient = Patient.objects.first()
+        with self.captureOnCommitCallbacks(execute=True):
+            patient.with_discount = (patient.with_discount or 0) + 1000
+            patient.save()
+        third = client.get(url, {'date_from': '2000-01-01'})
+        self.assertEqual(third['X-Cache'], 'MISS')
+        self.assertNotEqual(third.data, first.data)
+
+        self.assertEqual(cache_stats()['report_summary'], {'hits': 1, 'misses': 3})
+
+    def test_locmem_backend(self):
+        self.check_cache_cycle()
+
+    def test_stats_from_concurrent_processes(self):
+        # счётчики общие для воркеров: ни одно прибавление не теряется
+        def hammer():
+            try:
+                for _ in range(200):
+                    record('report_summary', 'hits')
+            finally:
+                # дочерний процесс не должен продолжить прогон тестов
+                os._exit(0)
+
+        pids = []
+        for _ in range(4):
+            pid = os.fork()
+            if pid == 0:
+                hammer()
+            pids.append(pid)
+        for pid in pids:
+            os.waitpid(pid, 0)
+        self.assertEqual(cache_stats()['report_summary'], {'hits': 800, 'misses': 0})
+
+    def test_file_backend(self):
+        with tempfile.TemporaryDirectory() as location:
+            caches = {'default': {
+                'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+                'LOCATION': location,
+            }}
+            with override_settings(CACHES=caches):
+                self.check_cache_cycle()
+
+    def test_analysis_is_cached(self):
+        self.make_patients(10)
+        client = self.client_for(self.admin)
+        url = reverse('analysis_regression')
+        self.assertEqual(client.get(url, {'period': 'daily'})['X-Cache'], 'MISS')
+        with self.assertNumQueries(0):
+            self.assertEqual(client.get(url, {'period': 'daily'})['X-Cache'], 'HIT')
+
+    def test_excel_export_is_not_cached(self):
+        client = self.client_for(self.admin)
+        response = client.get(reverse('report_summary'), {'export': 'excel'})
+        self.assertFalse(response.has_header('X-Cache'))
+
+
+class ReferenceDataCacheTests(CrmTestCase):
+    ROUTES = ('department_list', 'department_list_services', 'job_title_list', 'room_list')
+
+    def token_client(self, user):
+        client = APIClient()
+        token = add_claims(RefreshToken.for_user(user), user).access_token
+        client.credentials(HTTP_AUTHORIZATION=f'Bearer {token}')
+        return client
+
+    def test_warm_hit_skips_database(self):
+        client = self.token_client(self.admin)
+        for name in self.ROUTES:
+            with self.subTest(route=name):
+                first = client.get(reverse(name))
+                self.assertEqual(first['X-Cache'], 'MISS')
+                with self.assertNumQueries(0):
+                    second = client.get(reverse(name))
+                self.assertEqual(second['X-Cache'], 'HIT')
+                self.assertEqual(second.data, first.data)
+                self.assertEqual(second['ETag'], first['ETag'])
+
+    def test_not_modified(self):
+        client = self.client_for(self.admin)
+        url = reverse('department_list')
+        etag = client.get(url)['ETag']
+        self.assertRegex(etag, r'^"[0-9a-f]{32}-json"$')
+
+        with self.assertNumQueries(0):
+            response = client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+        self.assertEqual(response['ETag'], etag)
+
+        self.assertEqual(client.get(url, HTTP_IF_NONE_MATCH=f'"other", W/{etag}').status_code, 304)
+        self.assertEqual(client.get(url, HTTP_IF_NONE_MATCH='"other"').status_code, 200)
+
+        # после сброса кэша тот же ETag даёт 304 и на промахе
+        get_cache().clear()
+        response = client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual((response.status_code, response['X-Cache']), (304, 'MISS'))
+
+    def test_cached_per_language(self):
+        department = self.departments[0]
+        department.department_name_ru = 'Отделение 0'
+        department.save()
+        client = self.client_for(self.admin)
+        english = client.get(reverse('department_list'))
+        with translation.override('ru'):
+            russian = client.get(reverse('department_list'))
+        self.assertEqual(russian['X-Cache'], 'MISS')
+        self.assertNotEqual(russian['ETag'], english['ETag'])
+        self.assertIn('Отделение 0', [row['department_name'] for row in russian.data])
+
+    def test_invalidated_on_save_and_delete(self):
+        client = self.client_for(self.admin)
+        changes = [
+            ('department_list', lambda: Department.objects.create(department_name='New department')),
+            ('job_title_list', lambda: JobTitle.objects.filter(pk=self.job_titles[1].pk).get().delete()),
+            ('room_list', lambda: Room.objects.create(room_number=999)),
+            ('department_list_services', lambda: ServiceType.objects.create(
+                department=self.departments[0], type='New service', price=100)),
+        ]
+        for name, change in changes:
+            with self.subTest(route=name):
+                url = reverse(name)
+                before = client.get(url)
+                with self.captureOnCommitCallbacks(execute=True):
+                    change()
+                after = client.get(url)
+                self.assertEqual(after['X-Cache'], 'MISS')
+                self.assertNotEqual(after['ETag'], before['ETag'])
+                self.assertEqual(client.get(url, HTTP_IF_NONE_MATCH=before['ETag']).status_code, 200)
+
+    def test_patient_changes_keep_reference_data(self):
+        client = self.client_for(self.admin)
+        client.get(reverse('room_list'))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.make_patients(3)
+            Patient.objects.first().save()
+        self.assertEqual(client.get(reverse('room_list'))['X-Cache'], 'HIT')
+
+
+class ChangeCounterETagTests(CrmTestCase):
+    def setUp(self):
+        self.make_patients(20)
+
+    def etag(self, client, name, params=None):
+        response = client.get(reverse(name), params or {})
+        self.assertEqual(response.status_code, 200)
+        return response['ETag']
+
+    def not_modified(self, client, name, etag, params=None):
+        return client.get(reverse(name), params or {}, HTTP_IF_NONE_MATCH=etag).status_code == 304
+
+    def window(self, **filters):
+        now = timezone.now()
+        return {'start': (now - timedelta(days=31)).isoformat(), 'end': (now + timedelta(days=1)).isoformat(), **filters}
+
+    def test_not_modified_after_counter_lookup(self):
+        doctor = self.doctors[0]
+        client = self.client_for(doctor)
+        for name in ('doctor_patients', 'doctor_notification'):
+            with self.subTest(route=name):
+                etag = self.etag(client, name)
+                with self.assertNumQueries(1):
+                    response = client.get(reverse(name), HTTP_IF_NONE_MATCH=etag)
+                self.assertEqual(response.status_code, 304)
+                self.assertEqual(response['ETag'], etag)
+                self.assertNotEqual(self.etag(client, name, {'page_size': 5}), etag)
+
+    def test_patient_writes_bump_own_scopes_only(self):
+        first, second = self.doctors[0], self.doctors[1]
+        client = self.client_for(first)
+        etag = self.etag(client, 'doctor_patients')
+
+        other = Patient.objects.filter(doctor=second).first()
+        other.info = 'changed'
+        other.save()
+        self.assertTrue(self.not_modified(client, 'doctor_patients', etag))
+
+        own = Patient.objects.filter(doctor=first).first()
+        own.info = 'changed'
+        own.save()
+        self.assertFalse(self.not_modified(client, 'doctor_patients', etag))
+
+        # перенос визита к другому доктору меняет ленты обоих
+        etag = self.etag(client, 'doctor_patients')
+        other.doctor = first
+        other.department = first.department
+        other.save()
+        self.assertFalse(self.not_modified(client, 'doctor_patients', etag))
+
+    def test_calendar_scopes(self):
+        client = self.client_for(self.receptionist)
+        department = self.departments[0]
+        params = self.window(department=department.id)
+        etag = self.etag(client, 'calendar_list', params)
+        everything = self.etag(client, 'calendar_list', self.window())
+
+        Patient.objects.exclude(department=department).first().delete()
+        self.assertTrue(self.not_modified(client, 'calendar_list', etag, params))
+        self.assertFalse(self.not_modified(client, 'calendar_list', everything, self.window()))
+
+        patient = Patient.objects.filter(department=department).first()
+        Patient.objects.filter(pk=patient.pk).update(patient_status='waiting')
+        response = client.post(
+            reverse('patient_bulk_status'), {'ids': [patient.id], 'patient_status': 'canceled'}, format='json',
+        )
+        self.assertEqual(response.data['updated'], 1)
+        self.assertFalse(self.not_modified(client, 'calendar_list', etag, params))
+
+    def test_all_scope_is_derived(self):
+        # общий счётчик не хранится: запись визита обновляет только счётчики доктора и отделения
+        client = self.client_for(self.receptionist)
+        everything = self.etag(client, 'calendar_list', self.window())
+        patient = Patient.objects.first()
+        patient.info = 'changed'
+        patient.save()
+        self.assertFalse(ChangeCounter.objects.filter(scope=changes.ALL_SCOPE).exists())
+        self.assertFalse(self.not_modified(client, 'calendar_list', everything, self.window()))
+
+    def test_profile_changes(self):
+        doctor = self.doctors[0]
+        client = self.client_for(doctor)
+        etag = self.etag(client, 'doctor_notification')
+        self.receptionist.username = 'renamed'
+        self.receptionist.save()
+        self.assertFalse(self.not_modified(client, 'doctor_notification', etag))
+
+        etag = self.etag(client, 'doctor_notification')
+        self.receptionist.save(update_fields=['last_login'])
+        self.assertTrue(self.not_modified(client, 'doctor_notification', etag))
+
+
+class DoctorNotificationFeedTests(CrmTestCase):
+    def setUp(self):
+        self.doctor, self.other = self.doctors[0], self.doctors[1]
+        self.client = self.client_for(self.doctor)
+
+    def visit(self, doctor, name='Feed Patient'):
+        return Patient.objects.create(
+            name=name, phone='+996700123456', birthday='1990-01-01', gender='male',
+            service_type=next(s for s in self.services if s.department_id == doctor.department_id),
+            department=doctor.department, registrar=self.receptionist, doctor=doctor,
+            appointment_date=timezone.now(), payment_type='cash', patient_status='pre-registration',
+        )
+
+    def feed(self, since):
+        response = self.client.get(reverse('doctor_notification'), {'since': since})
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_incremental_feed(self):
+        self.make_patients(5, doctor=self.doctor)
+        cursor = int(self.client.get(reverse('doctor_notification'))['X-Notification-Cursor'])
+        self.assertEqual(self.feed(cursor)['events'], [])
+
+        patient = self.visit(self.doctor)
+        self.visit(self.other)
+        data = self.feed(cursor)
+        self.assertEqual([(event['kind'], event['patient_id']) for event in data['events']], [('assigned', patient.id)])
+        self.assertEqual(data['events'][0]['patient']['name'], 'Feed Patient')
+        self.assertFalse(data['has_more'])
+        cursor = data['cursor']
+
+        # перенос к другому доктору: снятие у прежнего, назначенный визит больше не раскрывается
+        patient.doctor = self.other
+        patient.department = self.other.department
+        patient.save()
+        data = self.feed(cursor)
+        self.assertEqual([(event['kind'], event['patient']) for event in data['events']], [('unassigned', None)])
+        self.assertEqual(self.feed(0)['events'][0]['patient'], None)
+
+        patient.delete()
+        self.assertEqual(self.feed(data['cursor'])['events'], [])
+
+        response = self.client.get(reverse('doctor_notification'), {'since': 'abc'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_bulk_create_and_limit(self):
+        service = next(s for s in self.services if s.department_id == self.doctor.department_id)
+        rows = [{
+            'name': f'Bulk {i}', 'phone': f'+996702000{i:03d}', 'service_type': service.id,
+            'birthday': '1990-01-01', 'department': self.doctor.department_id, 'registrar': self.receptionist.id,
+            'appointment_date': (timezone.now() + timedelta(minutes=i)).isoformat(), 'gender': 'female',
+            'doctor': self.doctor.id, 'payment_type': 'cash', 'patient_status': 'pre-registration',
+        } for i in range(3)]
+        response = self.client_for(self.receptionist).post(reverse('patient_bulk_create'), rows, format='json')
+        self.assertEqual(response.status_code, 201)
+        data = self.feed(0)
+        self.assertEqual(len(data['events']), 3)
+
+        with mock.patch('crm_med.notifications.FEED_LIMIT', 2):
+            first = self.feed(0)
+            self.assertTrue(first['has_more'])
+            self.assertEqual(len(self.feed(first['cursor'])['events']), 1)
+
+    def test_lookback_returns_late_commits(self):
+        # событие с меньшим id зафиксировано после того, как курсор ушёл дальше
+        late = self.visit(self.doctor)
+        self.visit(self.doctor)
+        late_id, cursor = DoctorNotificationEvent.objects.filter(doctor=self.doctor).order_by('id').values_list('id', flat=True)
+        self.assertEqual(notifications.seen_ids(self.doctor.id, cursor, 5), [late_id, cursor])
+        self.assertEqual(notifications.events_after(self.doctor.id, cursor)['events'], [])
+
+        feed = notifications.events_after(self.doctor.id, cursor, lookback=5, delivered=[cursor])
+        self.assertEqual([event['patient_id'] for event in feed['events']], [late.id])
+        self.assertEqual(feed['cursor'], cursor)
+        feed = notifications.events_after(self.doctor.id, cursor, lookback=5, delivered=[late_id, cursor])
+        self.assertEqual(feed['events'], [])
+
+    def stream(self, client, **params):
+        return async_to_sync(client.get)(reverse('doctor_notification_stream'), params)
+
+    def read(self, response):
+        async def collect():
+            return b''.join([chunk async for chunk in response.streaming_content]).decode()
+        return async_to_sync(collect)()
+
+    @override_settings(NOTIFICATION_STREAM_TIMEOUT=0.3, NOTIFICATION_STREAM_POLL_INTERVAL=0.05)
+    def test_stream(self):
+        token = add_claims(RefreshToken.for_user(self.doctor), self.doctor).access_token
+        client = AsyncClient()
+        response = self.stream(client, access_token=str(token), since=0)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        self.assertTrue(response.streaming)
+
+        patient = self.visit(self.doctor)
+        self.visit(self.other)
+        body = self.read(response)
+        self.assertTrue(body.startswith('retry: 1000'))
+        events = [block for block in body.split('\n\n') if block.startswith('id:')]
+        self.assertEqual(len(events), 1)
+        lines = dict(line.split(': ', 1) for line in events[0].split('\n'))
+        self.assertEqual(lines['event'], 'assigned')
+        self.assertEqual(json.loads(lines['data'])['patient_id'], patient.id)
+
+        # переподключение с Last-Event-ID: уже полученное не повторяется
+        response = async_to_sync(client.get)(
+            reverse('doctor_notification_stream'), {'access_token': str(token)}, headers={'Last-Event-ID': lines['id']},
+        )
+        self.assertNotIn('id:', self.read(response))
+
+    def test_stream_requires_doctor(self):
+        self.assertEqual(self.stream(AsyncClient()).status_code, 401)
+        self.assertEqual(self.stream(AsyncClient(), access_token='broken').status_code, 401)
+        token = add_claims(RefreshToken.for_user(self.admin), self.admin).access_token
+        self.assertEqual(self.stream(AsyncClient(), access_token=str(token)).status_code, 403)
+
+
+class LiveCalendarTests(CrmTestCase):
+    def setUp(self):
+        live._brokers.clear()
+        self.department = self.departments[0]
+        self.doctor = next(doctor for doctor in self.doctors if doctor.department_id == self.department.id)
+        self.token = add_claims(RefreshToken.for_user(self.receptionist), self.receptionist).access_token
+        self.doctor_token = add_claims(RefreshToken.for_user(self.doctor), self.doctor).access_token
+
+    def visit(self, department=None, days=0):
+        department = department or self.department
+        doctor = next(doctor for doctor in self.doctors if doctor.department_id == department.id)
+        with self.captureOnCommitCallbacks(execute=True):
+            return Patient.objects.create(
+                name='Live Patient', phone='+996700654321', birthday='1990-01-01', gender='male',
+                service_type=next(s for s in self.services if s.department_id == department.id),
+                department=department, registrar=self.receptionist, doctor=doctor,
+                appointment_date=timezone.now() + timedelta(days=days), payment_type='cash',
+                patient_status='pre-registration',
+            )
+
+    def connect(self, department_id=None, **params):
+        now = timezone.localdate()
+        query = {
+            'access_token': str(self.token), 'start': (now - timedelta(days=1)).isoformat(),
+            'end': (now + timedelta(days=1)).isoformat(), **params,
+        }
+        path = f'/ws/calendar/{department_id or self.department.id}/'
+        return ApplicationCommunicator(asgi.application, {
+            'type': 'websocket', 'path': path, 'query_string': urlencode(query).encode(),
+        })
+
+    async def open(self, **params):
+        communicator = self.connect(**params)
+        await communicator.send_input({'type': 'websocket.connect'})
+        self.assertEqual((await communicator.receive_output(1))['type'], 'websocket.accept')
+        return communicator
+
+    async def receive(self, communicator):
+        message = await communicator.receive_output(1)
+        self.assertEqual(message['type'], 'websocket.send')
+        return json.loads(message['text'])
+
+    async def close(self, communicator):
+        await communicator.send_input({'type': 'websocket.disconnect', 'code': 1000})
+        await communicator.wait(1)
+
+    async def test_deltas_for_department_and_window(self):
+        communicator = await self.open(lang='ru')
+        await sync_to_async(self.visit)(department=self.departments[1])
+        await sync_to_async(self.visit)(days=10)
+        patient = await sync_to_async(self.visit)()
+
+        message = await self.receive(communicator)
+        self.assertEqual((message['type'], message['id']), ('created', patient.id))
+        expected = await sync_to_async(lambda: CalendarReport(
+            Patient.objects.select_related('doctor__job_title', 'department').get(pk=patient.pk)).data)()
+        self.assertEqual(set(message['patient']), set(expected))
+        self.assertTrue(await communicator.receive_nothing(0.1))
+
+        # перенос из окна: клиент получает обновление, чтобы убрать визит
+        def move():
+            with self.captureOnCommitCallbacks(execute=True):
+                patient.appointment_date = timezone.now() + timedelta(days=20)
+                patient.save()
+        await sync_to_async(move)()
+        self.assertEqual((await self.receive(communicator))['type'], 'updated')
+
+        def delete():
+            with self.captureOnCommitCallbacks(execute=True):
+                patient.delete()
+        await sync_to_async(delete)()
+        self.assertTrue(await communicator.receive_nothing(0.1))
+
+        # новое окно — в нём удалённый визит виден
+        day = (timezone.localdate() + timedelta(days=20)).isoformat()
+        await communicator.send_input({'type': 'websocket.receive', 'text': json.dumps({'start': day, 'end': day})})
+        await sync_to_async(self.visit)(days=20)
+        self.assertEqual((await self.receive(communicator))['type'], 'created')
+
+        await communicator.send_input({'type': 'websocket.receive', 'text': 'not json'})
+        self.assertEqual((await self.receive(communicator))['type'], 'error')
+        await self.close(communicator)
+
+    async def test_rejected_connections(self):
+        for params, code in (
+            ({'access_token': 'broken'}, 4401),
+            ({'access_token': str(self.doctor_token)}, 4403),
+            ({'department_id': 999999}, 4404),
+            ({'start': 'yesterday'}, 4400),
+        ):
+            communicator = self.connect(**params)
+            await communicator.send_input({'type': 'websocket.connect'})
+            self.assertEqual(await communicator.receive_output(1), {'type': 'websocket.close', 'code': code})
+
+    @override_settings(LIVE_QUEUE_SIZE=2)
+    async def test_slow_subscriber_is_closed(self):
+        communicator = await self.open()
+        broker = live.get_broker()
+        channel = live.channel(self.department.id)
+        await asyncio.sleep(0)
+        for i in range(5):
+            broker.publish(channel, {'type': 'updated', 'id': i, 'appointment_date': '2000-01-01T00:00:00+00:00',
+                                     'previous_appointment_date': None, 'patient': None})
+        self.assertEqual(await communicator.receive_output(1), {'type': 'websocket.close', 'code': 4408})
+
+    def test_in_window_dates(self):
+        start, end = timezone.now() - timedelta(hours=1), timezone.now() + timedelta(hours=1)
+        naive = timezone.localtime().replace(tzinfo=None).isoformat()
+        for appointment_date, previous, expected in (
+            (naive, None, True),
+            (None, naive, True),
+            ('2025-13-45T00:00:00', None, False),
+            ('tomorrow', naive, True),
+            (None, None, False),
+        ):
+            with self.subTest(appointment_date=appointment_date, previous=previous):
+                message = {'appointment_date': appointment_date, 'previous_appointment_date': previous}
+                self.assertEqual(live.in_window(message, start, end), expected)
+
+    def test_file_broker_between_instances(self):
+        with tempfile.TemporaryDirectory() as directory, override_settings(
+            LIVE_BROKER='crm_med.live.FileBroker', LIVE_BROKER_DIR=directory, LIVE_BROKER_POLL_INTERVAL=0.01,
+        ):
+            publisher, subscriber = live.FileBroker(), live.FileBroker()
+
+            async def roundtrip():
+                async with subscriber.subscribe('calendar.1') as queue:
+                    await asyncio.sleep(0.02)
+                    await sync_to_async(publisher.publish)('calendar.1', {'id': 1})
+                    await sync_to_async(publisher.publish)('calendar.2', {'id': 2})
+                    return await asyncio.wait_for(queue.get(), 1)
+
+            self.assertEqual(async_to_sync(roundtrip)(), {'id': 1})
+
+    def test_file_broker_wants_subscribed_channels(self):
+        with tempfile.TemporaryDirectory() as directory, override_settings(
+            LIVE_BROKER_DIR=directory, LIVE_BROKER_HEARTBEAT=1,
+        ):
+            broker = live.FileBroker()
+            self.assertFalse(broker.wants('calendar.1'))
+
+            async def subscribed():
+                async with broker.subscribe('calendar.1'):
+                    return broker.wants('calendar.1'), broker.wants('calendar.2')
+
+            self.assertEqual(async_to_sync(subscribed)(), (True, False))
+            # отметка устарела: подписчик ушёл, не отметившись
+            stale = time.time() - 10
+            os.utime(broker.heartbeat_path('calendar.1'), (stale, stale))
+            self.assertFalse(broker.wants('calendar.1'))
+
+
+class AsyncReadPathTests(CrmTestCase):
+    """async_views.py отвечает так же, как синхронные представления."""
+    PATIENT_NAME = 'Async Patient'
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.make_patients(30)
+        cls.make_patients(12, name=cls.PATIENT_NAME, patient_status='had an appointment')
+        cls.make_patients(3, name=cls.PATIENT_NAME, patient_status='canceled')
+
+    def token_headers(self, user):
+        token = add_claims(RefreshToken.for_user(user), user).access_token
+        return {'HTTP_AUTHORIZATION': f'Bearer {token}'}
+
+    def routes(self):
+        card_id = Patient.objects.filter(name=self.PATIENT_NAME).values_list('card_id', flat=True).first()
+        now = timezone.now()
+        window = {'start': (now - timedelta(days=31)).isoformat(), 'end': (now + timedelta(days=1)).isoformat()}
+        return [
+            ('calendar_list', [], {**window, 'page_size': 7}, self.admin),
+            ('calendar_list', [], {**window, 'department': self.departments[1].id}, self.receptionist),
+            ('doctor_patients', [], {'page_size': 5}, self.doctors[0]),
+            ('patient_history', [self.PATIENT_NAME], {'page_size': 4}, self.admin),
+            ('patient_history', [self.PATIENT_NAME], {'period': 'monthly'}, self.admin),
+            ('patient_history_of_appointments', [self.PATIENT_NAME], {}, self.admin),
+            ('patient_history_of_payment', [self.PATIENT_NAME], {}, self.admin),
+            ('patient_card_history', [card_id], {}, self.admin),
+            ('patient_card_history_of_appointments', [card_id], {'period': 'yearly'}, self.admin),
+            ('patient_card_history_of_payment', [card_id], {}, self.admin),
+            ('analysis_regression', [], {'period': 'monthly'}, self.admin),
+            ('analysis_regression', [], {'period': 'daily'}, self.admin),
+        ]
+
+    def test_same_responses(self):
+        for name, args, params, user in self.routes():
+            with self.subTest(route=name, params=params):
+                expected = self.client.get(reverse(name, args=args), params, **self.token_headers(user))
+                # общий с синхронной версией кэш анализа: ответ должен быть посчитан заново
+                bump_version(PATIENT_DATA)
+                response = self.client.get(reverse(f'{name}_async', args=args), params, **self.token_headers(user))
+                self.assertEqual(response.status_code, 200, response.content[:300])
+                self.assertEqual(response.get('X-Cache'), expected.get('X-Cache'))
+                # ссылки на страницы ведут на тот же маршрут
+                self.assertEqual(response.content.replace(b'/async/', b'/'), expected.content)
+                self.assertEqual(response.get('ETag'), expected.get('ETag'))
+
+    def test_next_page_links(self):
+        headers = self.token_headers(self.doctors[0])
+        url = reverse('doctor_patients_async')
+        page = self.client.get(url, {'page_size': 2}, **headers).json()
+        ids = [patient['id'] for patient in page['results']]
+        while page['next']:
+            page = self.client.get(page['next'], **headers).json()
+            ids += [patient['id'] for patient in page['results']]
+        self.assertEqual(ids, list(Patient.objects.filter(doctor=self.doctors[0]).values_list('id', flat=True)))
+
+    def test_conditional_get(self):
+        headers = self.token_headers(self.doctors[0])
+        etag = self.client.get(reverse('doctor_patients'), **headers)['ETag']
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse('doctor_patients_async'), HTTP_IF_NONE_MATCH=etag, **headers)
+        self.assertEqual(response.status_code, 304)
+
+    def test_errors(self):
+        url = reverse('analysis_regression_async')
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 401)
+        self.assertIn('Bearer', response['WWW-Authenticate'])
+        self.assertEqual(self.client.get(url, HTTP_AUTHORIZATION='Bearer broken').status_code, 401)
+        self.assertEqual(self.client.get(url, **self.token_headers(self.doctors[0])).status_code, 403)
+        self.assertEqual(self.client.get(url, {'period': 'hourly'}, **self.token_headers(self.admin)).status_code, 400)
+        self.assertEqual(self.client.post(url, **self.token_headers(self.admin)).status_code, 405)
+        response = self.client.get(reverse('calendar_list_async'), {'start': 'never'}, **self.token_headers(self.admin))
+        self.assertEqual(response.status_code, 400)
+
+    def test_asgi_request(self):
+        client = AsyncClient()
+        url = reverse('patient_history_async', args=[self.PATIENT_NAME])
+        response = async_to_sync(client.get)(url, **self.token_headers(self.admin))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['report']['all'], 15)
+        self.assertIn('db;', response['Server-Timing'])
+
+
+class CursorPaginationTests(CrmTestCase):
+    def test_pages_follow_ordering_without_offset(self):
+        doctor = self.doctors[0]
+        self.make_patients(45, doctor=doctor)
+        expected = list(Patient.objects.filter(doctor=doctor).values_list('id', flat=True))
+
+        client = self.client_for(doctor)
+        url = reverse('doctor_patients')
+        params = {'page_size': 10}
+        ids = []
+        while url:
+            with CaptureQueriesContext(connection) as queries:
+                response = client.get(url, params)
+            self.assertEqual(response.status_code, 200)
+            self.assertFalse(any('OFFSET' in query['sql'] for query in queries.captured_queries))
+            ids += [row['id'] for row in response.data['results']]
+            url, params = response.data['next'], None
+        self.assertEqual(ids, expected)
+
+    def test_calendar_is_paginated(self):
+        self.make_patients(5)
+        today = timezone.localdate()
+        response = self.client_for(self.admin).get(reverse('calendar_list'), {
+            'start': (today - timedelta(days=30)).isoformat(), 'end': today.isoformat(), 'page_size': 100000,
+        })
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['results']), 5)
+
+
+class CalendarWindowTests(CrmTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.make_patients(120, days=60)
+
+    def test_admin_and_receptionist_only(self):
+        window = {'start': '2025-01-01', 'end': '2025-01-02'}
+        self.assertEqual(self.client_for(self.doctors[0]).get(reverse('calendar_list'), window).status_code, 403)
+        self.assertEqual(APIClient().get(reverse('calendar_list'), window).status_code, 401)
+
+    def test_window_is_required(self):
+        client = self.client_for(self.receptionist)
+        self.assertEqual(client.get(reverse('calendar_list')).status_code, 400)
+        self.assertEqual(client.get(reverse('calendar_list'), {'start': '2025-01-01'}).status_code, 400)
+        self.assertEqual(client.get(reverse('calendar_list'), {'start': 'x', 'end': '2025-01-02'}).status_code, 400)
+        self.assertEqual(client.get(reverse('calendar_list'), {'start': '2025-01-01', 'end': '2025-06-01'}).status_code, 400)
+
+    def test_week_view(self):
+        client = self.client_for(self.receptionist)
+        today = timezone.localdate()
+        start = today - timedelta(days=6)
+        department = self.departments[0]
+        params = {'start': start.isoformat(), 'end': today.isoformat(), 'department': department.id, 'page_size': 500}
+
+        # счётчик изменений для ETag + проверка department фильтром + одна страница записей
+        with self.assertNumQueries(3):
+            response = client.get(reverse('calendar_list'), params)
+        self.assertEqual(response.status_code, 200)
+
+        window_start = day_bounds(start)[0]
+        window_end = day_bounds(today)[1]
+        expected = Patient.objects.filter(
+            department=department, appointment_date__gte=window_start, appointment_date__lt=window_end,
+        )
+        self.assertEqual([row['id'] for row in response.data['results']], list(expected.values_list('id', flat=True)))
+        for row in response.data['results']:
+            self.assertIn('job_title', row['doctor'])
+
+
+FULL_SCAN = re.compile(r'\bSCAN crm_med_patient\b(?! USING)')
+
+
+@skipUnless(connection.vendor == 'sqlite', 'EXPLAIN QUERY PLAN есть только в SQLite')
+class PatientCardTests(CrmTestCase):
+    def create_visit(self, name, phone, **fields):
+        service = self.services[0]
+        doctor = next(d for d in self.doctors if d.department_id == service.department_id)
+        data = {
+            'name': name, 'phone': phone, 'service_type': service.id,
+            'birthday': '1990-01-01', 'department': doctor.department_id, 'registrar': self.receptionist.id,
+            'appointment_date': timezone.now().isoformat(), 'gender': 'male', 'doctor': doctor.id,
+            'payment_type': 'cash', 'patient_status': 'had an appointment',
+        }
+        data.update(fields)
+        response = self.client_for(self.receptionist).post(reverse('patient_create'), data)
+        self.assertEqual(response.status_code, 201, response.content)
+        return Patient.objects.latest('id')
+
+    def test_spelling_variants_share_one_card(self):
+        first = self.create_visit('Asan Usonov', '+996700123456')
+        second = self.create_visit('  asan   USONOV ', '+996700123456')
+        self.assertTrue(first.primary_patient)
+        self.assertFalse(second.primary_patient)
+        self.assertEqual(first.card_id, second.card_id)
+        self.assertEqual(PatientCard.objects.count(), 1)
+
+    def test_namesakes_with_other_phone_are_separate(self):
+        first = self.create_visit('Asan Usonov', '+996700123456')
+        other = self.create_visit('Asan Usonov', '+996700654321')
+        self.assertTrue(other.primary_patient)
+        self.assertNotEqual(first.card_id, other.card_id)
+
+    def test_history_by_card_and_by_name(self):
+        first = self.create_visit('Asan Usonov', '+996700123456')
+        self.create_visit('ASAN usonov', '+996700123456')
+        self.create_visit('Asan Usonov', '+996700654321')
+        client = self.client_for(self.admin)
+
+        response = client.get(reverse('patient_card_history', args=[first.card_id]))
+        self.assertEqual(response.data['report']['all'], 2)
+
+        response = client.get(reverse('patient_history', args=['asan usonov']))
+        self.assertEqual(response.data['report']['all'], 3)
+        response = client.get(reverse('patient_history', args=['asan usonov']), {'phone': '+996700654321'})
+        self.assertEqual(response.data['report']['all'], 1)
+
+        response = client.get(reverse('patient_card_history_of_payment', args=[first.card_id]))
+        self.assertEqual(response.status_code, 200)
+
+    def test_backfill_links_existing_visits(self):
+        patients = self.make_patients(20, name='Bakyt Bakytov')
+        Patient.objects.update(card=None)
+        PatientCard.objects.all().delete()
+        call_command('backfill_patient_cards', batch_size=7, stdout=io.StringIO())
+        self.assertFalse(Patient.objects.filter(card__isnull=True).exists())
+        self.assertEqual(PatientCard.objects.count(), len({str(p.phone) for p in patients}))
+
+
+class PatientBulkCreateTests(CrmTestCase):
+    def row(self, name, phone, minutes=0, **fields):
+        doctor = self.doctors[0]
+        service = next(s for s in self.services if s.department_id == doctor.department_id)
+        row = {
+            'name': name, 'phone': phone, 'service_type': service.id,
+            'birthday': '1990-01-01', 'department': doctor.department_id, 'registrar': self.receptionist.id,
+            'appointment_date': (timezone.now() + timedelta(minutes=minutes)).isoformat(), 'gender': 'female',
+            'doctor': doctor.id, 'payment_type': 'cash', 'patient_status': 'pre-registration',
+        }
+        row.update(fields)
+        return row
+
+    def post(self, rows):
+        return self.client_for(self.receptionist).post(reverse('patient_bulk_create'), rows, format='json')
+
+    def test_primary_patient_for_batch(self):
+        existing = self.make_patients(1, name='Old Patient')[0]
+        response = self.post([
+            self.row('Aida Asanova', '+996700000001', minutes=30),
+            self.row('aida  ASANOVA', '+996700000001', minutes=10),
+            self.row('Old Patient', str(existing.phone)),
+            self.row('Aida Asanova', '+996700000002'),
+        ])
+        self.assertEqual(response.status_code, 201, response.data)
+        self.assertEqual([row['primary_patient'] for row in response.data], [False, True, False, True])
+        self.assertEqual(response.data[0]['card'], response.data[1]['card'])
+        self.assertEqual(response.data[2]['card'], Patient.objects.get(pk=existing.pk).card_id)
+        self.assertEqual(Patient.objects.filter(card_id=response.data[0]['card']).count(), 2)
+
+    def test_rollup_and_cache_follow_bulk_create(self):
+        self.make_patients(20)
+        client = self.client_for(self.admin)
+        before = client.get(reverse('report_summary')).data
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.post([self.row(f'Bulk {i}', f'+99670000{i:04d}', with_discount=1000) for i in range(5)])
+        self.assertEqual(response.status_code, 201)
+
+        after = client.get(reverse('report_summary'))
+        self.assertEqual(after['X-Cache'], 'MISS')
+        self.assertEqual(after.data['total_cash'], before['total_cash'] + 5000)
+        snapshot = rollup_snapshot()
+        rebuild_rollup()
+        self.assertEqual(snapshot, rollup_snapshot())
+
+    def test_errors_are_reported_per_row(self):
+        response = self.post([
+            self.row('Good Row', '+996700000001'),
+            self.row('Bad Doctor', '+996700000002', doctor=999999),
+            self.row('Bad Phone', 'not a phone', service_type='x'),
+        ])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data[0], {})
+        self.assertEqual(set(response.data[1]), {'doctor'})
+        self.assertEqual(set(response.data[2]), {'phone', 'service_type'})
+        self.assertFalse(Patient.objects.exists())
+
+        self.assertEqual(self.post({'name': 'not a list'}).status_code, 400)
+        self.assertEqual(self.post([]).status_code, 400)
+
+    def test_query_count_does_not_grow_with_rows(self):
+        # 50 строк — ещё одна пачка INSERT на SQLite (лимит 999 параметров на запрос)
+        # счётчики изменений создаются первой записью доктора — создаём их заранее
+        changes.bump(changes.patient_scopes([Patient(doctor=self.doctors[0], department=self.doctors[0].department)]))
+        counts = []
+        for size, day in ((5, 1), (50, 3)):
+            # разные дни: у второй пачки нет готовых строк сводной таблицы, которые пришлось бы удалять
+            rows = [
+                self.row(f'Patient {size} {i}', f'+996701{size:03d}{i:03d}', minutes=day * 24 * 60 + i)
+                for i in range(size)
+            ]
+            with CaptureQueriesContext(connection) as ctx:
+                response = self.post(rows)
+            self.assertEqual(response.status_code, 201)
+            counts.append(len(ctx))
+        self.assertEqual(counts[0], counts[1])
+
+
+class PatientStatusBulkTests(CrmTestCase):
+    def post(self, ids, patient_status):
+        return self.client_for(self.receptionist).post(
+            reverse('patient_bulk_status'), {'ids': ids, 'patient_status': patient_status}, format='json')
+
+    def test_transitions_and_outcomes(self):
+        waiting = self.make_patients(3, patient_status='waiting')
+        pre = self.make_patients(1, patient_status='pre-registration')[0]
+        done = self.make_patients(1, patient_status='had an appointment')[0]
+        canceled = self.make_patients(1, patient_status='canceled')[0]
+        ids = [p.id for p in waiting] + [pre.id, done.id, canceled.id, 999999]
+
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.post(ids, 'had an appointment')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['updated'], 4)
+        self.assertEqual(
+            [row['result'] for row in response.data['results']],
+            ['updated'] * 4 + ['unchanged', 'not_allowed', 'not_found'],
+        )
+        self.assertEqual(response.data['results'][5]['previous_status'], 'canceled')
+        updates = [q['sql'] for q in ctx.captured_queries if q['sql'].startswith('UPDATE "crm_med_patient"')]
+        self.assertEqual(len(updates), 1)
+
+        self.assertEqual(
+            Patient.objects.filter(patient_status='had an appointment').count(), 5)
+        self.assertEqual(Patient.objects.get(pk=canceled.pk).patient_status, 'canceled')
+
+    def test_reports_follow_status_change(self):
+        # все визиты внутри месячного окна графика
+        patients = self.make_patients(10, days=10, patient_status='waiting')
+        client = self.client_for(self.admin)
+        self.assertEqual(client.get(reverse('analysis_regression'), {'period': 'monthly'}).data['fall'], 0)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.post([p.id for p in patients[:4]], 'canceled')
+
+        snapshot = rollup_snapshot()
+        rebuild_rollup()
+        self.assertEqual(snapshot, rollup_snapshot())
+        response = client.get(reverse('analysis_regression'), {'period': 'monthly'})
+        self.assertEqual(response['X-Cache'], 'MISS')
+        self.assertEqual(response.data['fall'], 40)
+
+    def test_validation(self):
+        self.assertEqual(self.post([], 'canceled').status_code, 400)
+        self.assertEqual(self.post([1], 'done').status_code, 400)
+
+
+@skipUnless(connection.vendor == 'sqlite', "FTS5 index is SQLite-only")
+class PatientSearchTests(CrmTestCase):
+    def setUp(self):
+        super().setUp()
+        self.make_patients(30)
+        doctor = self.doctors[0]
+        service = next(s for s in self.services if s.department_id == doctor.department_id)
+        common = dict(service_type=service, birthday=datetime(1990, 1, 1).date(), department=doctor.department,
+                      registrar=self.receptionist, appointment_date=timezone.now(), gender='male', doctor=doctor,
+                      payment_type='cash', patient_status='waiting')
+        self.asan = Patient.objects.create(name='Асанбек Усонов', phone='+996700123456', **common)
+        self.noted = Patient.objects.create(name='Нурлан Жапаров', phone='+996555000111',
+                                            info='направлен от Асанбек', **common)
+
+    def search(self, q, **params):
+        response = self.client_for(self.receptionist).get(reverse('patient_search'), {'q': q, **params})
+        self.assertEqual(response.status_code, 200, response.content)
+        return [row['id'] for row in response.data]
+
+    def test_prefix_match_ranks_name_above_info(self):
+        self.assertEqual(self.search('асан'), [self.asan.id, self.noted.id])
+        self.assertEqual(self.search('АСАНБЕК ус'), [self.asan.id])
+
+    def test_phone_prefix(self):
+        self.assertEqual(self.search('+996 555'), [self.noted.id])
+
+    def test_typo_tolerance(self):
+        self.assertEqual(self.search('усноов')[0], self.asan.id)
+        self.assertEqual(self.search('нурлн жапаров'), [self.noted.id])
+        self.assertEqual(self.search('qqqqqq'), [])
+
+    def test_index_follows_updates_and_deletes(self):
+        self.asan.name = 'Бакыт Усонов'
+        self.asan.save()
+        self.assertEqual(self.search('асанбек'), [self.noted.id])
+        self.assertEqual(self.search('бакыт'), [self.asan.id])
+        Patient.objects.filter(pk=self.noted.pk).update(info=None)
+        self.assertEqual(self.search('асанбек'), [])
+        self.asan.delete()
+        self.assertEqual(self.search('бакыт'), [])
+
+    def test_query_is_required(self):
+        response = self.client_for(self.receptionist).get(reverse('patient_search'), {'q': 'a'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_limit_must_be_positive(self):
+        client = self.client_for(self.receptionist)
+        for limit in (0, -1):
+            with self.subTest(limit=limit):
+                response = client.get(reverse('patient_search'), {'q': 'асан', 'limit': limit})
+                self.assertEqual(response.status_code, 400)
+                self.assertIn('limit', response.data)
+
+    def test_q_filters_reports(self):
+        response = self.client_for(self.admin).get(reverse('report_exact'), {'q': 'жапаров'})
+        self.assertEqual([p['id'] for p in response.data['patients']], [self.noted.id])
+        self.assertEqual(response.data['patients_count'], 1)
+
+        response = self.client_for(self.admin).get(
+            reverse('department_patients', args=[self.doctors[0].department_id]), {'q': 'усонов'})
+        self.assertEqual([p['id'] for p in response.data['patients']], [self.asan.id])
+
+    def test_search_plan_uses_fts_index(self):
+        with CaptureQueriesContext(connection) as ctx:
+            self.search('асан')
+        fts = [q['sql'] for q in ctx.captured_queries if 'MATCH' in q['sql']]
+        self.assertEqual(len(fts), 1)
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN QUERY PLAN ' + fts[0])
+            plan = ' '.join(str(row[-1]) for row in cursor.fetchall())
+        self.assertIn('VIRTUAL TABLE INDEX', plan)
+
+
+class QueryPlanTests(CrmTestCase):
+    """Горячие запросы к Patient не должны сваливаться в полный просмотр таблицы."""
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.make_patients(200, days=60)
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+
+    def patient_queries(self, client, url, params=None, method='get'):
+        with CaptureQueriesContext(connection) as queries:
+            response = getattr(client, method)(url, params or {})
+        self.assertLess(response.status_code, 400, response.content)
+        return [q['sql'] for q in queries.captured_queries if 'crm_med_patient' in q['sql']]
+
+    def assertNoFullScan(self, sql):
+        with connection.cursor() as cursor:
+            cursor.execute(f'EXPLAIN QUERY PLAN {sql}')
+            plan = '\n'.join(row[-1] for row in cursor.fetchall())
+        self.assertIsNone(FULL_SCAN.search(plan), f'{sql}\n{plan}')
+
+    def test_hot_queries_use_indexes(self):
+        patient = Patient.objects.first()
+        day = timezone.localtime(patient.appointment_date).date().isoformat()
+        admin = self.client_for(self.admin)
+        doctor = self.client_for(patient.doctor)
+        window = {'start': day, 'end': day}
+        cases = [
+            (admin, reverse('department_patients', args=[patient.department_id]), {'name': patient.name}),
+            (admin, reverse('department_patients', args=[patient.department_id]), {'date': day}),
+            (admin, reverse('patient_history', args=[patient.name]), {'period': 'yearly'}),
+            (admin, reverse('patient_history_of_appointments', args=[patient.name]), {}),
+            (admin, reverse('patient_history_of_payment', args=[patient.name]), {'period': 'monthly'}),
+            (admin, reverse('report_exact'), {'date': day}),
+            (admin, reverse('report_exact'), {'name': patient.name}),
+            (admin, reverse('report_exact'), {'doctor': patient.doctor_id, 'date': day}),
+            (admin, reverse('report_doctor'), {'doctor': patient.doctor_id, 'date': day}),
+            (admin, reverse('report_summary'), {'name': patient.name, 'date_from': day, 'date_to': day}),
+            (admin, reverse('calendar_list'), {**window, 'doctor': patient.doctor_id}),
+            (admin, reverse('calendar_list'), {**window, 'department': patient.department_id}),
+            (doctor, reverse('doctor_patients'), {}),
+            (doctor, reverse('doctor_notification'), {}),
+        ] + [
+            (admin, reverse('analysis_regression'), {'period': period}) for period in ANALYSIS_PERIODS
+        ]
+        for client, url, params in cases:
+            with self.subTest(url=url, params=params):
+                for sql in self.patient_queries(client, url, params):
+                    self.assertNoFullScan(sql)
+
+    def test_primary_patient_lookup_uses_index(self):
+        patient = Patient.objects.first()
+        queries = self.patient_queries(self.client_for(self.receptionist), reverse('patient_create'), {
+            'name': f'  {patient.name.upper()} ', 'phone': str(patient.phone), 'service_type': patient.service_type_id,
+            'birthday': '1990-01-01', 'department': patient.department_id, 'registrar': self.receptionist.id,
+            'appointment_date': timezone.now().isoformat(), 'gender': 'male', 'doctor': patient.doctor_id,
+            'payment_type': 'cash', 'patient_status': 'waiting',
+        }, method='post')
+        lookup = [sql for sql in queries if sql.startswith('SELECT') and (
+            'FROM "crm_med_patientcard"' in sql or 'SELECT 1 AS "a"' in sql
+        )]
+        self.assertEqual(len(lookup), 2)
+        for sql in lookup:
+            self.assertNoFullScan(sql)
+        created = Patient.objects.latest('id')
+        self.assertFalse(created.primary_patient)
+        self.assertEqual(created.card_id, patient.card_id)
+
+
+class QueryBudgetTests(CrmTestCase):
+    """
+    Каждый список объявляет query_budget — максимум SQL-запросов на запрос.
+    Эндпоинты вызываются на 10 и на 1000 строках: число запросов должно
+    укладываться в бюджет и не расти вместе с количеством строк (N+1).
+    """
+    PATIENT_NAME = 'Budget Patient'
+
+    def populate(self, count):
+        # строки для каждого списка: визиты одного пациента у одного доктора и справочники
+        doctor = self.doctors[0]
+        self.make_patients(count, doctor=doctor, name=self.PATIENT_NAME)
+        offset = Department.objects.count()
+        departments = Department.objects.bulk_create(
+            Department(department_name=f'Extra {offset + i}') for i in range(count))
+        JobTitle.objects.bulk_create(JobTitle(job_title=f'Extra {offset + i}') for i in range(count))
+        Room.objects.bulk_create(Room(room_number=1000 + offset + i) for i in range(count))
+        ServiceType.objects.bulk_create(
+            ServiceType(department=department, type='Extra', price=100) for department in departments)
+        for i in range(count):
+            Doctor.objects.create(
+                username=f'extra{offset + i}', email=f'extra{offset + i}@test.local', user_role='doctor',
+                department=departments[i], job_title=self.job_titles[0], room=self.rooms[0],
+            )
+
+    def endpoints(self):
+        doctor = self.doctors[0]
+        card_id = Patient.objects.filter(name=self.PATIENT_NAME).values_list('card_id', flat=True).first()
+        now = timezone.now()
+        window = {'start': (now - timedelta(days=31)).isoformat(), 'end': (now + timedelta(days=1)).isoformat()}
+        page = {'page_size': 500}
+        return [
+            ('department_patients', [doctor.department_id], {}, self.admin),
+            ('patient_search', [], {'q': 'budget', 'limit': 100}, self.receptionist),
+            ('patient_history', [self.PATIENT_NAME], page, self.admin),
+            ('patient_history_of_appointments', [self.PATIENT_NAME], {}, self.admin),
+            ('patient_history_of_payment', [self.PATIENT_NAME], {}, self.admin),
+            ('patient_card_history', [card_id], page, self.admin),
+            ('patient_card_history_of_appointments', [card_id], {}, self.admin),
+            ('patient_card_history_of_payment', [card_id], {}, self.admin),
+            ('doctor_list', [], {}, self.admin),
+            ('doctor_notification', [], page, doctor),
+            ('doctor_patients', [], page, doctor),
+            ('department_list', [], {}, self.admin),
+            ('department_list_services', [], {}, self.admin),
+            ('report_exact', [], page, self.admin),
+            ('report_doctor', [], {**page, 'doctor': doctor.id}, self.admin),
+            ('report_summary', [], {}, self.admin),
+            ('report_summary', [], {'name': self.PATIENT_NAME}, self.admin),
+            ('analysis_regression', [], {'period': 'monthly'}, self.admin),
+            ('calendar_list', [], {**window, **page}, self.admin),
+            ('job_title_list', [], {}, self.admin),
+            ('room_list', [], {}, self.admin),
+            ('calendar_list_async', [], {**window, **page}, self.admin),
+            ('doctor_patients_async', [], page, doctor),
+            ('patient_history_async', [self.PATIENT_NAME], page, self.admin),
+            ('patient_history_of_appointments_async', [self.PATIENT_NAME], {}, self.admin),
+            ('patient_history_of_payment_async', [self.PATIENT_NAME], {}, self.admin),
+            ('patient_card_history_async', [card_id], page, self.admin),
+            ('analysis_regression_async', [], {'period': 'monthly'}, self.admin),
+        ]
+
+    def measure(self):
+        counts = {}
+        for index, (name, args, params, user) in enumerate(self.endpoints()):
+            get_cache().clear()
+            client = self.client_for(user)
+            url = reverse(name, args=args)
+            with CaptureQueriesContext(connection) as ctx:
+                response = client.get(url, params)
+            self.assertEqual(response.status_code, 200, (name, response.content[:300]))
+            counts[index, name] = (len(ctx), resolve(url).func.view_class)
+        return counts
+
+    def test_every_list_view_declares_budget(self):
+        exercised = {name for name, *_ in self.endpoints()}
+        for pattern in crm_urls.urlpatterns:
+            view_class = getattr(pattern.callback, 'view_class', None)
+            if view_class is None or not issubclass(view_class, generics.ListAPIView):
+                continue
+            with self.subTest(view=view_class.__name__):
+                self.assertIsNotNone(getattr(view_class, 'query_budget', None))
+                self.assertIn(pattern.name, exercised)
+
+    def test_query_count_does_not_grow_with_rows(self):
+        self.populate(10)
+        small = self.measure()
+        self.populate(990)
+        large = self.measure()
+        for key, (count, view_class) in small.items():
+            with self.subTest(endpoint=key):
+                self.assertEqual(large[key][0], count)
+                self.assertLessEqual(count, view_class.query_budget)
+
+
+class ServerTimingTests(CrmTestCase):
+    def timing(self, response):
+        metrics = {}
+        for metric in response['Server-Timing'].split(', '):
+            name, *params = metric.split(';')
+            metrics[name] = dict(param.split('=', 1) for param in params)
+        return metrics
+
+    def test_header_phases(self):
+        self.make_patients(20)
+        client = self.client_for(self.admin)
+        with CaptureQueriesContext(connection) as ctx:
+            response = client.get(reverse('report_exact'))
+        metrics = self.timing(response)
+        self.assertEqual(metrics['db']['desc'], f'"{len(ctx)} queries"')
+        for name in ('db', 'ser', 'render', 'total'):
+            self.assertGreaterEqual(float(metrics[name]['dur']), 0)
+        self.assertGreaterEqual(float(metrics['total']['dur']), float(metrics['ser']['dur']))
+
+        response = client.get(reverse('report_exact'), {'export': 'excel'})
+        self.assertIn('xlsx', self.timing(response))
+
+    def test_query_budget_warning(self):
+        client = self.client_for(self.admin)
+        with mock.patch.object(DoctorListAPIView, 'query_budget', 0):
+            with self.assertLogs('crm_med.middleware', 'WARNING') as logs:
+                client.get(reverse('doctor_list'))
+        self.assertIn('DoctorListAPIView', logs.output[0])
+
+    @override_settings(SERVER_TIMING_ENABLED=False)
+    def test_can_be_disabled(self):
+        response = self.client_for(self.admin).get(reverse('doctor_list'))
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('Server-Timing', response)
+
+
+class MetricsTests(TemporaryMetricsMixin, CrmTestCase):
+
+    def scrape(self):
+        response = self.client_for(self.admin).get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        samples = {}
+        for line in response.content.decode().splitlines():
+            if line and not line.startswith('#'):
+                name, value = line.rsplit(' ', 1)
+                samples[name] = float(value)
+        return samples
+
+    def test_requests_and_histograms(self):
+        self.make_patients(5)
+        client = self.client_for(self.admin)
+        for _ in range(3):
+            client.get(reverse('doctor_list'))
+        client.get(reverse('calendar_list'))  # без start/end — 400
+
+        samples = self.scrape()
+        labels = 'route="doctor_list",method="GET"'
+        self.assertEqual(samples[f'crm_med_http_requests_total{{{labels}}}'], 3)
+        self.assertEqual(samples[f'crm_med_http_errors_total{{{labels},status="4xx"}}'], 0)
+        self.assertEqual(samples['crm_med_http_errors_total{route="calendar_list",method="GET",status="4xx"}'], 1)
+        self.assertEqual(samples[f'crm_med_http_request_duration_seconds_count{{{labels}}}'], 3)
+        self.assertEqual(samples[f'crm_med_http_request_duration_seconds_bucket{{{labels},le="+Inf"}}'], 3)
+        self.assertGreater(samples[f'crm_med_db_queries_per_request_sum{{{labels}}}'], 0)
+        self.assertGreater(samples[f'crm_med_http_response_size_bytes_sum{{{labels}}}'], 0)
+        # корзины накопительные
+        buckets = [value for name, value in samples.items()
+                   if name.startswith(f'crm_med_db_queries_per_request_bucket{{{labels}')]
+        self.assertEqual(buckets, sorted(buckets))
+
+    def test_aggregates_across_processes(self):
+        store = metrics.get_store()
+        store.observe('doctor_list', 'GET', 0.01, 2, 100, 200)
+        pid = os.fork()
+        if pid == 0:
+            try:
+                metrics.get_store().observe('doctor_list', 'GET', 0.02, 3, 100, 500)
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+
+        values = store.snapshot()['doctor_list', 'GET']
+        self.assertEqual(values['requests'], 2)
+        self.assertEqual(values['server_errors'], 1)
+        self.assertEqual(values['queries_sum'], 5)
+
+    def test_unknown_route(self):
+        self.client_for(self.admin).get('/en/no-such-page/')
+        self.assertEqual(metrics.get_store().snapshot()['other', 'GET']['client_errors'], 1)
+
+    def test_admin_only(self):
+        self.assertEqual(APIClient().get('/metrics').status_code, 401)
+        self.assertEqual(self.client_for(self.receptionist).get('/metrics').status_code, 403)
+
+
+class BenchmarkTests(TestCase):
+    def setUp(self):
+        # состояние пользователей в кэше пережило бы откат данных предыдущего теста
+        get_cache().clear()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        settings_override = override_settings(MEDIA_ROOT=directory.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def test_every_route_is_measured(self):
+        seeding.seed(300)
+        results = benchmark.run(iterations=2)
+        measured = {key.split(':')[0] for key in results}
+        for pattern in crm_urls.urlpatterns:
+            name = getattr(pattern, 'name', None) or getattr(pattern, 'namespace', None)
+            if name not in benchmark.SKIPPED_ROUTES:
+                self.assertIn(name, measured)
+        for values in results.values():
+            self.assertLessEqual(values['p50_ms'], values['p95_ms'])
+            self.assertGreater(values['peak_kb'], 0)
+        # изменяющие запросы откатываются
+        self.assertEqual(Patient.objects.count(), 300)
+
+    def test_load_test(self):
+        seeding.seed(300)
+        routes = benchmark.load_routes(benchmark.fixtures(), only=['calendar_list', 'analysis_regression'])
+        self.assertEqual([route[:3] for route in routes], [
+            ('calendar_list', 'calendar_list', 'calendar_list_async'),
+            ('analysis_regression', 'analysis_regression', 'analysis_regression_async'),
+        ])
+        results = async_to_sync(benchmark.load_test)(routes, levels=[1, 4], requests=8)
+        for key, levels in results.items():
+            self.assertEqual(list(levels), [1, 4])
+            for modes in levels.values():
+                for mode in ('sync', 'async'):
+                    self.assertEqual(modes[mode]['errors'], 0, (key, mode))
+                    self.assertGreater(modes[mode]['rps'], 0)
+
+    def test_compare(self):
+        baseline = {'report_exact': {'p50_ms': 10.0, 'p95_ms': 20.0, 'queries': 3, 'peak_kb': 100.0}}
+        current = {'report_exact': {'p50_ms': 11.0, 'p95_ms': 30.0, 'queries': 4, 'peak_kb': 90.0}}
+        regressions = {
+            metric for key, metric, old, new, change, regression in benchmark.compare(baseline, current, 0.2)
+            if regression
+        }
+        self.assertEqual(regressions, {'p95_ms', 'queries'})
+
+
+class SeedingTests(TestCase):
+    def snapshot(self):
+        return list(Patient.objects.order_by('id').values_list(
+            'name', 'phone', 'appointment_date', 'doctor__username', 'with_discount', 'primary_patient'))
+
+    def test_same_data_for_any_number_of_workers(self):
+        with transaction.atomic():
+            seeding.seed(300, workers=1)
+            first = self.snapshot()
+            transaction.set_rollback(True)
+
+        seeding.seed(300, workers=2)
+        self.assertEqual(self.snapshot(), first)
+
+    def test_seeded_data(self):
+        seeding.seed(500, doctors=5, receptionists=2, departments=3)
+        self.assertEqual(Patient.objects.count(), 500)
+        self.assertEqual(Doctor.objects.count(), 5)
+        self.assertEqual(Receptionist.objects.count(), 2)
+        self.assertTrue(Admin.objects.get(email=seeding.ADMIN_EMAIL).check_password(seeding.PASSWORD))
+
+        # повторные визиты одного человека, первичный — самый ранний
+        self.assertLess(PatientCard.objects.count(), 500)
+        for card in PatientCard.objects.annotate(visits_count=Count('visits')).filter(visits_count__gt=1)[:20]:
+            visits = list(card.visits.order_by('appointment_date'))
+            self.assertEqual([v.primary_patient for v in visits], [True] + [False] * (len(visits) - 1))
+        self.assertTrue(Patient.objects.filter(with_discount__isnull=False).exists())
+        seeded = rollup_snapshot()
+        rebuild_rollup()
+        self.assertEqual(seeded, rollup_snapshot())
+        self.assertEqual(sum(row[5] for row in seeded), 500)
+
+        # индексы и триггеры поиска восстановлены после загрузки
+        patient = Patient.objects.first()
+        self.assertIn(patient.id, search.search_ids(patient.name, limit=500))
+        patient.name = 'Unique Seedname'
+        patient.save()
+        self.assertEqual(search.search_ids('seedname'), [patient.id])
+
+    def test_seed_data_keep_reuses_reference_data(self):
+        options = {'patients': 100, 'doctors': 3, 'receptionists': 2, 'departments': 2, 'workers': 1}
+        call_command('seed_data', keep=True, stdout=io.StringIO(), **options)
+        reference = [list(model.objects.order_by('id').values_list('id', flat=True))
+                     for model in (Department, JobTitle, Room, ServiceType, Doctor, Receptionist, Admin)]
+
+        call_command('seed_data', keep=True, stdout=io.StringIO(), **{**options, 'doctors': 4})
+        self.assertEqual(Patient.objects.count(), 200)
+        self.assertEqual(Doctor.objects.count(), 4)
+        self.assertEqual(Department.objects.count(), 2)
+        self.assertEqual(Admin.objects.filter(email=seeding.ADMIN_EMAIL).count(), 1)
+        self.assertEqual(PatientCard.objects.filter(visits__isnull=True).count(), 0)
+        # новые визиты ссылаются на прежние справочники и пользователей
+        for ids, model in zip(reference, (Department, JobTitle, Room, ServiceType)):
+            self.assertEqual(list(model.objects.order_by('id').values_list('id', flat=True)), ids)
+        self.assertTrue(set(reference[4]) < set(Doctor.objects.values_list('id', flat=True)))
+
+    def test_clear(self):
+        seeding.seed(100, doctors=2, receptionists=1, departments=1)
+        seeding.clear()
+        self.assertFalse(Patient.objects.exists())
+        self.assertFalse(PatientCard.objects.exists())
+        self.assertFalse(UserProfile.objects.exists())
+        self.assertEqual(search.search_ids('seed'), [])
+
+
+class ClaimsAuthenticationTests(CrmTestCase):
+    def login(self, user):
+        user.set_password('secret-password')
+        user.save()
+        response = APIClient().post(reverse('login'), {'email': user.email, 'password': 'secret-password'})
+        self.assertEqual(response.status_code, 200, response.data)
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Bearer {response.data["access"]}')
+        return client
+
+    def user_queries(self, ctx):
+        return [q['sql'] for q in ctx.captured_queries if 'crm_med_userprofile' in q['sql']]
+
+    def test_role_from_token(self):
+        client = self.login(self.receptionist)
+        client.get(reverse('job_title_list'))
+        with CaptureQueriesContext(connection) as ctx:
+            response = client.get(reverse('job_title_list'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.user_queries(ctx), [])
+        self.assertEqual(client.get(reverse('analysis_regression')).status_code, 403)
+
+    def test_doctor_sees_own_patients(self):
+        doctor = self.doctors[0]
+        self.make_patients(5, doctor=doctor)
+        response = self.login(doctor).get(reverse('doctor_patients'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['results']), 5)
+
+    def test_revoked_on_deactivation_role_or_password_change(self):
+        for change in (
+            lambda user: setattr(user, 'is_active', False),
+            lambda user: setattr(user, 'user_role', 'doctor'),
+            lambda user: user.set_password('another-password'),
+        ):
+            get_cache().clear()
+            user = Receptionist.objects.get(pk=self.receptionist.pk)
+            client = self.login(user)
+            self.assertEqual(client.get(reverse('doctor_list')).status_code, 200)
+            change(user)
+            with self.captureOnCommitCallbacks(execute=True):
+                user.save()
+            self.assertEqual(client.get(reverse('doctor_list')).status_code, 401)
+            Receptionist.objects.filter(pk=user.pk).update(is_active=True, user_role='receptionist')
+
+    def test_token_without_claims_uses_database(self):
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Bearer {RefreshToken.for_user(self.admin).access_token}')
+        with CaptureQueriesContext(connection) as ctx:
+            response = client.get(reverse('job_title_list'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(self.user_queries(ctx)), 1)
+
+
+@override_settings(OUTBOX_WORKER='command', OUTBOX_RETRY_BASE=30, OUTBOX_MAX_ATTEMPTS=3)
+class MailOutboxTests(TestCase):
+    def setUp(self):
+        self.user = Admin.objects.create(username='reset', email='reset@test.local', user_role='admin')
+        self.user.set_password('secret-password')
+        self.user.save()
+
+    def enqueue(self, count=1):
+        return [outbox.enqueue(f'Subject {i}', f'Body {i}', [f'user{i}@test.local'], 'noreply@test.local')
+                for i in range(count)]
+
+    def test_reset_request_does_not_send_mail(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = APIClient().post(reverse('password_reset:reset-password-request'), {'email': self.user.email})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(mail.outbox, [])
+        message = OutboxMessage.objects.get()
+        self.assertEqual((message.status, message.recipients), ('pending', [self.user.email]))
+
+        call_command('send_outbox', '--once', stdout=io.StringIO())
+        self.assertEqual(len(mail.outbox), 1)
+        code = self.user.password_reset_tokens.get().key
+        self.assertIn(code, mail.outbox[0].body)
+        self.assertEqual(mail.outbox[0].to, [self.user.email])
+        message.refresh_from_db()
+        self.assertEqual((message.status, message.attempts), ('sent', 1))
+
+    def test_batches_share_connection(self):
+        self.enqueue(5)
+        with mock.patch('crm_med.outbox.get_connection', wraps=outbox.get_connection) as get_connection:
+            self.assertEqual(outbox.deliver(batch_size=2), {'sent': 5, 'retried': 0, 'failed': 0})
+        # три пачки; последняя, пустая, соединение не открывает
+        self.assertEqual(get_connection.call_count, 3)
+        self.assertEqual(sorted(message.to[0] for message in mail.outbox), [f'user{i}@test.local' for i in range(5)])
+        self.assertEqual(outbox.deliver(), {'sent': 0, 'retried': 0, 'failed': 0})
+
+    def test_claimed_messages_are_leased(self):
+        self.enqueue(3)
+        first, second = outbox.claim(2), outbox.claim(2)
+        self.assertEqual(len(first), 2)
+        self.assertEqual(len(second), 1)
+        self.assertFalse({message.id for message in first} & {message.id for message in second})
+        self.assertEqual(outbox.claim(2), [])
+
+    def test_retry_with_backoff(self):
+        message, = self.enqueue()
+        with mock.patch('django.core.mail.EmailMessage.send', side_effect=smtplib.SMTPServerDisconnected('gone')), \
+                self.assertLogs('crm_med.outbox', 'WARNING'):
+            self.assertEqual(outbox.send_batch(), {'sent': 0, 'retried': 1, 'failed': 0})
+            message.refresh_from_db()
+            self.assertEqual((message.status, message.attempts), ('pending', 1))
+            self.assertIn('SMTPServerDisconnected', message.last_error)
+            delay = message.next_attempt_at - timezone.now()
+            self.assertTrue(timedelta(seconds=25) < delay <= timedelta(seconds=30))
+            # пауза ещё не прошла
+            self.assertEqual(outbox.send_batch(), {'sent': 0, 'retried': 0, 'failed': 0})
+
+            OutboxMessage.objects.update(next_attempt_at=timezone.now())
+            outbox.send_batch()
+            message.refresh_from_db()
+            self.assertEqual(message.attempts, 2)
+            self.assertGreater(message.next_attempt_at - timezone.now(), timedelta(seconds=55))
+
+            OutboxMessage.objects.update(next_attempt_at=timezone.now())
+            with self.assertLogs('crm_med.outbox', 'ERROR'):
+                self.assertEqual(outbox.send_batch(), {'sent': 0, 'retried': 0, 'failed': 1})
+        message.refresh_from_db()
+        self.assertEqual((message.status, message.attempts), ('failed', 3))
+        self.assertEqual(mail.outbox, [])
+
+    def test_unreachable_server_retries_batch(self):
+        self.enqueue(2)
+        with mock.patch('django.core.mail.backends.locmem.EmailBackend.open', side_effect=OSError('refused')), \
+                self.assertLogs('crm_med.outbox', 'WARNING'):
+            self.assertEqual(outbox.send_batch(), {'sent': 0, 'retried': 2, 'failed': 0})
+        self.assertEqual(OutboxMessage.objects.filter(status='pending', attempts=1).count(), 2)
+
+
+@override_settings(OUTBOX_WORKER='thread', OUTBOX_POLL_INTERVAL=0.05)
+class MailOutboxWorkerTests(TransactionTestCase):
+    def tearDown(self):
+        outbox.stop_worker(timeout=5)
+
+    def test_thread_sends_after_commit(self):
+        with transaction.atomic():
+            outbox.enqueue("Сброс пароля", "Code", ['worker@test.local'])
+            self.assertIsNone(outbox._worker)
+        deadline = time.monotonic() + 5
+        while not mail.outbox and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual([message.to for message in mail.outbox], [['worker@test.local']])
+        self.assertTrue(outbox._worker.is_alive())
 
-# Create your tests here.
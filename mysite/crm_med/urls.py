@@ -1,5 +1,6 @@
 from django.urls import path, include
 from .views import *
+from .async_views import *
 
 
 urlpatterns = [
@@ -9,11 +10,17 @@ urlpatterns = [
     # ✅ patient
     path('department/<int:pk>/patient/', DepartmentPatientAPIView.as_view(), name='department_patients'),
     path('patient/create/', PatientCreateAPIView.as_view(), name='patient_create'),
+    path('patient/bulk_create/', PatientBulkCreateAPIView.as_view(), name='patient_bulk_create'),
+    path('patient/bulk_status/', PatientStatusBulkAPIView.as_view(), name='patient_bulk_status'),
+    path('patient/search/', PatientSearchAPIView.as_view(), name='patient_search'),
     path('patient/<int:pk>/edit/', PatientEditAPIView.as_view(), name='patient_edit'),
     path('patient/<str:patient_name>/history/', PatientHistoryAPIView.as_view(), name='patient_history'),
     path('patient/<str:patient_name>/history_of_appointment/', PatientHistoryAppointmentAPIView.as_view(), name='patient_history_of_appointments'),
     path('patient/<str:patient_name>/history_of_payment/', PatientHistoryPaymentAPIView.as_view(), name='patient_history_of_payment'),
     path('patient/<int:pk>/info/', PatientInfoAPIView.as_view(), name='patient_info'),
+    path('patient/card/<int:card_id>/history/', PatientHistoryAPIView.as_view(), name='patient_card_history'),
+    path('patient/card/<int:card_id>/history_of_appointment/', PatientHistoryAppointmentAPIView.as_view(), name='patient_card_history_of_appointments'),
+    path('patient/card/<int:card_id>/history_of_payment/', PatientHistoryPaymentAPIView.as_view(), name='patient_card_history_of_payment'),
 
     # ✅ receptionist
     path('receptionist/<int:pk>/', ReceptionistEditAPIView.as_view(), name='receptionist_edit'),
@@ -21,7 +28,8 @@ urlpatterns = [
     # ✅ doctor
     path('doctor/', DoctorListAPIView.as_view(), name='doctor_list'),
     path('doctor/<int:pk>/', DoctorEditAPIView.as_view(), name='doctor_edit'),
-    path('doctor/notification/', DoctorNotificationAPIView.as_view(), name='doctor_edit'),
+    path('doctor/notification/', DoctorNotificationAPIView.as_view(), name='doctor_notification'),
+    path('doctor/notification/stream/', doctor_notification_stream, name='doctor_notification_stream'),
     path('doctor/create/', DoctorCreateAPIView.as_view(), name='doctor_create'),
     path('doctor/patient/', DoctorPatientAPIView.as_view(), name='doctor_patients'),
 
@@ -47,5 +55,16 @@ urlpatterns = [
     # other
     path('departments/', DepartmentListAPIView.as_view(), name='department_list'),
     path('jobs/', JobTitleAPIView.as_view(), name='job_title_list'),
-    path('rooms/', RoomAPIView.as_view(), name='job_title_list'),
+    path('rooms/', RoomAPIView.as_view(), name='room_list'),
+
+    # async-версии для ASGI (crm_med/async_views.py): те же ответы
+    path('async/calendar/', CalendarListAsyncView.as_view(), name='calendar_list_async'),
+    path('async/doctor/patient/', DoctorPatientAsyncView.as_view(), name='doctor_patients_async'),
+    path('async/patient/<str:patient_name>/history/', PatientHistoryAsyncView.as_view(), name='patient_history_async'),
+    path('async/patient/<str:patient_name>/history_of_appointment/', PatientHistoryAppointmentAsyncView.as_view(), name='patient_history_of_appointments_async'),
+    path('async/patient/<str:patient_name>/history_of_payment/', PatientHistoryPaymentAsyncView.as_view(), name='patient_history_of_payment_async'),
+    path('async/patient/card/<int:card_id>/history/', PatientHistoryAsyncView.as_view(), name='patient_card_history_async'),
+    path('async/patient/card/<int:card_id>/history_of_appointment/', PatientHistoryAppointmentAsyncView.as_view(), name='patient_card_history_of_appointments_async'),
+    path('async/patient/card/<int:card_id>/history_of_payment/', PatientHistoryPaymentAsyncView.as_view(), name='patient_card_history_of_payment_async'),
+    path('async/analysis/', AnalysisAsyncView.as_view(), name='analysis_regression_async'),
 ]
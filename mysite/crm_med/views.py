@@ -4,24 +4,30 @@ from rest_framework import generics, views, status
 from .serializers import *
 from .models import *
 from rest_framework.response import Response
-from django.db.models import Q
+from django.db import transaction
 from rest_framework.views import APIView
 from django.utils import timezone
 from rest_framework.exceptions import ValidationError
-from django.db.models import F, Sum, Value, IntegerField, Case, When, Q
-from django.db.models.functions import Coalesce
-from django.http import HttpResponse
-from openpyxl import Workbook
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from asgiref.sync import sync_to_async
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.exceptions import InvalidToken
 from rest_framework.permissions import IsAuthenticated
 from django.utils.translation import gettext as _
-import openpyxl
-from openpyxl.utils import get_column_letter
 from django.db.models import Count
 from .permissions import *
+from .pagination import PatientCursorPagination
+from .reports import (
+    patient_totals, rollup_totals, doctor_earnings, summary_from_totals, analysis_report, ANALYSIS_PERIODS,
+    day_bounds, appointment_on, calendar_window, visit_price,
+)
+from .exports import XlsxExport, iterate
+from .cache import CachedResponseMixin, ReferenceDataMixin
+from .changes import ChangeCounterETagMixin, doctor_scope, department_scope, ALL_SCOPE
+from .signals import patients_bulk_changed
+from . import search, metrics, notifications
 from rest_framework_simplejwt.views import TokenObtainPairView
 from rest_framework.decorators import api_view
-from rest_framework.response import Response
-from rest_framework import status
 from django_filters.rest_framework import DjangoFilterBackend
 
 
@@ -43,6 +49,8 @@ class DepartmentPatientAPIView(generics.RetrieveAPIView):
     queryset = Department.objects.all()
     serializer_class = DepartmentPatientSerializer
     permission_classes = [IsAdmin | IsReceptionist]
+    # максимум SQL-запросов на один запрос, не зависящий от числа строк (см. QueryBudgetTests)
+    query_budget = 2
 
     def retrieve(self, request, *args, **kwargs):
         # Получаем департамент
@@ -60,6 +68,10 @@ class DepartmentPatientAPIView(generics.RetrieveAPIView):
         if search_name:
             patients_qs = patients_qs.filter(name=search_name)
 
+        # полнотекстовый поиск по имени, телефону и примечанию
+        if request.query_params.get('q'):
+            patients_qs = search.filter_patients(patients_qs, request.query_params['q'])
+
         # Фильтрация по доктору
         if doctor_id:
             patients_qs = patients_qs.filter(doctor_id=doctor_id)
@@ -69,13 +81,11 @@ class DepartmentPatientAPIView(generics.RetrieveAPIView):
             selected_date = parse_date(date_str)
             if not selected_date:
                 raise ValidationError({"date": "Invalid date format, use YYYY-MM-DD"})
-            patients_qs = patients_qs.filter(appointment_date__date=selected_date)
-
-        # Временно подменим queryset пациентов на отфильтрованный
-        serializer = self.get_serializer(department)
-        data = serializer.data
+            patients_qs = patients_qs.filter(appointment_on(selected_date))
 
-        # Заменим пациентов в ответе на отфильтрованные
+        # DepartmentPatientSerializer сериализовал бы всех пациентов отделения,
+        # поэтому отделение — без них, а пациенты — только отфильтрованные
+        data = DepartmentListSerializer(department).data
         data['patients'] = PatientListSerializer(patients_qs, many=True).data
 
         return Response(data)
@@ -88,25 +98,136 @@ class PatientCreateAPIView(views.APIView):
         serializer = PatientCreateSerializer(data=request.data)
         if serializer.is_valid():
             data = serializer.validated_data
-            name = data.get("name")
-            patient_name_db = Patient.objects.filter(name__iexact=name).exists()
-            serializer.save(primary_patient=not patient_name_db)
+            # первичный визит — у карточки пациента ещё нет визитов
+            card = PatientCard.objects.for_visit(data.get("name"), data.get("phone"))
+            serializer.save(card=card, primary_patient=not card.visits.exists())
+            return Response(serializer.data, status=status.HTTP_201_CREATED)
+
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+
+class PatientBulkCreateAPIView(views.APIView):
+    """
+    Создание списка визитов одним запросом: POST /patient/bulk_create/ [{...}, {...}]
+    Ошибки возвращаются списком — по одному элементу на строку ({} у корректных).
+    """
+    permission_classes = [IsAdmin | IsReceptionist]
+    max_rows = 500
+
+    def post(self, request):
+        serializer = PatientBulkCreateSerializer(
+            data=request.data, many=True, allow_empty=False, max_length=self.max_rows,
+        )
+        if serializer.is_valid():
+            serializer.save()
             return Response(serializer.data, status=status.HTTP_201_CREATED)
 
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
+class PatientStatusBulkAPIView(views.APIView):
+    """
+    Массовая смена статуса (закрытие дня): POST /patient/bulk_status/
+    {"ids": [1, 2, 3], "patient_status": "had an appointment"}
+
+    Меняются только визиты, для которых переход разрешён (PATIENT_STATUS_TRANSITIONS),
+    одним UPDATE. В ответе — результат по каждому id:
+    updated / unchanged / not_allowed / not_found.
+    """
+    permission_classes = [IsAdmin | IsReceptionist]
+
+    def post(self, request):
+        serializer = PatientStatusBulkSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        ids = list(dict.fromkeys(serializer.validated_data['ids']))
+        target = serializer.validated_data['patient_status']
+        sources = {source for source, targets in PATIENT_STATUS_TRANSITIONS.items() if target in targets}
+
+        with transaction.atomic():
+            patients = {
+                patient.id: patient
+                for patient in Patient.objects.select_for_update()
+                .filter(id__in=ids).only('id', 'patient_status', 'appointment_date', 'doctor_id', 'department_id')
+            }
+            allowed = [patient for patient in patients.values() if patient.patient_status in sources]
+            updated = Patient.objects.filter(
+                id__in=[patient.id for patient in allowed], patient_status__in=sources,
+            ).update(patient_status=target)
+            # update() не отправляет post_save — сводная таблица и кэш отчётов
+            # обновляются в этой же транзакции
+            patients_bulk_changed.send(sender=Patient, patients=allowed)
+
+        results = []
+        for patient_id in ids:
+            patient = patients.get(patient_id)
+            if patient is None:
+                results.append({'id': patient_id, 'result': 'not_found'})
+                continue
+            if patient.patient_status in sources:
+                result = 'updated'
+            elif patient.patient_status == target:
+                result = 'unchanged'
+            else:
+                result = 'not_allowed'
+            results.append({'id': patient_id, 'result': result, 'previous_status': patient.patient_status})
+
+        return Response({'patient_status': target, 'updated': updated, 'results': results})
+
+
 class PatientEditAPIView(generics.RetrieveUpdateDestroyAPIView):
     queryset = Patient.objects.all()
     serializer_class = PatientEditSerializer
 
 
+class PatientSearchAPIView(generics.ListAPIView):
+    """
+    Поиск визитов: /patient/search/?q=асан 996700
+    Каждое слово — префикс имени, телефона или примечания; результаты
+    отсортированы по релевантности, при отсутствии совпадений учитываются опечатки.
+    """
+    serializer_class = PatientSearchSerializer
+    permission_classes = [IsAdmin | IsReceptionist]
+    # 2 без опечаток; с опечатками — ещё поиск и по запросу к словарю на слово (до search.MAX_TOKENS)
+    query_budget = 8
+
+    def get_queryset(self):
+        query = self.request.query_params.get('q', '')
+        if not search.tokenize(query):
+            raise ValidationError({"q": "Enter at least 2 characters"})
+        try:
+            limit = min(int(self.request.query_params.get('limit', 20)), 100)
+        except ValueError:
+            raise ValidationError({"limit": "Must be an integer"})
+        # LIMIT -1 в SQLite — без ограничения, отрицательный срез queryset — ошибка
+        if limit < 1:
+            raise ValidationError({"limit": "Must be at least 1"})
+        return search.search_patients(query, limit)
+
+
+def patient_visits(view):
+    """
+    Визиты пациента по карточке: /patient/card/<card_id>/...
+    или по имени /patient/<patient_name>/... (регистр и пробелы не важны, ?phone= уточняет).
+    """
+    card_id = view.kwargs.get('card_id')
+    visits = Patient.objects.select_related('registrar', 'department', 'doctor', 'service_type')
+    if card_id is not None:
+        return visits.filter(card_id=card_id)
+
+    qs = visits.filter(card__name_key=normalize_name(view.kwargs.get('patient_name')))
+    phone = view.request.query_params.get('phone')
+    if phone:
+        qs = qs.filter(card__phone=phone)
+    return qs
+
+
 class PatientHistoryAPIView(generics.ListAPIView):
     serializer_class = PatientHistoryAppointmentSerializer
+    pagination_class = PatientCursorPagination
+    query_budget = 2
 
     def get_queryset(self):
-        patient_name = self.kwargs.get('patient_name')
-        qs = Patient.objects.filter(name=patient_name)
+        qs = patient_visits(self)
         period = self.request.query_params.get('period')
         if not period:
             return qs
@@ -138,27 +259,25 @@ class PatientHistoryAPIView(generics.ListAPIView):
         for item in status_counts:
             counts_dict[item['patient_status']] = item['count']
 
-        # Общее количество
-        total_count = queryset.count()
-
-        counts_dict['all'] = total_count
+        # Общее количество — сумма по статусам, без отдельного COUNT(*)
+        counts_dict['all'] = sum(item['count'] for item in status_counts)
 
-        serializer = self.get_serializer(queryset, many=True)
+        page = self.paginate_queryset(queryset)
+        serializer = self.get_serializer(page, many=True)
         return Response({
             "report": counts_dict,
-            "patients": serializer.data
+            "patients": serializer.data,
+            "next": self.paginator.get_next_link(),
+            "previous": self.paginator.get_previous_link(),
         })
 
 
 class PatientHistoryAppointmentAPIView(generics.ListAPIView):
     serializer_class = PatientHistoryAppointmentSerializer
+    query_budget = 1
 
     def get_queryset(self):
-        patient_name = self.kwargs.get('patient_name')
-        qs = Patient.objects.filter(
-            name=patient_name,
-            patient_status='had an appointment'
-        )
+        qs = patient_visits(self).filter(patient_status='had an appointment')
 
         period = self.request.query_params.get('period')
         if not period:  # если параметр не задан — возвращаем всех
@@ -183,23 +302,21 @@ class PatientHistoryAppointmentAPIView(generics.ListAPIView):
     def list(self, request, *args, **kwargs):
         queryset = self.get_queryset()
         serializer = self.get_serializer(queryset, many=True)
+        patients = serializer.data
 
         return Response({
-            'patient_quantity': queryset.count(),
-            'patients': serializer.data,
+            'patient_quantity': len(patients),
+            'patients': patients,
         })
 
 
 class PatientHistoryPaymentAPIView(generics.ListAPIView):
     queryset = Patient.objects.all()
     serializer_class = PatientHistoryPaymentSerializer
+    query_budget = 1
 
     def get_queryset(self):
-        patient_name = self.kwargs.get('patient_name')
-        qs = Patient.objects.filter(
-            Q(name=patient_name) &
-            Q(patient_status='had an appointment')
-        )
+        qs = patient_visits(self).filter(patient_status='had an appointment')
 
         period = self.request.query_params.get('period')
         if not period:  # если параметр не задан — возвращаем всех
@@ -228,7 +345,7 @@ class PatientHistoryPaymentAPIView(generics.ListAPIView):
         cash = 0
         card = 0
         for i in queryset:
-            price = i.with_discount if i.with_discount else i.service_type.price
+            price = visit_price(i)
             if i.payment_type == 'cash':
                 cash += price
             else:
@@ -259,9 +376,10 @@ class DoctorListAPIView(generics.ListAPIView):
     queryset = Doctor.objects.all()
     serializer_class = DoctorListSerializer
     permission_classes = [IsAdmin | IsReceptionist]
+    query_budget = 1
 
     def get_queryset(self):
-        qs = Doctor.objects.all()
+        qs = Doctor.objects.select_related('department', 'job_title')
 
         department_id = self.request.query_params.get('department')
         if department_id:
@@ -280,13 +398,40 @@ class DoctorEditAPIView(generics.RetrieveUpdateDestroyAPIView):
     permission_classes = [IsAdmin | DoctorRetrieve]
 
 
-class DoctorNotificationAPIView(generics.ListAPIView):
+class DoctorNotificationAPIView(ChangeCounterETagMixin, generics.ListAPIView):
+    """
+    Визиты доктора. С ?since=<cursor> — только события назначения после
+    курсора: {cursor, has_more, events}; курсор для первого запроса —
+    заголовок X-Notification-Cursor полного списка.
+    Курсор надёжен при SQLite; в PostgreSQL событие конкурентной транзакции
+    может стать видимым позже курсора и будет пропущено (crm_med/notifications.py).
+    Поток тех же событий — doctor_notification_stream — досматривает такие события.
+    """
     queryset = Patient.objects.all()
     serializer_class = DoctorNotificationSerializer
     permission_classes = [IsDoctor]
+    pagination_class = PatientCursorPagination
+    query_budget = 3
+
+    def get_change_scope(self, request):
+        return doctor_scope(request.user.id)
 
     def get_queryset(self):
-        return Patient.objects.filter(doctor=self.request.user.id)
+        return Patient.objects.select_related('department', 'registrar').filter(doctor=self.request.user.id)
+
+    def list(self, request, *args, **kwargs):
+        try:
+            since = notifications.parse_cursor(request.query_params.get('since'))
+        except ValueError as exc:
+            raise ValidationError({'since': str(exc)})
+        if since is not None:
+            return Response(notifications.events_after(request.user.id, since))
+
+        # курсор читается до списка: событие между ними придёт повторно, а не потеряется
+        cursor = notifications.latest_cursor(request.user.id)
+        response = super().list(request, *args, **kwargs)
+        response['X-Notification-Cursor'] = cursor
+        return response
 
 
 class DoctorCreateAPIView(generics.CreateAPIView):
@@ -298,51 +443,71 @@ class DoctorCreateAPIView(generics.CreateAPIView):
         serializer.save(user_role="doctor")
 
 
-class DoctorPatientAPIView(generics.ListAPIView):
+class DoctorPatientAPIView(ChangeCounterETagMixin, generics.ListAPIView):
     queryset = Patient.objects.all()
     serializer_class = DoctorPatientSerializer
+    pagination_class = PatientCursorPagination
+    query_budget = 2
+
+    def get_change_scope(self, request):
+        return doctor_scope(request.user.id)
 
     def get_queryset(self):
-        return Patient.objects.filter(doctor=self.request.user.id)
+        return Patient.objects.select_related(
+            'service_type', 'department', 'doctor__department', 'doctor__job_title',
+        ).filter(doctor=self.request.user.id)
 
 
 class UserProfileAPIView(generics.ListAPIView):
     queryset = UserProfile.objects.all()
     serializer_class = UserProfileSerializer
+    query_budget = 1
 
 
-class DepartmentListAPIView(generics.ListAPIView):
+class DepartmentListAPIView(ReferenceDataMixin, generics.ListAPIView):
+    cache_name = 'department_list'
     queryset = Department.objects.all()
     serializer_class = DepartmentListSerializer
+    query_budget = 1
 
 
-class DepartmentServiceAPIView(generics.ListAPIView):
-    queryset = Department.objects.all()
+class DepartmentServiceAPIView(ReferenceDataMixin, generics.ListAPIView):
+    cache_name = 'department_list_services'
+    queryset = Department.objects.prefetch_related('department_services')
     serializer_class = DepartmentServicesSerializer
     permission_classes = [IsAdmin | IsReceptionist]
+    query_budget = 2
 
 
-class JobTitleAPIView(generics.ListAPIView):
+class JobTitleAPIView(ReferenceDataMixin, generics.ListAPIView):
+    cache_name = 'job_title_list'
     queryset = JobTitle.objects.all()
     serializer_class = JobTitleSerializer
+    query_budget = 1
 
 
-class RoomAPIView(generics.ListAPIView):
+class RoomAPIView(ReferenceDataMixin, generics.ListAPIView):
+    cache_name = 'room_list'
     queryset = Room.objects.all()
     serializer_class = RoomSerializer
+    query_budget = 1
 
 
-class ReportExactAPIView(generics.ListAPIView):
+class ReportExactAPIView(CachedResponseMixin, generics.ListAPIView):
     """
     Возвращает список пациентов, отфильтрованных по:
     - doctor (id доктора, опционально)
     - department (id департамента, опционально)
     - date (YYYY-MM-DD, опционально)
+    - q (поиск по имени, телефону и примечанию, опционально)
 
     Если передан параметр export=excel, возвращается Excel-файл.
     """
     serializer_class = ReportExactSerializer
     permission_classes = [IsAdmin | IsReceptionist]
+    cache_name = 'report_exact'
+    pagination_class = PatientCursorPagination
+    query_budget = 2
 
     def get_queryset(self):
         qs = Patient.objects.select_related("service_type", "doctor")
@@ -354,6 +519,8 @@ class ReportExactAPIView(generics.ListAPIView):
 
         if search_name:
             qs = qs.filter(name=search_name)
+        if self.request.query_params.get('q'):
+            qs = search.filter_patients(qs, self.request.query_params['q'])
         if doctor_id:
             qs = qs.filter(doctor_id=doctor_id)
         if department_id:
@@ -362,87 +529,54 @@ class ReportExactAPIView(generics.ListAPIView):
             selected_date = parse_date(date_str)
             if not selected_date:
                 raise ValidationError({"date": "Invalid date format, use YYYY-MM-DD"})
-            qs = qs.filter(appointment_date__date=selected_date)
+            qs = qs.filter(appointment_on(selected_date))
 
         return qs
 
+    def get_totals(self, queryset):
+        if self.request.query_params.get('name') or self.request.query_params.get('q'):
+            # по имени пациента сводная таблица не группирует — считаем по визитам
+            return patient_totals(queryset)
+
+        rollups = DailyRevenueRollup.objects.all()
+
+        doctor_id = self.request.query_params.get('doctor')
+        department_id = self.request.query_params.get('department')
+        date_str = self.request.query_params.get('date')
+
+        if doctor_id:
+            rollups = rollups.filter(doctor_id=doctor_id)
+        if department_id:
+            rollups = rollups.filter(department_id=department_id)
+        if date_str:
+            rollups = rollups.filter(date=parse_date(date_str))
+
+        return rollup_totals(rollups)
+
     def list(self, request, *args, **kwargs):
         queryset = self.get_queryset()
 
         if request.query_params.get("export") == "excel":
             return self.export_to_excel(queryset)
 
-        sum_discount = queryset.aggregate(
-            total=Coalesce(Sum('with_discount', filter=Q(with_discount__isnull=False)), Value(0))
-        )['total']
-
-        sum_no_discount = queryset.aggregate(
-            total=Coalesce(
-                Sum('service_type__price', filter=Q(with_discount__isnull=True)),
-                Value(0)
-            )
-        )['total']
-
-        doctor_earnings = 0
-        for patient in queryset:
-            price = patient.with_discount if patient.with_discount else patient.service_type.price
-            percent = patient.doctor.bonus or 0
-            doctor_earnings += price * percent / 100
-
-        patients_count = queryset.count()
-
-        payments = queryset.aggregate(
-            total_cash=Coalesce(
-                Sum(
-                    Case(
-                        When(payment_type='cash',
-                             then=Case(
-                                 When(with_discount__isnull=False, then=F('with_discount')),
-                                 default=F('service_type__price'),
-                                 output_field=IntegerField()
-                             )
-                             ),
-                        default=Value(0),
-                        output_field=IntegerField()
-                    )
-                ),
-                Value(0)
-            ),
-            total_card=Coalesce(
-                Sum(
-                    Case(
-                        When(payment_type='card',
-                             then=Case(
-                                 When(with_discount__isnull=False, then=F('with_discount')),
-                                 default=F('service_type__price'),
-                                 output_field=IntegerField()
-                             )
-                             ),
-                        default=Value(0),
-                        output_field=IntegerField()
-                    )
-                ),
-                Value(0)
-            )
-        )
+        totals = self.get_totals(queryset)
 
-        serializer = self.get_serializer(queryset, many=True)
+        page = self.paginate_queryset(queryset)
+        serializer = self.get_serializer(page, many=True)
 
         return Response({
-            "sum_discount": sum_discount,
-            "sum_no_discount": sum_no_discount,
-            "doctor_earnings": round(doctor_earnings, 2),
-            "patients_count": patients_count,
-            "total_cash": payments['total_cash'],
-            "total_card": payments['total_card'],
-            "patients": serializer.data
+            "sum_discount": totals['sum_discount'],
+            "sum_no_discount": totals['sum_no_discount'],
+            "doctor_earnings": doctor_earnings(totals),
+            "patients_count": totals['patients_count'],
+            "total_cash": totals['total_cash'],
+            "total_card": totals['total_card'],
+            "patients": serializer.data,
+            "next": self.paginator.get_next_link(),
+            "previous": self.paginator.get_previous_link(),
         })
 
     def export_to_excel(self, queryset):
-        wb = openpyxl.Workbook()
-        ws = wb.active
-        ws.title = "Patients"
-
         lang = self.request.LANGUAGE_CODE
         if lang == 'ru':
             headers = [
@@ -454,39 +588,35 @@ class ReportExactAPIView(generics.ListAPIView):
                 "ID", "Date", "Name", "Service",
                 "Payment type", "Price", "Discount", "Doctor"
             ]
-        ws.append(headers)
-
-        for p in queryset:
-            price = p.with_discount if p.with_discount else p.service_type.price
-            ws.append([
+        export = XlsxExport("Patients", headers)
+
+        # строки и итоги считаются за один проход по queryset
+        patients_count = 0
+        total_price = 0
+        for p in iterate(queryset):
+            price = visit_price(p)
+            patients_count += 1
+            total_price += price
+            export.append([
                 p.id,
                 p.appointment_date.strftime('%d-%m-%Y %H:%M'),
                 p.name,
                 p.service_type.type,
                 p.get_payment_type_display(),
                 p.service_type.price if p.with_discount is None else "-",
-                p.with_discount if p.with_discount else "-",
+                p.with_discount if p.with_discount is not None else "-",
                 p.doctor.username,
             ])
 
-        total_price = sum(
-            p.with_discount if p.with_discount else p.service_type.price
-            for p in queryset
-        )
-        ws.append([])
-        ws.append([_("Total patients"), queryset.count()])
-        ws.append([_("Total amount"), total_price])
+        export.append([])
+        export.append([_("Total patients"), patients_count])
+        export.append([_("Total amount"), total_price])
 
-        response = HttpResponse(
-            content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
-        )
         filename = self.request.query_params.get('filename', 'report_exact.xlsx')
-        response['Content-Disposition'] = f'attachment; filename={filename}'
-        wb.save(response)
-        return response
+        return export.response(filename)
 
 
-class ReportDoctorAPIView(generics.ListAPIView):
+class ReportDoctorAPIView(CachedResponseMixin, generics.ListAPIView):
     """
         Возвращает список пациентов для конкретного доктора и даты.
         Фильтры:
@@ -495,9 +625,12 @@ class ReportDoctorAPIView(generics.ListAPIView):
         """
     serializer_class = ReportDoctorSerializer
     permission_classes = [IsAdmin | IsReceptionist]
+    pagination_class = PatientCursorPagination
+    cache_name = 'report_doctor'
+    query_budget = 2
 
     def get_queryset(self):
-        qs = Patient.objects.all()
+        qs = Patient.objects.select_related('service_type')
 
         search_doctor_name = self.request.query_params.get('name')
         doctor_id = self.request.query_params.get('doctor')
@@ -513,7 +646,24 @@ class ReportDoctorAPIView(generics.ListAPIView):
             selected_date = parse_date(date_str)
             if not selected_date:
                 raise ValidationError({"date": "Invalid date format, use YYYY-MM-DD"})
-            qs = qs.filter(appointment_date__date=selected_date)
+            qs = qs.filter(appointment_on(selected_date))
+
+        return qs
+
+    def get_rollup_queryset(self):
+        """Те же фильтры, но по сводной таблице — для итоговой суммы."""
+        qs = DailyRevenueRollup.objects.all()
+
+        search_doctor_name = self.request.query_params.get('name')
+        doctor_id = self.request.query_params.get('doctor')
+        date_str = self.request.query_params.get('date')
+
+        if search_doctor_name:
+            qs = qs.filter(doctor__username=search_doctor_name)
+        if doctor_id:
+            qs = qs.filter(doctor_id=doctor_id)
+        if date_str:
+            qs = qs.filter(date=parse_date(date_str))
 
         return qs
 
@@ -523,144 +673,96 @@ class ReportDoctorAPIView(generics.ListAPIView):
         if request.query_params.get("export") == "excel":
             return self.export_to_excel(queryset)
 
-        serializer = self.get_serializer(queryset, many=True)
-
-        total_price = sum(
-            p.with_discount if p.with_discount else p.service_type.price
-            for p in queryset
-        )
+        page = self.paginate_queryset(queryset)
+        serializer = self.get_serializer(page, many=True)
+        totals = rollup_totals(self.get_rollup_queryset())
 
         return Response({
-            "total_price": total_price,
-            "results": serializer.data
+            "total_price": totals['total_cash'] + totals['total_card'],
+            "results": serializer.data,
+            "next": self.paginator.get_next_link(),
+            "previous": self.paginator.get_previous_link(),
         })
 
     def export_to_excel(self, queryset):
-        wb = openpyxl.Workbook()
-        ws = wb.active
-        ws.title = "Patients"
-
         lang = self.request.LANGUAGE_CODE
         if lang == 'ru':
             headers = ["ID", "Дата", "Имя", "Цена"]
         else:
             headers = ["ID", "Date", "Name", "Price"]
+        export = XlsxExport("Patients", headers)
 
-        ws.append(headers)
-
-        for p in queryset:
-            price = p.with_discount if p.with_discount else p.service_type.price
-            ws.append([
+        total_price = 0
+        for p in iterate(queryset):
+            price = visit_price(p)
+            total_price += price
+            export.append([
                 p.id,
                 p.appointment_date.strftime('%d-%m-%Y %H:%M'),
                 p.name,
                 price,
             ])
 
-        total_price = sum(
-            p.with_discount if p.with_discount else p.service_type.price
-            for p in queryset
-        )
-        ws.append([])
-        ws.append([_("Total"), "", "", total_price])
+        export.append([])
+        export.append([_("Total"), "", "", total_price])
 
-        response = HttpResponse(
-            content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
-        )
         filename = self.request.query_params.get('filename', 'report_doctor.xlsx')
-        response['Content-Disposition'] = f'attachment; filename={filename}'
-        wb.save(response)
-        return response
-
+        return export.response(filename)
 
-from django.http import HttpResponse
-from rest_framework import generics
-from rest_framework.exceptions import ValidationError
-from rest_framework.response import Response
-from django.utils.dateparse import parse_date
-from openpyxl import Workbook
-from openpyxl.utils import get_column_letter
 
-from .models import Patient
-
-
-class ReportSummaryAPIView(generics.ListAPIView):
+class ReportSummaryAPIView(CachedResponseMixin, generics.ListAPIView):
     """
     Выводит итоговые суммы за период,
     а если передан ?export=excel — возвращает Excel файл.
     """
     permission_classes = [IsAdmin | IsReceptionist]
+    cache_name = 'report_summary'
+    query_budget = 1
 
     def get_queryset(self):
         return Patient.objects.none()
 
     def get_report_data(self):
-        qs = Patient.objects.all()
-
         search_name = self.request.query_params.get('name')
         date_from = self.request.query_params.get('date_from')
         date_to = self.request.query_params.get('date_to')
 
-        if search_name:
-            qs = qs.filter(name=search_name)
-
+        selected_date_from = selected_date_to = None
         if date_from:
             selected_date_from = parse_date(date_from)
             if not selected_date_from:
                 raise ValidationError({"date_from": "Invalid date format, use YYYY-MM-DD"})
-            qs = qs.filter(appointment_date__date__gte=selected_date_from)
 
         if date_to:
             selected_date_to = parse_date(date_to)
             if not selected_date_to:
                 raise ValidationError({"date_to": "Invalid date format, use YYYY-MM-DD"})
-            qs = qs.filter(appointment_date__date__lte=selected_date_to)
-
-        doctor_cash = 0
-        doctor_card = 0
-        clinic_cash = 0
-        clinic_card = 0
-
-        for patient in qs:
-            price = patient.with_discount if patient.with_discount else patient.service_type.price
-            bonus = patient.doctor.bonus
-
-            doctor_part = price / 100 * bonus if bonus else 1
-
-            if patient.payment_type == 'cash':
-                doctor_cash += doctor_part
-                clinic_cash += price - doctor_part
-            else:
-                doctor_card += doctor_part
-                clinic_card += price - doctor_part
-
-        total_cash = doctor_cash + clinic_cash
-        total_card = doctor_card + clinic_card
-        total_clinic = clinic_cash + clinic_card
-        total_doctor = doctor_cash + doctor_card
-
-        return {
-            'doctor_cash': int(doctor_cash),
-            'doctor_card': int(doctor_card),
 
-            'clinic_cash': int(clinic_cash),
-            'clinic_card': int(clinic_card),
-
-            'total_cash': int(total_cash),
-            'total_card': int(total_card),
-
-            'total_clinic': int(total_clinic),
-            'total_doctor': int(total_doctor),
-        }
+        search_query = self.request.query_params.get('q')
+        if search_name or search_query:
+            # по имени пациента сводная таблица не группирует — считаем по визитам
+            qs = Patient.objects.all()
+            if search_name:
+                qs = qs.filter(name=search_name)
+            if search_query:
+                qs = search.filter_patients(qs, search_query)
+            if selected_date_from:
+                qs = qs.filter(appointment_date__gte=day_bounds(selected_date_from)[0])
+            if selected_date_to:
+                qs = qs.filter(appointment_date__lt=day_bounds(selected_date_to)[1])
+            return summary_from_totals(patient_totals(qs))
+
+        rollups = DailyRevenueRollup.objects.all()
+        if selected_date_from:
+            rollups = rollups.filter(date__gte=selected_date_from)
+        if selected_date_to:
+            rollups = rollups.filter(date__lte=selected_date_to)
+        return summary_from_totals(rollup_totals(rollups))
 
     def list(self, request, *args, **kwargs):
         report_data = self.get_report_data()
 
         if request.query_params.get('export') == 'excel':
-            wb = Workbook()
-            ws = wb.active
-            ws.title = "Report Summary"
-
             lang = self.request.LANGUAGE_CODE
             if lang == 'ru':
                 headers = [
@@ -677,9 +779,7 @@ class ReportSummaryAPIView(generics.ListAPIView):
                     "Total clinic", "Total doctors",
                 ]
 
-            ws.append(headers)
-
-            ws.append([
+            row = [
                 report_data['doctor_cash'],
                 report_data['doctor_card'],
                 report_data['clinic_cash'],
@@ -688,120 +788,56 @@ class ReportSummaryAPIView(generics.ListAPIView):
                 report_data['total_card'],
                 report_data['total_clinic'],
                 report_data['total_doctor'],
-            ])
+            ]
+            widths = [max(len(str(header)), len(str(value))) + 2 for header, value in zip(headers, row)]
+
+            export = XlsxExport("Report Summary", headers, widths=widths)
+            export.append(row)
 
-            for i, col in enumerate(ws.columns, start=1):
-                max_length = 0
-                column = get_column_letter(i)
-                for cell in col:
-                    try:
-                        if len(str(cell.value)) > max_length:
-                            max_length = len(str(cell.value))
-                    except:
-                        pass
-                adjusted_width = (max_length + 2)
-                ws.column_dimensions[column].width = adjusted_width
-
-            response = HttpResponse(
-                content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
-            )
             filename = request.query_params.get('filename', 'report_summary.xlsx')
-            response['Content-Disposition'] = f'attachment; filename={filename}'
-            wb.save(response)
-            return response
+            return export.response(filename)
 
         return Response(report_data)
 
 
-class AnalysisAPIView(APIView):
+class AnalysisAPIView(CachedResponseMixin, APIView):
     permission_classes = [IsAdmin]
+    cache_name = 'analysis_regression'
+    # окно графика сдвигается со временем, поэтому храним недолго
+    cache_timeout = 60
+    query_budget = 2
 
-    def get(self, request):
+    def get_uncached(self, request):
         period = request.query_params.get("period", "weekly")
 
-        now = timezone.now()
-        if period == "daily":
-            interval = timedelta(hours=2)  # 12 интервалов
-            start_date = now - timedelta(days=1)
-        elif period == "weekly":
-            interval = timedelta(days=1)  # 7 интервалов
-            start_date = now - timedelta(days=7)
-        elif period == "monthly":
-            interval = timedelta(days=2)  # 15 интервалов
-            start_date = now - timedelta(days=30)
-        elif period == "yearly":
-            interval = None  # Для года будем делить на месяцы
-            start_date = now - timedelta(days=365)
-        else:
+        if period not in ANALYSIS_PERIODS:
             return Response({"error": "Invalid period"}, status=400)
 
-        patients_qs = Patient.objects.filter(appointment_date__gte=start_date, appointment_date__lte=now)
-
         total_doctors = Doctor.objects.count()
-        total_patients = patients_qs.count()
-
-        primary = 0
-        for p in patients_qs:
-            if p.primary_patient:
-                primary += 1
-
-        primary_percent = 0 if not total_patients else primary / total_patients * 100
-        repeated_percent = 0 if not total_patients else 100 - primary_percent
-
-        fall = patients_qs.filter(
-            patient_status='canceled',
-        ).count()
-        fall_percent = 0 if not total_patients else fall / total_patients * 100
-        rise_percent = 0 if not total_patients else 100 - fall_percent
-
-        chart = []
-        if period == "yearly":
-            for m in range(1, 13):
-                start_month = start_date.replace(month=m, day=1)
-                if m == 12:
-                    end_month = start_month.replace(year=start_month.year + 1, month=1, day=1)
-                else:
-                    end_month = start_month.replace(month=m + 1, day=1)
-                bucket_qs = patients_qs.filter(
-                    appointment_date__gte=start_month,
-                    appointment_date__lt=end_month
-                )
-                had_an_appointment = bucket_qs.exclude(patient_status='canceled').count()
-                canceled = bucket_qs.filter(patient_status='canceled').count()
-                chart.append({
-                    "appointment_date": start_month,
-                    "had_an_appointment": had_an_appointment,
-                    "canceled": canceled,
-                })
-        else:
-            current_start = start_date
-            while current_start < now:
-                current_end = current_start + interval
-                bucket_qs = patients_qs.filter(
-                    appointment_date__gte=current_start,
-                    appointment_date__lt=current_end
-                )
-                had_an_appointment = bucket_qs.exclude(patient_status='canceled').count()
-                canceled = bucket_qs.filter(patient_status='canceled').count()
-                chart.append({
-                    "appointment_date": current_start,
-                    "had_an_appointment": had_an_appointment,
-                    "canceled": canceled,
-                })
-                current_start = current_end
-
-        for row in chart:
-            row["appointment_date"] = row["appointment_date"].strftime("%d-%m-%Y %H:%M")
+        totals, chart = analysis_report(Patient.objects.all(), period, timezone.now())
+        return Response(analysis_response(total_doctors, totals, chart))
 
-        return Response({
-            "total_doctors": total_doctors,
-            "total_patients": total_patients,
-            "new_percent": round(primary_percent),
-            "repeated_percent": round(repeated_percent),
-            "rise": round(rise_percent),
-            "fall": round(fall_percent),
-            "chart": chart,
-        })
+
+def analysis_response(total_doctors, totals, chart):
+    total_patients = totals['total']
+    primary_percent = 0 if not total_patients else totals['primary'] / total_patients * 100
+    repeated_percent = 0 if not total_patients else 100 - primary_percent
+
+    fall_percent = 0 if not total_patients else totals['canceled'] / total_patients * 100
+    rise_percent = 0 if not total_patients else 100 - fall_percent
+
+    for row in chart:
+        row["appointment_date"] = timezone.localtime(row["appointment_date"]).strftime("%d-%m-%Y %H:%M")
+
+    return {
+        "total_doctors": total_doctors,
+        "total_patients": total_patients,
+        "new_percent": round(primary_percent),
+        "repeated_percent": round(repeated_percent),
+        "rise": round(rise_percent),
+        "fall": round(fall_percent),
+        "chart": chart,
+    }
 
 
 @api_view(['POST'])
@@ -813,10 +849,74 @@ def verify_reset_code(request):
     return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
-class CalendarListAPIView(generics.ListAPIView):
+class CalendarListAPIView(ChangeCounterETagMixin, generics.ListAPIView):
+    """
+    Записи календаря в окне [start, end).
+    Фильтры: start и end (обязательные), doctor, department.
+    """
     queryset = Patient.objects.all()
     serializer_class = CalendarReport
+    # те же права у живого календаря (crm_med/live.py)
+    permission_classes = [IsAuthenticated & (IsAdmin | IsReceptionist)]
+    pagination_class = PatientCursorPagination
     filter_backends = [DjangoFilterBackend]
     filterset_fields = ['doctor', 'department']
+    query_budget = 3
+
+    def get_change_scope(self, request):
+        # самая узкая область, в которую попадают все визиты ответа
+        doctor = request.query_params.get('doctor', '')
+        department = request.query_params.get('department', '')
+        if doctor.isdigit():
+            return doctor_scope(int(doctor))
+        if department.isdigit():
+            return department_scope(int(department))
+        return ALL_SCOPE
+
+    def get_queryset(self):
+        start, end = calendar_window(self.request.query_params.get('start'), self.request.query_params.get('end'))
+        return Patient.objects.select_related('doctor__job_title', 'department').filter(
+            appointment_date__gte=start,
+            appointment_date__lt=end,
+        )
 
 
+async def doctor_notification_stream(request):
+    """
+    События ленты доктора потоком Server-Sent Events (crm_med/notifications.py).
+    Начало — Last-Event-ID (переподключение EventSource), ?since= или текущий
+    конец ленты. Держит соединение открытым: запускать через mysite/asgi.py,
+    под WSGI поток занимает воркер целиком.
+    """
+    try:
+        user = await sync_to_async(notifications.authenticate)(request)
+    except (AuthenticationFailed, InvalidToken) as exc:
+        detail = exc.detail if isinstance(exc.detail, dict) else {'detail': exc.detail}
+        return JsonResponse(detail, status=status.HTTP_401_UNAUTHORIZED)
+    if user is None:
+        return JsonResponse({'detail': "Authentication credentials were not provided."},
+                            status=status.HTTP_401_UNAUTHORIZED)
+    if user.user_role != 'doctor':
+        return JsonResponse({'detail': "You do not have permission to perform this action."},
+                            status=status.HTTP_403_FORBIDDEN)
+
+    try:
+        cursor = notifications.parse_cursor(request.headers.get('Last-Event-ID', request.GET.get('since')))
+    except ValueError as exc:
+        return JsonResponse({'since': [str(exc)]}, status=status.HTTP_400_BAD_REQUEST)
+    if cursor is None:
+        cursor = await sync_to_async(notifications.latest_cursor)(user.id)
+
+    response = StreamingHttpResponse(notifications.stream(user.id, cursor), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # nginx не должен буферизовать поток
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+class MetricsAPIView(APIView):
+    """Метрики запросов в текстовом формате Prometheus (crm_med/metrics.py)."""
+    permission_classes = [IsAuthenticated & IsAdmin]
+
+    def get(self, request):
+        return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -12,6 +12,7 @@ https://docs.djangoproject.com/en/5.1/ref/settings/
 
 from pathlib import Path
 import os
+import tempfile
 from dotenv import load_dotenv
 from datetime import timedelta
 
@@ -54,6 +55,9 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # первой — чтобы total включал все остальные middleware
+    'crm_med.middleware.ServerTimingMiddleware',
+    'crm_med.middleware.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.locale.LocaleMiddleware',
@@ -160,10 +164,35 @@ AUTH_USER_MODEL = 'crm_med.UserProfile'
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'crm_med.authentication.ClaimsJWTAuthentication',
     )
 }
 
+# размер страницы по умолчанию для списков визитов (crm_med/pagination.py)
+PATIENT_PAGE_SIZE = 50
+
+# сколько секунд кэшируется состояние пользователя (активен, роль, пароль)
+# для проверки JWT без загрузки пользователя (crm_med/authentication.py)
+AUTH_USER_STATE_TIMEOUT = 60
+
+# поток уведомлений доктора (crm_med/notifications.py): как часто проверять новые
+# события, как часто слать keepalive и через сколько секунд закрыть соединение
+NOTIFICATION_STREAM_POLL_INTERVAL = 0.5
+NOTIFICATION_STREAM_KEEPALIVE = 15
+NOTIFICATION_STREAM_TIMEOUT = 300
+# сколько секунд поток досматривает события, зафиксированные позже курсора
+# (PostgreSQL фиксирует конкурентные транзакции не в порядке id)
+NOTIFICATION_STREAM_LOOKBACK = 5
+
+# живой календарь по WebSocket (crm_med/live.py): InProcessBroker — один процесс,
+# FileBroker — несколько воркеров на одной машине через файлы в LIVE_BROKER_DIR
+LIVE_BROKER = os.getenv('LIVE_BROKER', 'crm_med.live.InProcessBroker')
+LIVE_BROKER_DIR = os.getenv('LIVE_BROKER_DIR', os.path.join(tempfile.gettempdir(), 'crm_med_live'))
+LIVE_BROKER_POLL_INTERVAL = 0.2
+# как часто подписчик FileBroker отмечается в <канал>.subscribers
+LIVE_BROKER_HEARTBEAT = 5
+LIVE_QUEUE_SIZE = 1000
+
 SIMPLE_JWT = {
     "ACCESS_TOKEN_LIFETIME": timedelta(minutes=520),
     "REFRESH_TOKEN_LIFETIME": timedelta(days=7),
@@ -172,11 +201,46 @@ SIMPLE_JWT = {
     "AUTH_HEADER_TYPES": ('Bearer',),
 }
 
+# LocMemCache живёт внутри одного процесса: при нескольких воркерах gunicorn
+# используйте общий бэкенд, например
+# CACHE_BACKEND=django.core.cache.backends.filebased.FileBasedCache CACHE_LOCATION=/tmp/crm_med_cache
+CACHES = {
+    'default': {
+        'BACKEND': os.getenv('CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.getenv('CACHE_LOCATION', 'crm-med'),
+    }
+}
+
+# кэш ответов отчётов и аналитики (crm_med/cache.py)
+REPORT_CACHE_ALIAS = 'default'
+REPORT_CACHE_TIMEOUT = 300
+# справочники сбрасываются при изменении, срок — лишь страховка
+REFERENCE_CACHE_TIMEOUT = 24 * 60 * 60
+
+# заголовок Server-Timing с временем SQL, сериализации и рендера (crm_med/middleware.py)
+SERVER_TIMING_ENABLED = os.getenv('SERVER_TIMING_ENABLED', 'True') == 'True'
+
+# метрики Prometheus на /metrics (crm_med/metrics.py); файл общий для всех воркеров
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'True') == 'True'
+METRICS_FILE = os.getenv('METRICS_FILE', os.path.join(tempfile.gettempdir(), 'crm_med_metrics.mmap'))
+
 EMAIL_HOST = 'smtp.gmail.com'
 EMAIL_PORT = 587
 EMAIL_USE_TLS = True
 EMAIL_HOST_USER = 'zulpukarovz555@gmail.com'
 EMAIL_HOST_PASSWORD = 'ywqy kfeh xyne dofn'
+EMAIL_TIMEOUT = 30
+
+# очередь писем (crm_med/outbox.py): 'thread' — отправляет фоновый поток
+# процесса приложения, 'command' — отдельный процесс `manage.py send_outbox`
+OUTBOX_WORKER = os.getenv('OUTBOX_WORKER', 'thread')
+OUTBOX_BATCH_SIZE = 50
+OUTBOX_POLL_INTERVAL = 5
+OUTBOX_LEASE = 300
+# повторы: 30 с, 1 мин, 2 мин ... не реже раза в час, после 8 попыток — failed
+OUTBOX_RETRY_BASE = 30
+OUTBOX_RETRY_MAX = 60 * 60
+OUTBOX_MAX_ATTEMPTS = 8
 
 CORS_ALLOW_ALL_ORIGINS = True
 
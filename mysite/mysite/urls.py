@@ -22,6 +22,7 @@ from django.conf.urls.i18n import i18n_patterns
 from drf_yasg.views import get_schema_view
 from drf_yasg import openapi
 from rest_framework import permissions
+from crm_med.views import MetricsAPIView
 
 schema_view = get_schema_view(
     openapi.Info(
@@ -31,7 +32,10 @@ schema_view = get_schema_view(
     permission_classes=(permissions.AllowAny,),
 )
 
-urlpatterns = i18n_patterns(
+urlpatterns = [
+    # вне i18n_patterns: Prometheus опрашивает фиксированный адрес
+    path('metrics', MetricsAPIView.as_view(), name='metrics'),
+] + i18n_patterns(
     path('admin/', admin.site.urls),
     path('', include('crm_med.urls')),
     path('docs/', schema_view.with_ui('swagger', cache_timeout=0), name='schema-swagger-ui'),